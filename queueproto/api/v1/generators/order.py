@@ -1,41 +1,157 @@
 import asyncio
 import json
-from typing import AsyncGenerator, Optional, Dict
+from typing import AsyncGenerator, Awaitable, Callable, Dict, Set
 
+from celery.utils.log import get_task_logger
 from fastapi import Request
 
 from core.events import OrderEventsQueue, OrderProcessingEventQueue
 
-from api.v1.utils.order import convert_db_order_to_schema
+logger = get_task_logger(__name__)
 
+# How long a single blocking read waits for events, in seconds
+EVENTS_READ_TIMEOUT = 0.5
 
-async def order_event_generator(
-    request: Request,
-    order_event_queue: OrderEventsQueue,
-    process_event_queue: OrderProcessingEventQueue,
-) -> AsyncGenerator[str, None]:
-    while True:
-        if await request.is_disconnected():
-            break
-
-        if order_event_queue.has_orders():
-            recent_order = order_event_queue.pop_order()
-            if recent_order is None:
-                return
-            schemas_order = await asyncio.to_thread(
-                convert_db_order_to_schema, recent_order
+# How long a reader waits after a failed read (e.g. Redis being unavailable),
+# in seconds. The wait is doubled with every failed read in a row, up to
+# READER_MAX_RETRY_BACKOFF.
+READER_RETRY_BACKOFF = 0.5
+READER_MAX_RETRY_BACKOFF = 10
+
+# How many messages can wait for a single connection. A connection that falls
+# this far behind is dropped, the browser's EventSource reconnects on its own.
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+class OrderEventSubscription:
+    def __init__(self, max_size: int):
+        self.messages: asyncio.Queue[str] = asyncio.Queue(maxsize=max_size)
+        self.dropped = False
+
+
+# Process-wide hub - a single background reader per event queue consumes the
+# events and fans every event out to all connected SSE clients
+class OrderEventHub:
+    def __init__(self, subscriber_queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self._subscriber_queue_size = subscriber_queue_size
+        self._subscriptions: Set[OrderEventSubscription] = set()
+        self._readers: Dict[str, asyncio.Task] = dict()
+
+    def subscribe(self) -> OrderEventSubscription:
+        subscription = OrderEventSubscription(max_size=self._subscriber_queue_size)
+        self._subscriptions.add(subscription)
+
+        # Any reader that stopped is started again, not only when all did
+        for name, read in (
+            ("new orders", self._read_new_orders),
+            ("processing events", self._read_processing_events),
+        ):
+            reader = self._readers.get(name)
+            if reader is None or reader.done():
+                self._readers[name] = asyncio.create_task(read())
+
+        return subscription
+
+    def unsubscribe(self, subscription: OrderEventSubscription) -> None:
+        self._subscriptions.discard(subscription)
+
+    def subscriptions_count(self) -> int:
+        return len(self._subscriptions)
+
+    def _publish(self, message: str) -> None:
+        for subscription in list(self._subscriptions):
+            try:
+                subscription.messages.put_nowait(message)
+            except asyncio.QueueFull:
+                # Never let a slow client stall everyone else
+                subscription.dropped = True
+                self._subscriptions.discard(subscription)
+
+    # Readers stop once the last client disconnects, and are started again by
+    # the next subscription. `read` is given the ID to continue reading from and
+    # returns the next one. A failed read is logged and retried after a backoff,
+    # so a Redis outage does not silently stop the events of all clients.
+    async def _keep_reading(
+        self,
+        name: str,
+        latest_event_id: Callable[[], str],
+        read: Callable[[str], Awaitable[str]],
+    ) -> None:
+        last_event_id = None
+        backoff = READER_RETRY_BACKOFF
+        while len(self._subscriptions) > 0:
+            try:
+                if last_event_id is None:
+                    last_event_id = await asyncio.to_thread(latest_event_id)
+                last_event_id = await read(last_event_id)
+            except Exception as e:
+                logger.error(msg=f"Error while reading {name}: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, READER_MAX_RETRY_BACKOFF)
+                continue
+
+            backoff = READER_RETRY_BACKOFF
+
+    async def _read_new_orders(self) -> None:
+        async def read(last_event_id: str) -> str:
+            last_event_id, serialized_orders = await asyncio.to_thread(
+                OrderEventsQueue().read_orders,
+                last_event_id,
+                EVENTS_READ_TIMEOUT,
             )
-            yield f"event: newOrders\ndata: {schemas_order.model_dump_json()}\n\n"
+            for serialized_order in serialized_orders:
+                self._publish(f"event: newOrders\ndata: {serialized_order}\n\n")
+
+            return last_event_id
 
-        if process_event_queue.has_items():
-            processing_order_data: Optional[Dict[str, str]] = (
-                process_event_queue.pop_processing_status()
+        await self._keep_reading(
+            "new orders", lambda: OrderEventsQueue().latest_event_id(), read
+        )
+
+    async def _read_processing_events(self) -> None:
+        async def read(last_event_id: str) -> str:
+            # Blocks until processing events arrive (or the timeout passes), so
+            # they are sent out as soon as they are produced without busy polling
+            last_event_id, processing_events = await asyncio.to_thread(
+                OrderProcessingEventQueue().read_processing_statuses,
+                last_event_id,
+                EVENTS_READ_TIMEOUT,
             )
-            if processing_order_data is None:
-                # should not happend based on the has_items() check above
-                return
+            for processing_order_data in processing_events:
+                event = processing_order_data.pop("event", "")
+                self._publish(
+                    f"event: {event}\ndata: {json.dumps(processing_order_data)}\n\n"
+                )
+
+            return last_event_id
+
+        await self._keep_reading(
+            "processing events",
+            lambda: OrderProcessingEventQueue().latest_event_id(),
+            read,
+        )
+
+
+order_event_hub = OrderEventHub()
+
+
+async def order_event_generator(
+    request: Request,
+    hub: OrderEventHub,
+) -> AsyncGenerator[str, None]:
+    subscription = hub.subscribe()
+    try:
+        while not subscription.dropped:
+            if await request.is_disconnected():
+                break
 
-            event = processing_order_data.pop("event", "")
-            yield f"event: {event}\ndata: {json.dumps(processing_order_data)}\n\n"
+            try:
+                message = await asyncio.wait_for(
+                    subscription.messages.get(), timeout=EVENTS_READ_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                continue
 
-        await asyncio.sleep(0.5)
+            yield message
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,71 @@
+import datetime
+from typing import Annotated, List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from django.utils.timezone import now, make_aware, is_naive
+
+from core.models import OrderHandlingProcess, StageDurationRollup
+from core.buffers import StageDurationRollupBuffer
+
+from api.v1.schemas import analytics as analytics_schema
+
+
+router = APIRouter()
+
+
+# Read from the stage duration rollups, so the cost depends on the length of the
+# window and not on how many orders were handled. Percentiles are accurate to
+# about 1% of their value. Defaults to the last hour.
+@router.get(
+    "/analytics/stage-durations",
+    response_model=analytics_schema.StageDurations,
+)
+def get_stage_durations(
+    state: OrderHandlingProcess.State,
+    status: Optional[OrderHandlingProcess.Status] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    percentiles: Annotated[
+        str, Query(description="Comma separated list of percentiles")
+    ] = "50,95,99",
+):
+    end = end or now()
+    start = start or end - datetime.timedelta(hours=1)
+    if is_naive(start):
+        start = make_aware(start)
+    if is_naive(end):
+        end = make_aware(end)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="`start` must be before `end`")
+
+    try:
+        requested: List[float] = [
+            float(percentile) for percentile in percentiles.split(",") if percentile
+        ]
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Percentiles must be numbers")
+    if any(percentile < 0 or percentile > 100 for percentile in requested):
+        raise HTTPException(
+            status_code=422, detail="Percentiles must be between 0 and 100"
+        )
+
+    # Durations collected by this process are included right away
+    StageDurationRollupBuffer().flush()
+    duration_sum, sketch = StageDurationRollup.summarize(
+        state=state, start=start, end=end, status=status
+    )
+
+    return analytics_schema.StageDurations(
+        state=state.value,
+        status=status.value if status is not None else None,
+        start=start,
+        end=end,
+        count=sketch.count,
+        mean_seconds=duration_sum / sketch.count if sketch.count > 0 else None,
+        percentiles=[
+            analytics_schema.Percentile(
+                percentile=percentile, seconds=sketch.quantile(percentile / 100)
+            )
+            for percentile in requested
+        ],
+    )
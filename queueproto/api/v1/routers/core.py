@@ -1,17 +1,36 @@
-from typing import List, Annotated, Set
-
-from fastapi import APIRouter, HTTPException, Path, Body, Request, Query
-from fastapi.responses import StreamingResponse
+import datetime
+import math
+from typing import List, Annotated, Set, Optional, Dict, Any, Union
+
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    Path,
+    Body,
+    Request,
+    Query,
+    Response,
+    Header,
+)
+from fastapi.responses import StreamingResponse, JSONResponse
 from django.db.models import QuerySet
+from django.utils.timezone import make_aware, is_naive
 
 from core.models import Order, OrderHandlingProcess
-from core.events import OrderEventsQueue, OrderProcessingEventQueue
-from core.tasks import handle_orders
+from core.events import OrderEventsQueue
+from core.tasks import handle_orders, retry_failed_orders
 from core.definitions import Result
+from core.pagination import KeysetPaginator, KeysetPage, InvalidCursor
+from core.dedupe import IdempotencyKeys, IdempotencyKeyReused
 
 from api.v1.schemas import order as order_schema, core as core_schema
-from api.v1.generators.order import order_event_generator
-
+from api.v1.generators.order import order_event_generator, order_event_hub
+from api.v1.utils.order import (
+    convert_db_orders_to_dicts,
+    convert_db_orders_to_schemas,
+    etag_matches,
+    get_orders_page_etag,
+)
 
 router = APIRouter()
 
@@ -24,13 +43,115 @@ async def stream_orders(request: Request):
     return StreamingResponse(
         order_event_generator(
             request=request,
-            order_event_queue=OrderEventsQueue(),
-            process_event_queue=OrderProcessingEventQueue(),
+            hub=order_event_hub,
         ),
         media_type="text/event-stream",
     )
 
 
+# Without `fields` the items are whole orders, with it they only have the
+# requested fields
+@router.get(
+    "/orders",
+    response_model=core_schema.ResponseWithPagination[
+        Union[order_schema.Order, order_schema.PartialOrder]
+    ],
+)
+def list_orders(
+    request: Request,
+    cursor: Optional[str] = None,
+    per_page: Annotated[int, Query(ge=1, le=100)] = 15,
+    state: Optional[Order.State] = None,
+    currency: Annotated[Optional[str], Query(max_length=3)] = None,
+    placed_after: Optional[datetime.datetime] = None,
+    placed_before: Optional[datetime.datetime] = None,
+    fields: Annotated[
+        Optional[str], Query(description="Comma separated list of order fields")
+    ] = None,
+):
+    projection: Optional[Set[str]] = None
+    if fields:
+        projection = {field.strip() for field in fields.split(",") if field.strip()}
+        unknown_fields = projection - set(order_schema.Order.model_fields)
+        if unknown_fields:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}",
+            )
+
+    filters = dict()
+    if state is not None:
+        filters["state"] = state.value
+    if currency is not None:
+        filters["currency_iso_code"] = currency.upper()
+    if placed_after is not None:
+        if is_naive(placed_after):
+            placed_after = make_aware(placed_after)
+        filters["placed_at__gte"] = placed_after
+    if placed_before is not None:
+        if is_naive(placed_before):
+            placed_before = make_aware(placed_before)
+        filters["placed_at__lt"] = placed_before
+
+    paginator = KeysetPaginator(
+        Order.objects.filter(**filters), per_page=per_page, key_field="placed_at"
+    )
+    try:
+        page_orders: KeysetPage = paginator.get_page(cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    latest_handling_processes = Order.get_latest_handling_process_for_each_order(
+        orders=page_orders.object_list
+    )
+
+    # Part of the ETag, so orders added or purged outside of the page are
+    # noticed too
+    items_count = Order.get_cached_count(**filters)
+
+    etag = get_orders_page_etag(
+        orders=page_orders.object_list,
+        latest_handling_processes=latest_handling_processes,
+        params={
+            "filters": filters,
+            "cursor": cursor,
+            "items_count": items_count,
+            "fields": sorted(projection) if projection else None,
+        },
+    )
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    if projection is None:
+        items = [
+            schemas_order.model_dump()
+            for schemas_order in convert_db_orders_to_schemas(
+                page_orders.object_list,
+                latest_handling_processes=latest_handling_processes,
+            )
+        ]
+    else:
+        # Only the requested fields are converted
+        items = convert_db_orders_to_dicts(
+            page_orders.object_list,
+            latest_handling_processes=latest_handling_processes,
+            fields=projection,
+        )
+
+    response = core_schema.ResponseWithPagination[Dict[str, Any]](
+        current_page=page_orders.number,
+        items_count=items_count,
+        pages_count=max(1, math.ceil(items_count / per_page)),
+        items=items,
+        next_cursor=page_orders.next_cursor,
+        previous_cursor=page_orders.previous_cursor,
+    )
+
+    return JSONResponse(
+        content=response.model_dump(mode="json"), headers={"ETag": etag}
+    )
+
+
 @router.post("/orders", response_model=core_schema.ErrorResponse)
 def generate_orders(generate: Annotated[int, Query(ge=1)] = 5):
     result: Result[List[Order]] = Order.generate_and_add_fake_orders(
@@ -39,7 +160,10 @@ def generate_orders(generate: Annotated[int, Query(ge=1)] = 5):
 
     if result.result and len(result.result) > 0:
         event_controller = OrderEventsQueue()
-        event_controller.enque_orders(result.result)
+        event_controller.enque_orders(
+            schemas_order.model_dump_json()
+            for schemas_order in convert_db_orders_to_schemas(result.result)
+        )
 
     return core_schema.ErrorResponse(
         errors=[
@@ -51,11 +175,41 @@ def generate_orders(generate: Annotated[int, Query(ge=1)] = 5):
     )
 
 
+# Orders that are already queued or being handled are skipped by the task. A
+# request repeated with the same Idempotency-Key is not queued at all.
 @router.post("/orders/handle")
-def add_orders_to_handling_queue(ids: Annotated[order_schema.OrderIds, Body]):
-    handle_orders.delay(
-        order_ids=ids.order_ids,
-    )
+def add_orders_to_handling_queue(
+    ids: Annotated[order_schema.OrderIds, Body],
+    idempotency_key: Annotated[Optional[str], Header(max_length=255)] = None,
+):
+    if idempotency_key is not None:
+        try:
+            is_new = IdempotencyKeys().register(
+                scope="orders_handle",
+                key=idempotency_key,
+                request=",".join(sorted(ids.order_ids)),
+            )
+        except IdempotencyKeyReused as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+        if not is_new:
+            return
+
+    try:
+        handle_orders.delay(
+            order_ids=ids.order_ids,
+        )
+    except Exception:
+        # Nothing was queued, so a retry with the same key has to queue it
+        if idempotency_key is not None:
+            IdempotencyKeys().forget(scope="orders_handle", key=idempotency_key)
+        raise
+
+
+# Resumes every order that failed in one of the stages at the stage it failed in
+@router.post("/orders/handle/retry-failed")
+def retry_failed_orders_handling():
+    retry_failed_orders.delay()
 
 
 @router.get(
@@ -0,0 +1,75 @@
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from celery.utils.log import get_task_logger
+
+from core.events import OrderProcessingEventQueue
+from core.metrics import METRICS, MetricsRegistry, render_gauge
+from core.partitions import get_partition_queues
+from core.stages import get_stage_queues
+from queueproto.celery import app as celery_app
+
+logger = get_task_logger(__name__)
+
+router = APIRouter()
+
+
+# Prometheus text exposition format
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    # Updates recorded by this process are included right away
+    MetricsRegistry().flush()
+
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    lines.extend(
+        render_gauge(
+            "celery_queue_length",
+            "Tasks waiting in the celery queues",
+            get_queue_lengths(
+                [
+                    "single_worker_queue",
+                    *get_partition_queues(),
+                    *get_stage_queues(),
+                ]
+            ),
+        )
+    )
+    # Readers of the stream keep their own positions, so the stream only tells
+    # how many events it retains - not how far behind its readers are
+    events_backend = settings.ORDER_EVENTS_BACKEND
+    lines.extend(
+        render_gauge(
+            "order_events_stored",
+            "Order processing events held in redis - retained history with the "
+            "stream backend, events not read yet with the list backend",
+            {(("backend", events_backend),): OrderProcessingEventQueue().length()},
+        )
+    )
+
+    return PlainTextResponse(
+        "\n".join(lines) + "\n", media_type="text/plain; version=0.0.4"
+    )
+
+
+def get_queue_lengths(queues: List[str]) -> Dict[Tuple[Tuple[str, str], ...], float]:
+    lengths: Dict[Tuple[Tuple[str, str], ...], float] = dict()
+    try:
+        with celery_app.connection_for_read() as connection:
+            channel = connection.default_channel
+            for queue in queues:
+                try:
+                    lengths[(("queue", queue),)] = channel.queue_declare(
+                        queue=queue, passive=True
+                    ).message_count
+                except Exception:
+                    # Queues only exist once something was sent to them
+                    lengths[(("queue", queue),)] = 0
+    except Exception as e:
+        logger.error(msg=f"Error while reading celery queue lengths: {e}")
+
+    return lengths
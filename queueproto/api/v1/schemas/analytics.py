@@ -0,0 +1,18 @@
+import datetime
+from typing import Optional, List
+from pydantic import BaseModel
+
+
+class Percentile(BaseModel):
+    percentile: float
+    seconds: Optional[float]
+
+
+class StageDurations(BaseModel):
+    state: str
+    status: Optional[str]
+    start: datetime.datetime
+    end: datetime.datetime
+    count: int
+    mean_seconds: Optional[float]
+    percentiles: List[Percentile]
@@ -1,4 +1,4 @@
-from typing import Iterable, Generic, TypeVar, List
+from typing import Iterable, Generic, TypeVar, List, Optional
 from pydantic import BaseModel
 
 T = TypeVar("T")
@@ -9,6 +9,8 @@ class ResponseWithPagination(BaseModel, Generic[T]):
     items_count: int
     pages_count: int
     items: Iterable[T]
+    next_cursor: Optional[str] = None
+    previous_cursor: Optional[str] = None
 
 
 class Error(BaseModel):
@@ -44,5 +44,21 @@ class Order(BaseSchema):
     latest_handling_process: Optional[OrderHandlingProcess]
 
 
+# An order projected to the fields asked for with `fields` - only those are
+# present, every other one is left out
+class PartialOrder(BaseModel):
+    id: Optional[str] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+    total_price: Optional[float] = None
+    total_quantity: Optional[int] = None
+    state: Optional[str] = None
+    currency_iso_code: Optional[str] = None
+    placed_at: Optional[str] = None
+    order_items: Optional[List[OrderItem]] = None
+    customer: Optional[Customer] = None
+    latest_handling_process: Optional[OrderHandlingProcess] = None
+
+
 class OrderIds(BaseModel):
     order_ids: List[str]
@@ -0,0 +1,50 @@
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.metrics import HTTP_REQUEST_DURATION
+
+
+# Times every HTTP request. Requests are labelled by the name of their route
+# instead of the path, to keep the number of series bounded. Plain ASGI
+# middleware, so streaming responses (SSE) are passed through untouched.
+class RequestMetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - started_at,
+                method=scope["method"],
+                route=get_route_name(scope),
+                status_code=str(status_code),
+            )
+
+
+# Name of the route that handled the request, e.g. `list_orders`
+def get_route_name(scope: Scope) -> str:
+    route = scope.get("route")
+    if route is None:
+        # Served by one of the mounted applications (django, static files)
+        if "app_root_path" in scope:
+            return f"mount:{scope.get('root_path') or '/'}"
+
+        return "unmatched"
+
+    return getattr(route, "name", None) or "unnamed"
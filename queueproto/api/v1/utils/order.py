@@ -1,57 +1,184 @@
-from core.models import Order, OrderHandlingProcess
+import hashlib
+import json
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from django.db.models import prefetch_related_objects
+
+from core.models import Order, OrderHandlingProcess, OrderItem, Customer
 
 from api.v1.schemas import order as order_schema
 
 
-def convert_db_order_to_schema(order: Order) -> order_schema.Order:
-    latest_order_handling = (
-        OrderHandlingProcess.objects.filter(order=order).order_by("created_at").last()
-    )
-    latest_order_handling_schema = None
-    if latest_order_handling:
-        latest_order_handling_schema = order_schema.OrderHandlingProcess(
-            id=str(latest_order_handling.id),
-            created_at=str(latest_order_handling.created_at),
-            updated_at=str(latest_order_handling.updated_at),
-            status=str(latest_order_handling.status),
-            state=str(latest_order_handling.state),
-            message=latest_order_handling.message,
-            started_at=str(latest_order_handling.started_at),
-            finished_at=str(latest_order_handling.finished_at),
+# Converts many orders with a constant number of queries - one for the customers,
+# one for the order items (unless they are loaded already) and one for the
+# latest handling processes. The orders the caller loaded are used as they are,
+# and the schemas are returned in their order.
+def convert_db_orders_to_schemas(
+    orders: Iterable[Order],
+    latest_handling_processes: Optional[
+        Dict[Order, Optional[OrderHandlingProcess]]
+    ] = None,
+) -> List[order_schema.Order]:
+    orders = list(orders)
+    if len(orders) == 0:
+        return []
+
+    prefetch_related_objects(orders, "customer", "order_items")
+    # Callers that already resolved the latest processes can pass them in
+    if latest_handling_processes is None:
+        latest_handling_processes = Order.get_latest_handling_process_for_each_order(
+            orders=orders
         )
 
+    return [
+        _convert_order(
+            order=order,
+            latest_order_handling=latest_handling_processes.get(order),
+        )
+        for order in orders
+    ]
+
+
+# Converts only the `fields` of the orders, in the order of the schema. Only the
+# relations of the requested fields are loaded.
+def convert_db_orders_to_dicts(
+    orders: List[Order],
+    latest_handling_processes: Dict[Order, Optional[OrderHandlingProcess]],
+    fields: Set[str],
+) -> List[Dict[str, Any]]:
+    if "customer" in fields:
+        prefetch_related_objects(orders, "customer")
+    if "order_items" in fields:
+        prefetch_related_objects(orders, "order_items")
+
+    return [
+        {
+            field: convert(order, latest_handling_processes.get(order))
+            for field, convert in _ORDER_FIELDS.items()
+            if field in fields
+        }
+        for order in orders
+    ]
+
+
+def _convert_order(
+    order: Order, latest_order_handling: Optional[OrderHandlingProcess]
+) -> order_schema.Order:
     return order_schema.Order(
-        id=str(order.id),
-        created_at=str(order.created_at),
-        updated_at=str(order.updated_at),
-        total_price=float(order.total_price),
-        total_quantity=int(order.total_quantity),
-        state=str(order.state),
-        currency_iso_code=str(order.currency_iso_code),
-        placed_at=str(order.placed_at),
-        order_items=[
-            order_schema.OrderItem(
-                id=str(order_item.id),
-                created_at=str(order_item.created_at),
-                updated_at=str(order_item.updated_at),
-                product_sku=order_item.product_sku,
-                product_title=order_item.product_title,
-                product_media_url=order_item.product_media_url,
-                price=float(order_item.price),
-                quantity=int(order_item.quantity),
+        **{
+            field: convert(order, latest_order_handling)
+            for field, convert in _ORDER_FIELDS.items()
+        }
+    )
+
+
+def _convert_order_item(order_item: OrderItem) -> order_schema.OrderItem:
+    return order_schema.OrderItem(
+        id=str(order_item.id),
+        created_at=str(order_item.created_at),
+        updated_at=str(order_item.updated_at),
+        product_sku=order_item.product_sku,
+        product_title=order_item.product_title,
+        product_media_url=order_item.product_media_url,
+        price=float(order_item.price),
+        quantity=int(order_item.quantity),
+    )
+
+
+def _convert_customer(customer: Customer) -> order_schema.Customer:
+    return order_schema.Customer(
+        id=str(customer.id),
+        created_at=str(customer.created_at),
+        updated_at=str(customer.updated_at),
+        first_name=customer.first_name,
+        last_name=customer.last_name,
+        address1=customer.address1,
+        address2=customer.address2,
+        zip_code=customer.zip_code,
+        country=customer.country,
+    )
+
+
+def _convert_handling_process(
+    handling_process: OrderHandlingProcess,
+) -> order_schema.OrderHandlingProcess:
+    return order_schema.OrderHandlingProcess(
+        id=str(handling_process.id),
+        created_at=str(handling_process.created_at),
+        updated_at=str(handling_process.updated_at),
+        status=str(handling_process.status),
+        state=str(handling_process.state),
+        message=handling_process.message,
+        started_at=str(handling_process.started_at),
+        finished_at=str(handling_process.finished_at),
+    )
+
+
+# Converters of the fields of the order schema, given the order and its latest
+# handling process
+_ORDER_FIELDS: Dict[str, Callable[[Order, Optional[OrderHandlingProcess]], Any]] = {
+    "id": lambda order, _: str(order.id),
+    "created_at": lambda order, _: str(order.created_at),
+    "updated_at": lambda order, _: str(order.updated_at),
+    "total_price": lambda order, _: float(order.total_price),
+    "total_quantity": lambda order, _: int(order.total_quantity),
+    "state": lambda order, _: str(order.state),
+    "currency_iso_code": lambda order, _: str(order.currency_iso_code),
+    "placed_at": lambda order, _: str(order.placed_at),
+    "order_items": lambda order, _: [
+        _convert_order_item(order_item) for order_item in order.order_items.all()
+    ],
+    "customer": lambda order, _: _convert_customer(order.customer),
+    "latest_handling_process": lambda _, latest_order_handling: (
+        _convert_handling_process(latest_order_handling)
+        if latest_order_handling
+        else None
+    ),
+}
+
+
+# Weak ETag of a page of orders. It only depends on the rows that make up the
+# page (and on the parameters of the request), so it can be checked before the
+# page gets serialized.
+def get_orders_page_etag(
+    orders: Iterable[Order],
+    latest_handling_processes: Dict[Order, Optional[OrderHandlingProcess]],
+    params: Dict[str, Any],
+) -> str:
+    fingerprint = [
+        params,
+        [
+            (
+                str(order.id),
+                order.updated_at.isoformat(),
+                (
+                    str(latest_handling_processes[order].id)
+                    if latest_handling_processes.get(order)
+                    else None
+                ),
             )
-            for order_item in order.order_items.all()
+            for order in orders
         ],
-        customer=order_schema.Customer(
-            id=str(order.customer.id),
-            created_at=str(order.customer.created_at),
-            updated_at=str(order.customer.updated_at),
-            first_name=order.customer.first_name,
-            last_name=order.customer.last_name,
-            address1=order.customer.address1,
-            address2=order.customer.address2,
-            zip_code=order.customer.zip_code,
-            country=order.customer.country,
-        ),
-        latest_handling_process=latest_order_handling_schema,
-    )
+    ]
+    digest = hashlib.sha1(
+        json.dumps(fingerprint, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+    return f'W/"{digest}"'
+
+
+# Whether the If-None-Match header matches `etag`. The header is a comma
+# separated list of ETags (or `*`), compared weakly - a W/ prefix is ignored on
+# both sides.
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    def opaque_tag(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return any(opaque_tag(tag) == opaque_tag(etag) for tag in if_none_match.split(","))
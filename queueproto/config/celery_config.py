@@ -2,6 +2,7 @@ from django.conf import settings
 
 broker_url = settings.CELERY_BROKER_URL
 result_backend = settings.CELERY_BROKER_URL
+result_expires = settings.CELERY_RESULT_EXPIRES
 
 task_serializer = "json"
 result_serializer = "json"
@@ -1,32 +1,67 @@
-from random import random
 import time
-from typing import Callable, Optional
+import asyncio
+from typing import Callable, Optional, Tuple
 
 from core.definitions import ApiResponse, Error
+from core.latency import DEFAULT_ENDPOINT, get_endpoint_profile
 
 
-# Simulate work of sending an API request and waiting for response
+# Simulate work of sending an API request and waiting for response. The latency
+# and failures follow the profile of `endpoint`, unless `to_wait` is given.
 def simulate_request(
     data_callback: Optional[Callable],
-    to_wait: float = 0.5,
+    to_wait: Optional[float] = None,
     allow_failure: bool = False,
     failure_percentage: int = 5,
+    endpoint: str = DEFAULT_ENDPOINT,
 ) -> ApiResponse:
+    to_wait, failed = _sample_request(
+        endpoint, to_wait, allow_failure, failure_percentage
+    )
     time.sleep(to_wait)
 
-    success_response = ApiResponse(
-        status_code=200,
-        response=data_callback() if data_callback is not None else None,
+    return _build_response(data_callback, failed)
+
+
+# Same as `simulate_request`, but waits without blocking the thread
+async def simulate_request_async(
+    data_callback: Optional[Callable],
+    to_wait: Optional[float] = None,
+    allow_failure: bool = False,
+    failure_percentage: int = 5,
+    endpoint: str = DEFAULT_ENDPOINT,
+) -> ApiResponse:
+    to_wait, failed = _sample_request(
+        endpoint, to_wait, allow_failure, failure_percentage
     )
+    await asyncio.sleep(to_wait)
 
-    if not allow_failure:
-        return success_response
+    return _build_response(data_callback, failed)
 
-    if random() < failure_percentage / 100:
+
+def _sample_request(
+    endpoint: str,
+    to_wait: Optional[float],
+    allow_failure: bool,
+    failure_percentage: int,
+) -> Tuple[float, bool]:
+    profile = get_endpoint_profile(endpoint)
+
+    if to_wait is None:
+        to_wait = profile.latency.sample()
+
+    return to_wait, allow_failure and profile.failures.should_fail(failure_percentage)
+
+
+def _build_response(data_callback: Optional[Callable], failed: bool) -> ApiResponse:
+    if failed:
         # failure response
         return ApiResponse(
             status_code=400,
             response=Error(message="Invalid data provided"),
         )
 
-    return success_response
+    return ApiResponse(
+        status_code=200,
+        response=data_callback() if data_callback is not None else None,
+    )
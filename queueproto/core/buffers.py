@@ -0,0 +1,230 @@
+import atexit
+import datetime
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from django.apps import apps
+from django.conf import settings
+from django.db import models, transaction
+from django.utils.timezone import now
+from celery.utils.log import get_task_logger
+
+from core.events import Singleton, OrderProcessingEventQueue
+from core.sketch import QuantileSketch
+
+logger = get_task_logger(__name__)
+
+# (resolution, state, status, bucket start) of a stage duration rollup
+RollupKey = Tuple[str, str, str, datetime.datetime]
+
+
+# Write-behind buffer for the rows written while handling orders. Handling
+# process rows and order state changes are collected and written in a single
+# transaction once ORDER_HANDLING_WRITE_BEHIND_ROWS rows are pending, or
+# ORDER_HANDLING_WRITE_BEHIND_INTERVAL_MS after the first pending row. Events go
+# through the buffer too, so they keep their order and are only emitted once
+# the rows they describe are written.
+class OrderHandlingWriteBuffer(metaclass=Singleton):
+    def __init__(self):
+        self._flush_rows = settings.ORDER_HANDLING_WRITE_BEHIND_ROWS
+        self._flush_interval = settings.ORDER_HANDLING_WRITE_BEHIND_INTERVAL_MS / 1000
+        self._event_queue = OrderProcessingEventQueue()
+
+        self._lock = threading.RLock()
+        self._handling_processes: List[models.Model] = []
+        self._orders: Dict[Any, models.Model] = dict()
+        self._events: List[Dict[str, Any]] = []
+        self._released_claims: List[str] = []
+        self._first_pending_at: Optional[float] = None
+
+        self._flusher = threading.Thread(
+            target=self._flush_periodically,
+            name="order-handling-write-buffer",
+            daemon=True,
+        )
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def enque_processing_status_event(self, data: Dict[str, Any]) -> None:
+        self.add(events=[data])
+
+    def add(
+        self,
+        handling_processes: Iterable[models.Model] = (),
+        orders: Iterable[models.Model] = (),
+        events: Iterable[Dict[str, Any]] = (),
+        released_claims: Iterable[str] = (),
+    ) -> None:
+        with self._lock:
+            self._handling_processes.extend(handling_processes)
+            for order in orders:
+                self._orders[order.pk] = order
+            self._events.extend(events)
+            self._released_claims.extend(released_claims)
+
+            if self._first_pending_at is None:
+                self._first_pending_at = time.monotonic()
+
+            if self._pending_rows() >= self._flush_rows or self._is_overdue():
+                try:
+                    self.flush()
+                except Exception as e:
+                    # Everything is still pending, and written by the next flush
+                    logger.error(msg=f"Error while flushing order handling rows: {e}")
+
+    # Pending rows are only dropped from the buffer once their transaction
+    # committed, and events once they were sent. When either fails, everything
+    # not written yet stays in the buffer for the next flush.
+    def flush(self) -> None:
+        with self._lock:
+            handling_processes = list(self._handling_processes)
+            orders = list(self._orders.values())
+            released_claims = list(self._released_claims)
+
+            if handling_processes or orders or released_claims:
+                with transaction.atomic():
+                    apps.get_model("core", "OrderHandlingProcess").bulk_save(
+                        handling_processes
+                    )
+                    self._update_order_states(orders)
+                    # Claims are released only together with the rows written
+                    # while they were held
+                    for token in released_claims:
+                        apps.get_model("core", "Order").release_claim(token)
+
+            self._handling_processes = []
+            self._orders = dict()
+            self._released_claims = []
+
+            # Only emitted once the rows are durable. The lock is still held,
+            # so the events of a later flush can not overtake these.
+            self._event_queue.enque_processing_status_events(self._events)
+            self._events = []
+            self._first_pending_at = None
+
+    def _update_order_states(self, orders: List[models.Model]) -> None:
+        orders_by_state: Dict[str, List[models.Model]] = dict()
+        for order in orders:
+            orders_by_state.setdefault(order.state, []).append(order)
+
+        updated_at = now()
+        for state, state_orders in orders_by_state.items():
+            type(state_orders[0]).objects.filter(
+                pk__in=[order.pk for order in state_orders]
+            ).update(state=state, updated_at=updated_at)
+
+    def _pending_rows(self) -> int:
+        return (
+            len(self._handling_processes)
+            + len(self._orders)
+            + len(self._released_claims)
+        )
+
+    def _is_overdue(self) -> bool:
+        return (
+            self._first_pending_at is not None
+            and time.monotonic() - self._first_pending_at >= self._flush_interval
+        )
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                with self._lock:
+                    if self._is_overdue():
+                        self.flush()
+            except Exception as e:
+                logger.error(msg=f"Error while flushing order handling rows: {e}")
+
+
+def get_handling_event_queue() -> Union[
+    OrderHandlingWriteBuffer, OrderProcessingEventQueue
+]:
+    if settings.ORDER_HANDLING_WRITE_BEHIND:
+        return OrderHandlingWriteBuffer()
+
+    return OrderProcessingEventQueue()
+
+
+# Writes the rows produced while handling orders and emits the events
+# describing them - either right away, or through the write-behind buffer
+def write_handling_results(
+    event_queue: Union[OrderHandlingWriteBuffer, OrderProcessingEventQueue],
+    handling_processes: Iterable[models.Model] = (),
+    orders: Iterable[models.Model] = (),
+    events: Iterable[Dict[str, Any]] = (),
+    released_claims: Iterable[str] = (),
+) -> None:
+    if isinstance(event_queue, OrderHandlingWriteBuffer):
+        event_queue.add(
+            handling_processes=handling_processes,
+            orders=orders,
+            events=events,
+            released_claims=released_claims,
+        )
+        return
+
+    with transaction.atomic():
+        apps.get_model("core", "OrderHandlingProcess").bulk_save(
+            list(handling_processes)
+        )
+        for order in orders:
+            # Only the state is written, so a lease renewed in the meantime is
+            # not overwritten
+            order.save(update_fields=["state", "updated_at"])
+        for token in released_claims:
+            apps.get_model("core", "Order").release_claim(token)
+
+    event_queue.enque_processing_status_events(events)
+
+
+# Process-wide buffer of stage durations. Durations of the same bucket are
+# merged in memory, and added to the stage duration rollups by a background
+# thread every STAGE_DURATION_ROLLUP_FLUSH_INTERVAL seconds - one write per
+# bucket and interval, instead of one per written stage.
+class StageDurationRollupBuffer(metaclass=Singleton):
+    def __init__(self):
+        self._flush_interval = settings.STAGE_DURATION_ROLLUP_FLUSH_INTERVAL
+
+        self._lock = threading.Lock()
+        self._pending: Dict[RollupKey, Tuple[float, QuantileSketch]] = dict()
+
+        self._flusher = threading.Thread(
+            target=self._flush_periodically,
+            name="stage-duration-rollup-buffer",
+            daemon=True,
+        )
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def add(self, durations: Dict[RollupKey, Tuple[float, QuantileSketch]]) -> None:
+        with self._lock:
+            for key, (duration_sum, sketch) in durations.items():
+                if key not in self._pending:
+                    self._pending[key] = (duration_sum, sketch)
+                    continue
+
+                pending_sum, pending_sketch = self._pending[key]
+                pending_sketch.merge(sketch)
+                self._pending[key] = (pending_sum + duration_sum, pending_sketch)
+
+    def flush(self) -> None:
+        with self._lock:
+            pending = self._pending
+            self._pending = dict()
+
+        if len(pending) == 0:
+            return
+
+        try:
+            apps.get_model("core", "StageDurationRollup").merge(pending)
+        except Exception as e:
+            logger.error(msg=f"Error while flushing stage duration rollups: {e}")
+            # Kept for the next flush instead of being lost
+            self.add(pending)
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
@@ -0,0 +1,98 @@
+import hashlib
+from typing import Iterable, List, Optional, Set
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from core.events import Singleton
+
+
+# Keeps an order from being queued for handling again while it is queued or
+# being handled. A lock is taken per order when it is queued, and released once
+# its handling is finished (or out of retries). The locks expire after
+# ORDER_HANDLING_DEDUPE_TTL seconds, so orders of crashed workers can be queued
+# again.
+class OrderHandlingLocks(metaclass=Singleton):
+    def __init__(self):
+        self._key_prefix = "order_handling_lock"
+        self._ttl = settings.ORDER_HANDLING_DEDUPE_TTL
+        self._connection = get_redis_connection("default")
+
+    # Returns the IDs whose locks were taken, in the input order. The others are
+    # already queued or being handled.
+    def acquire(self, order_ids: Iterable[str]) -> List[str]:
+        order_ids = list(dict.fromkeys(str(order_id) for order_id in order_ids))
+        if len(order_ids) == 0:
+            return []
+
+        pipeline = self._connection.pipeline(transaction=False)
+        for order_id in order_ids:
+            pipeline.set(self.key(order_id), 1, nx=True, ex=self._ttl)
+
+        return [
+            order_id
+            for order_id, acquired in zip(order_ids, pipeline.execute())
+            if acquired
+        ]
+
+    def release(self, order_ids: Iterable[str]) -> None:
+        keys = [self.key(order_id) for order_id in order_ids]
+        if len(keys) > 0:
+            self._connection.delete(*keys)
+
+    # The IDs of `order_ids` that are still queued or being handled
+    def held(self, order_ids: Iterable[str]) -> Set[str]:
+        order_ids = [str(order_id) for order_id in order_ids]
+        if len(order_ids) == 0:
+            return set()
+
+        pipeline = self._connection.pipeline(transaction=False)
+        for order_id in order_ids:
+            pipeline.exists(self.key(order_id))
+
+        return {
+            order_id
+            for order_id, exists in zip(order_ids, pipeline.execute())
+            if exists
+        }
+
+    def key(self, order_id: str) -> str:
+        return f"{self._key_prefix}:{order_id}"
+
+
+# Raised when an idempotency key is sent again with a different request
+class IdempotencyKeyReused(Exception):
+    pass
+
+
+# Remembers the idempotency keys sent by the clients for IDEMPOTENCY_KEY_TTL
+# seconds, together with a fingerprint of the request they were sent with
+class IdempotencyKeys(metaclass=Singleton):
+    def __init__(self):
+        self._key_prefix = "idempotency_key"
+        self._ttl = settings.IDEMPOTENCY_KEY_TTL
+        self._connection = get_redis_connection("default")
+
+    # Returns True the first time `key` is seen, False when the same request was
+    # already sent with it
+    def register(self, scope: str, key: str, request: str) -> bool:
+        fingerprint = hashlib.sha256(request.encode()).hexdigest()
+        redis_key = self.key(scope, key)
+        if self._connection.set(redis_key, fingerprint, nx=True, ex=self._ttl):
+            return True
+
+        stored: Optional[bytes] = self._connection.get(redis_key)
+        if stored is not None and stored.decode() != fingerprint:
+            raise IdempotencyKeyReused(
+                f"Idempotency key `{key}` was already used for a different request."
+            )
+
+        return False
+
+    # Forgets `key`, so the request can be sent with it again. Used when the
+    # request it was registered for failed.
+    def forget(self, scope: str, key: str) -> None:
+        self._connection.delete(self.key(scope, key))
+
+    def key(self, scope: str, key: str) -> str:
+        return f"{self._key_prefix}:{scope}:{key}"
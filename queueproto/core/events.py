@@ -1,11 +1,10 @@
 import json
-from typing import Deque, Optional, Iterable, Dict, Any
-from collections import deque
+import uuid
+from typing import Optional, Iterable, Dict, Any, List, Tuple, Union
 
+from django.conf import settings
 from django_redis import get_redis_connection
 
-from core.models import Order
-
 
 class Singleton(type):
     _instances = {}
@@ -16,30 +15,174 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+# Processing events are encoded into 20 bytes instead of ~150 bytes of JSON:
+# a version byte, the 16 bytes of the order ID, and the codes of the event name,
+# the status and the state (0 when there is no state). Codes are indexes into
+# the tables below + 1 - new values may only be appended, anything else needs a
+# new version. Events that can not be encoded fall back to JSON, which is always
+# accepted by the decoder as well.
+EVENT_ENCODING_VERSION = 1
+
+EVENT_NAMES = (
+    "updatedOrderHandlingStatus",
+    "updatedOrderProcessingStatus",
+    "updatedOrderFulfillmentStatus",
+)
+EVENT_STATUSES = ("QUEUED", "PROCESSING", "PROCESSED", "SUCCESS", "FAILED", "SHIPPED")
+EVENT_STATES = (
+    "WAITING",
+    "GENERATING SHIPMENT",
+    "SENDING TRACKING",
+    "MARKING AS SHIPPED",
+    "HANDLED",
+)
+
+
+def encode_processing_event(data: Dict[str, Any]) -> Union[bytes, str]:
+    try:
+        if not set(data) <= {"order_id", "event", "status", "state"}:
+            raise ValueError("Unknown event fields.")
+
+        state = data.get("state")
+        return (
+            bytes([EVENT_ENCODING_VERSION])
+            + uuid.UUID(str(data["order_id"])).bytes
+            + bytes(
+                [
+                    EVENT_NAMES.index(data["event"]) + 1,
+                    EVENT_STATUSES.index(data["status"]) + 1,
+                    EVENT_STATES.index(state) + 1 if state is not None else 0,
+                ]
+            )
+        )
+    except (KeyError, ValueError):
+        return json.dumps(data)
+
+
+def decode_processing_event(encoded: Union[bytes, str]) -> Dict[str, str]:
+    if isinstance(encoded, str):
+        encoded = encoded.encode()
+
+    # JSON events always start with "{"
+    if encoded[0] != EVENT_ENCODING_VERSION:
+        return json.loads(encoded)
+
+    event_code, status_code, state_code = encoded[17:20]
+    data = {
+        "order_id": str(uuid.UUID(bytes=encoded[1:17])),
+        "event": EVENT_NAMES[event_code - 1],
+        "status": EVENT_STATUSES[status_code - 1],
+    }
+    if state_code > 0:
+        data["state"] = EVENT_STATES[state_code - 1]
+
+    return data
+
+
+def _latest_stream_entry_id(connection, key: str) -> str:
+    entries = connection.xrevrange(key, count=1)
+    if not entries:
+        return "0-0"
+
+    return entries[0][0].decode()
+
+
+def _read_stream(
+    connection, key: str, last_id: str, timeout: float, count: int
+) -> Tuple[str, List[bytes]]:
+    response = connection.xread(
+        {key: last_id},
+        count=count,
+        block=max(1, int(timeout * 1000)),
+    )
+
+    items: List[bytes] = []
+    for _, entries in response or []:
+        for entry_id, fields in entries:
+            last_id = entry_id.decode()
+            items.append(fields[b"data"])
+
+    return last_id, items
+
+
+# Broadcasts newly added orders to every API process through a redis stream.
+# The stream carries already serialized orders and is capped at roughly
+# NEW_ORDER_EVENTS_MAX_LENGTH entries - once the cap is reached the oldest
+# entries are dropped, no matter if anyone has read them.
 class OrderEventsQueue(metaclass=Singleton):
     def __init__(self):
-        self.recently_added_orders: Deque[Order] = deque()
-
-    def enque_orders(self, orders: Iterable[Order]) -> None:
-        for order in orders:
-            self.recently_added_orders.appendleft(order)
-
-    def pop_order(self) -> Optional[Order]:
-        return self.recently_added_orders.pop()
-
-    def has_orders(self) -> bool:
-        return len(self.recently_added_orders) > 0
-
+        self._event_stream_key = "new_order_event_stream"
+        self._stream_max_length = settings.NEW_ORDER_EVENTS_MAX_LENGTH
+        self._connection = get_redis_connection("default")
 
-# A wrapper class around a 'raw' redis connection that utlizes
-# redis list as a queue
+    def enque_orders(self, serialized_orders: Iterable[str]) -> None:
+        pipeline = self._connection.pipeline(transaction=False)
+        for serialized_order in serialized_orders:
+            pipeline.xadd(
+                self._event_stream_key,
+                {"data": serialized_order},
+                maxlen=self._stream_max_length,
+                approximate=True,
+            )
+        pipeline.execute()
+
+    def latest_event_id(self) -> str:
+        return _latest_stream_entry_id(self._connection, self._event_stream_key)
+
+    # Waits up to `timeout` seconds for orders newer than `last_id` and returns
+    # their serialized forms together with the ID to continue reading from
+    def read_orders(
+        self, last_id: str, timeout: float, count: int = 100
+    ) -> Tuple[str, List[str]]:
+        last_id, items = _read_stream(
+            self._connection, self._event_stream_key, last_id, timeout, count
+        )
+
+        return last_id, [item.decode() for item in items]
+
+
+# A wrapper class around a 'raw' redis connection that utlizes either a redis
+# list as a queue, or a capped redis stream that can be read with blocking reads
+# (ORDER_EVENTS_BACKEND = "list" | "stream"). Events popped from the list are
+# gone, so it only suits a single reading process. Both are bounded - the list keeps
+# the newest ORDER_EVENTS_LIST_MAX_LENGTH events, and both expire
+# ORDER_EVENTS_TTL seconds after the last event, so events nobody reads (e.g.
+# while no dashboard is open) do not pile up in redis.
 class OrderProcessingEventQueue(metaclass=Singleton):
     def __init__(self):
         self._event_queue_key = "order_processing_status_event_queue"
+        self._event_stream_key = "order_processing_status_event_stream"
+        self._use_stream = settings.ORDER_EVENTS_BACKEND == "stream"
+        self._stream_max_length = settings.ORDER_EVENTS_STREAM_MAX_LENGTH
+        self._list_max_length = settings.ORDER_EVENTS_LIST_MAX_LENGTH
+        self._ttl = settings.ORDER_EVENTS_TTL
         self._connection = get_redis_connection("default")
 
     def enque_processing_status_event(self, data: Dict[str, Any]) -> None:
-        self._connection.lpush(self._event_queue_key, json.dumps(data))
+        self.enque_processing_status_events([data])
+
+    # All the events are sent in a single round trip
+    def enque_processing_status_events(self, events: Iterable[Dict[str, Any]]) -> None:
+        encoded_events = [encode_processing_event(data) for data in events]
+        if len(encoded_events) == 0:
+            return
+
+        pipeline = self._connection.pipeline(transaction=False)
+        if self._use_stream:
+            for encoded_event in encoded_events:
+                pipeline.xadd(
+                    self._event_stream_key,
+                    {"data": encoded_event},
+                    maxlen=self._stream_max_length,
+                    approximate=True,
+                )
+            pipeline.expire(self._event_stream_key, self._ttl)
+        else:
+            pipeline.lpush(self._event_queue_key, *encoded_events)
+            # Events are popped from the tail, so the oldest ones are dropped
+            pipeline.ltrim(self._event_queue_key, 0, self._list_max_length - 1)
+            pipeline.expire(self._event_queue_key, self._ttl)
+        pipeline.execute()
 
     def pop_processing_status(self) -> Optional[Dict[str, str]]:
         event = self._connection.rpop(self._event_queue_key)
@@ -47,7 +190,47 @@ class OrderProcessingEventQueue(metaclass=Singleton):
         if not event:
             return None
 
-        return json.loads(event)
+        return decode_processing_event(event)
 
     def has_items(self) -> bool:
-        return len(self._connection.lrange(self._event_queue_key, 0, -1)) > 0
+        return self.length() > 0
+
+    def length(self) -> int:
+        if self._use_stream:
+            return self._connection.xlen(self._event_stream_key)
+
+        return self._connection.llen(self._event_queue_key)
+
+    # ID to start reading new events from. Streams are not consumed by reading,
+    # so every reader keeps its own position. Lists do not have positions.
+    def latest_event_id(self) -> str:
+        if not self._use_stream:
+            return ""
+
+        return _latest_stream_entry_id(self._connection, self._event_stream_key)
+
+    # Waits up to `timeout` seconds for events newer than `last_id` and returns
+    # them together with the ID to continue reading from
+    def read_processing_statuses(
+        self, last_id: str, timeout: float, count: int = 100
+    ) -> Tuple[str, List[Dict[str, str]]]:
+        if self._use_stream:
+            last_id, items = _read_stream(
+                self._connection, self._event_stream_key, last_id, timeout, count
+            )
+
+            return last_id, [decode_processing_event(item) for item in items]
+
+        event = self._connection.brpop(self._event_queue_key, timeout=timeout)
+        if not event:
+            return last_id, []
+
+        events = [decode_processing_event(event[1])]
+        if count > 1:
+            events.extend(
+                decode_processing_event(item)
+                for item in self._connection.rpop(self._event_queue_key, count - 1)
+                or []
+            )
+
+        return last_id, events
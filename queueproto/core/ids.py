@@ -0,0 +1,64 @@
+import os
+import time
+import uuid
+import threading
+
+# Crockford's base32 alphabet, as used by ULIDs
+CROCKFORD_BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+_lock = threading.Lock()
+_last_timestamp_ms = 0
+_counter = 0
+
+
+# UUIDv7 (RFC 9562) - the first 48 bits are a millisecond unix timestamp, so new
+# rows are appended to the right edge of the primary key index instead of being
+# scattered across it. The 12 bits after the version are a counter, which keeps
+# the IDs generated within the same millisecond (in this process) ordered. The
+# remaining 62 bits are random.
+def uuid7() -> uuid.UUID:
+    global _last_timestamp_ms, _counter
+
+    with _lock:
+        timestamp_ms = time.time_ns() // 1_000_000
+        if timestamp_ms > _last_timestamp_ms:
+            # Start low, leaving room for the IDs generated in the same millisecond
+            _counter = int.from_bytes(os.urandom(2), "big") & 0x1FF
+            _last_timestamp_ms = timestamp_ms
+        else:
+            # Same millisecond, or the clock went backwards - never go back
+            _counter += 1
+            if _counter > 0xFFF:
+                _counter = 0
+                _last_timestamp_ms += 1
+            timestamp_ms = _last_timestamp_ms
+
+        counter = _counter
+
+    random_bits = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    value = (
+        (timestamp_ms & ((1 << 48) - 1)) << 80
+        | 0x7 << 76
+        | counter << 64
+        | 0b10 << 62
+        | random_bits
+    )
+
+    return uuid.UUID(int=value)
+
+
+# 26 character, lexicographically sortable encoding of a UUID (the ULID format)
+def encode_crockford_base32(value: uuid.UUID) -> str:
+    number = value.int
+    characters = []
+    for _ in range(26):
+        characters.append(CROCKFORD_BASE32[number & 0x1F])
+        number >>= 5
+
+    return "".join(reversed(characters))
+
+
+# Shipment IDs are derived from a UUIDv7, so they do not collide with each
+# other (unlike a handful of random characters) and sort by creation time
+def generate_shipment_id() -> str:
+    return f"SHIPMENT-{encode_crockford_base32(uuid7())}"
@@ -0,0 +1,212 @@
+import abc
+import math
+import time
+import random
+import datetime
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict
+
+from django.conf import settings
+
+SHIPMENT_ENDPOINT = "shipment"
+TRACKING_ENDPOINT = "tracking"
+MARK_SHIPPED_ENDPOINT = "mark_shipped"
+DEFAULT_ENDPOINT = "default"
+
+
+class LatencyModel(abc.ABC):
+    # Seconds the next request takes
+    @abc.abstractmethod
+    def sample(self) -> float:
+        pass
+
+
+class FixedLatency(LatencyModel):
+    def __init__(self, seconds: float):
+        self._seconds = seconds
+
+    def sample(self) -> float:
+        return self._seconds
+
+
+# Most requests take around `median` seconds, with a long right tail whose
+# weight is controlled by `sigma`
+class LognormalLatency(LatencyModel):
+    def __init__(self, median: float, sigma: float):
+        self._median = median
+        self._sigma = sigma
+
+    def sample(self) -> float:
+        if self._median <= 0:
+            return 0.0
+
+        return random.lognormvariate(math.log(self._median), self._sigma)
+
+
+# Every now and then (`spike_probability`) a request gets stuck behind a GC
+# pause, a retransmit or a cold cache, and takes at least `spike_min` seconds
+# more. The extra time is Pareto distributed, so the spikes have no upper bound.
+class HeavyTailLatency(LatencyModel):
+    def __init__(
+        self,
+        base: LatencyModel,
+        spike_probability: float,
+        spike_min: float,
+        spike_alpha: float = 1.5,
+    ):
+        self._base = base
+        self._spike_probability = spike_probability
+        self._spike_min = spike_min
+        self._spike_alpha = spike_alpha
+
+    def sample(self) -> float:
+        latency = self._base.sample()
+        if random.random() < self._spike_probability:
+            latency += self._spike_min * random.paretovariate(self._spike_alpha)
+
+        return latency
+
+
+# Scales the latency with the load of the day - requests at `peak_hour` (local
+# time) are `peak_multiplier` times slower than requests 12 hours earlier, with
+# a smooth ramp in between
+class TimeOfDayLatency(LatencyModel):
+    def __init__(
+        self, base: LatencyModel, peak_hour: float = 14, peak_multiplier: float = 2
+    ):
+        self._base = base
+        self._peak_hour = peak_hour
+        self._peak_multiplier = peak_multiplier
+
+    def sample(self) -> float:
+        return self._base.sample() * self.multiplier(datetime.datetime.now())
+
+    def multiplier(self, at: datetime.datetime) -> float:
+        hour = at.hour + at.minute / 60
+        load = 0.5 + 0.5 * math.cos(2 * math.pi * (hour - self._peak_hour) / 24)
+
+        return 1 + (self._peak_multiplier - 1) * load
+
+
+class FailureModel:
+    def should_fail(self, failure_percentage: float) -> bool:
+        return random.random() < failure_percentage / 100
+
+
+# Failures come in bursts, like an outage of the remote side. Outside of a burst
+# requests fail at the usual rate. Bursts start on average every
+# `seconds_between_bursts` seconds (no matter how many requests are sent), and
+# for the next `burst_seconds` requests fail at `burst_failure_percentage`.
+class BurstFailureModel(FailureModel):
+    def __init__(
+        self,
+        seconds_between_bursts: float,
+        burst_seconds: float,
+        burst_failure_percentage: float,
+    ):
+        self._seconds_between_bursts = seconds_between_bursts
+        self._burst_seconds = burst_seconds
+        self._burst_failure_percentage = burst_failure_percentage
+        self._lock = threading.Lock()
+        self._burst_until = 0.0
+        self._checked_at = time.monotonic()
+
+    def should_fail(self, failure_percentage: float) -> bool:
+        with self._lock:
+            current_time = time.monotonic()
+            if current_time >= self._burst_until:
+                # Chance of a burst having started since the last request
+                elapsed = current_time - self._checked_at
+                if random.random() < 1 - math.exp(
+                    -elapsed / self._seconds_between_bursts
+                ):
+                    self._burst_until = current_time + self._burst_seconds
+            self._checked_at = current_time
+
+            in_burst = current_time < self._burst_until
+
+        if in_burst:
+            return super().should_fail(self._burst_failure_percentage)
+
+        return super().should_fail(failure_percentage)
+
+
+@dataclass
+class EndpointProfile:
+    latency: LatencyModel
+    failures: FailureModel
+
+
+# "fixed"      - every request takes SIMULATED_REQUEST_LATENCY seconds and fails
+#                independently of the others
+# "production" - latencies and failures modelled on what the carrier and
+#                marketplace APIs do in production, see `_production_profiles`
+def get_endpoint_profile(endpoint: str) -> EndpointProfile:
+    profiles = _get_profiles(
+        settings.SIMULATED_REQUEST_PROFILES, settings.SIMULATED_REQUEST_LATENCY
+    )
+
+    return profiles.get(endpoint, profiles[DEFAULT_ENDPOINT])
+
+
+# Profiles keep state (failure bursts), so they are only built once for every
+# configuration
+@lru_cache(maxsize=None)
+def _get_profiles(profiles: str, latency: float) -> Dict[str, EndpointProfile]:
+    if profiles == "fixed":
+        return {
+            DEFAULT_ENDPOINT: EndpointProfile(FixedLatency(latency), FailureModel())
+        }
+
+    if profiles == "production":
+        return _production_profiles(latency)
+
+    raise ValueError(f"Unknown simulated request profiles `{profiles}`.")
+
+
+# Medians are relative to `latency`, so SIMULATED_REQUEST_LATENCY still scales
+# every endpoint (and 0 turns the latency off)
+def _production_profiles(latency: float) -> Dict[str, EndpointProfile]:
+    def endpoint_latency(
+        median: float, sigma: float, spike_probability: float
+    ) -> LatencyModel:
+        return TimeOfDayLatency(
+            HeavyTailLatency(
+                LognormalLatency(median=median * latency, sigma=sigma),
+                spike_probability=spike_probability,
+                spike_min=4 * median * latency,
+            )
+        )
+
+    return {
+        SHIPMENT_ENDPOINT: EndpointProfile(
+            latency=endpoint_latency(median=1, sigma=0.5, spike_probability=0.01),
+            failures=BurstFailureModel(
+                seconds_between_bursts=600,
+                burst_seconds=10,
+                burst_failure_percentage=60,
+            ),
+        ),
+        TRACKING_ENDPOINT: EndpointProfile(
+            latency=endpoint_latency(median=0.6, sigma=0.4, spike_probability=0.005),
+            failures=BurstFailureModel(
+                seconds_between_bursts=900,
+                burst_seconds=5,
+                burst_failure_percentage=40,
+            ),
+        ),
+        MARK_SHIPPED_ENDPOINT: EndpointProfile(
+            latency=endpoint_latency(median=0.4, sigma=0.3, spike_probability=0.005),
+            failures=BurstFailureModel(
+                seconds_between_bursts=900,
+                burst_seconds=5,
+                burst_failure_percentage=40,
+            ),
+        ),
+        DEFAULT_ENDPOINT: EndpointProfile(
+            latency=endpoint_latency(median=1, sigma=0.5, spike_probability=0.01),
+            failures=FailureModel(),
+        ),
+    }
@@ -1,6 +1,32 @@
+import time
+import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Deque, List, Optional, Iterator, Tuple
+
 from django.core.management.base import BaseCommand, CommandError
 
 from core.models import Order
+from core.definitions import Order as OrderDefinition
+from core.marketplace import generate_orders
+
+
+# The orders `start` to `start + size` of the seed
+def generate_chunk(
+    start: int,
+    size: int,
+    seed: Optional[int],
+    reference_time: datetime.datetime,
+) -> List[OrderDefinition]:
+    return next(
+        generate_orders(
+            size,
+            seed=seed,
+            chunk_size=size,
+            reference_time=reference_time,
+            start=start,
+        )
+    )
 
 
 class Command(BaseCommand):
@@ -8,6 +34,24 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("to_generate", type=int)
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of orders generated and added in a single transaction",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes generating the orders",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=None,
+            help="Seed making the generated orders reproducible",
+        )
 
     def handle(self, *args, **options):
         to_generate: int = options["to_generate"]
@@ -19,18 +63,80 @@ class Command(BaseCommand):
             )
             return
 
-        failed = Order.generate_and_add_fake_orders(to_generate=to_generate)
+        batch_size: int = options["batch_size"]
+        workers: int = options["workers"]
+        if batch_size <= 0 or workers <= 0:
+            raise CommandError("Batch size and workers have to be positive numbers.")
+
+        # Every chunk is its part of the orders of the seed, so the orders do
+        # not depend on the batch size, the number of workers or the order in
+        # which the chunks were generated
+        reference_time = datetime.datetime.now()
+        chunks = [
+            (
+                start,
+                min(batch_size, to_generate - start),
+                options["seed"],
+                reference_time,
+            )
+            for start in range(0, to_generate, batch_size)
+        ]
+
+        started_at = time.perf_counter()
+        added = 0
+        added_rows = 0
+        errors = []
+        for fake_orders in self._generate_chunks(chunks, workers):
+            result = Order.generate_and_add_fake_orders(
+                to_generate=len(fake_orders), fake_orders=fake_orders
+            )
+            errors.extend(result.errors)
+
+            added += len(result.result)
+            if result.result:
+                # orders, their customers, handling processes and items
+                added_rows += sum(
+                    3 + len(fake_order.order_items) for fake_order in fake_orders
+                )
+
+            elapsed = time.perf_counter() - started_at
+            self.stdout.write(
+                f"{added}/{to_generate} orders added "
+                f"({added / elapsed:.0f} orders/s, {added_rows / elapsed:.0f} rows/s)."
+            )
 
-        if failed:
+        if errors:
             self.stdout.write(
                 self.style.WARNING(
-                    f"It was not possible to generate and add all orders. Errors: {len(failed)}."
+                    f"It was not possible to generate and add all orders. Errors: {len(errors)}."
                 )
             )
-            [self.stdout.write(self.style.ERROR(error.message)) for error in failed]
+            [self.stdout.write(self.style.ERROR(error.message)) for error in errors]
         else:
             self.stdout.write(
                 self.style.SUCCESS(
                     f"{to_generate} orders were generated and added successfully."
                 )
             )
+
+    # Yields the generated chunks in order. At most two chunks per worker are
+    # generated ahead of the database, which bounds the memory by the batch size.
+    def _generate_chunks(
+        self,
+        chunks: List[Tuple[int, int, Optional[int], datetime.datetime]],
+        workers: int,
+    ) -> Iterator[List[OrderDefinition]]:
+        if workers == 1:
+            for chunk in chunks:
+                yield generate_chunk(*chunk)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending: Deque[Future] = deque()
+            for chunk in chunks:
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(generate_chunk, *chunk))
+
+            while pending:
+                yield pending.popleft().result()
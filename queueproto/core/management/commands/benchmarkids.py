@@ -0,0 +1,95 @@
+import time
+import uuid
+from typing import Callable, Dict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from core.ids import uuid7
+from core.models import OrderHandlingProcess
+
+# Marks the rows added by the benchmark, so they can be removed afterwards
+BENCHMARK_MESSAGE = "benchmarkids"
+
+ID_GENERATORS: Dict[str, Callable[[], uuid.UUID]] = {
+    "uuid4": uuid.uuid4,
+    "uuid7": uuid7,
+}
+
+
+class Command(BaseCommand):
+    help = "Compares the insert throughput of random (uuid4) and time ordered (uuid7) primary keys"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            type=int,
+            default=200_000,
+            help="Number of rows inserted with every kind of ID",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of rows inserted in a single statement",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the inserted rows instead of deleting them afterwards",
+        )
+
+    def handle(self, *args, **options):
+        rows: int = options["rows"]
+        batch_size: int = options["batch_size"]
+        if rows <= 0 or batch_size <= 0:
+            raise CommandError("Rows and batch size have to be positive numbers.")
+
+        for name, generate_id in ID_GENERATORS.items():
+            try:
+                self._benchmark(name, generate_id, rows, batch_size)
+            finally:
+                # Every kind of ID starts from the same table size
+                if not options["keep"]:
+                    OrderHandlingProcess.objects.filter(
+                        message=BENCHMARK_MESSAGE
+                    ).delete()
+
+    def _benchmark(
+        self,
+        name: str,
+        generate_id: Callable[[], uuid.UUID],
+        rows: int,
+        batch_size: int,
+    ) -> None:
+        timestamp = now()
+        elapsed = 0.0
+        slowest_batch = 0.0
+        for start in range(0, rows, batch_size):
+            handling_processes = [
+                OrderHandlingProcess(
+                    id=generate_id(),
+                    status=OrderHandlingProcess.Status.SUCCEEDED,
+                    state=OrderHandlingProcess.State.WAITING,
+                    message=BENCHMARK_MESSAGE,
+                    started_at=timestamp,
+                    finished_at=timestamp,
+                    order=None,
+                )
+                for _ in range(min(batch_size, rows - start))
+            ]
+
+            # Only the inserts are timed, not building the rows
+            started_at = time.perf_counter()
+            OrderHandlingProcess.objects.bulk_create(handling_processes)
+            batch_elapsed = time.perf_counter() - started_at
+
+            elapsed += batch_elapsed
+            slowest_batch = max(slowest_batch, batch_elapsed)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{name}: {rows} rows in {elapsed:.2f}s "
+                f"({rows / elapsed:.0f} rows/s, slowest batch {slowest_batch * 1000:.1f}ms)."
+            )
+        )
@@ -0,0 +1,369 @@
+import json
+import math
+import time
+import asyncio
+import datetime
+import threading
+from contextlib import ExitStack, contextmanager
+from typing import Dict, List, Set, Tuple
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from core.models import Order, OrderHandlingProcess
+from core.marketplace import generate_orders
+from core.buffers import OrderHandlingWriteBuffer
+from core.dedupe import OrderHandlingLocks
+from api.v1.generators.order import OrderEventHub, EVENTS_READ_TIMEOUT
+
+PERCENTILES = (50, 95, 99)
+
+
+# Nearest-rank percentile of already sorted values
+def percentile(sorted_values: List[float], p: float) -> float:
+    if len(sorted_values) == 0:
+        return math.nan
+
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# Receives the events of the benchmarked orders the same way SSE clients do -
+# through an order event hub - until every order reached its final state.
+# PROCESSED is sent after every attempt, also the failed ones that are retried,
+# so an order is only done once it was shipped, or once it was processed and
+# is no longer queued or being handled (it failed and is out of retries).
+class OrderEventCollector:
+    def __init__(self, order_ids: List[str]):
+        self._pending: Set[str] = set(order_ids)
+        # Pending orders that were processed, with the time they last were
+        self._processed: Dict[str, float] = dict()
+        self._checked_at = 0.0
+        self._stopped = threading.Event()
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.events_received = 0
+        self.processed_at: Dict[str, float] = dict()
+
+    def run(self) -> None:
+        asyncio.run(self._collect())
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    async def _collect(self) -> None:
+        hub = OrderEventHub()
+        subscription = hub.subscribe()
+        try:
+            # Gives the hub readers time to pick their starting positions
+            await asyncio.sleep(EVENTS_READ_TIMEOUT)
+            self.ready.set()
+
+            while len(self._pending) > 0 and not self._stopped.is_set():
+                if subscription.dropped:
+                    raise RuntimeError(
+                        "Event subscription fell behind and was dropped."
+                    )
+
+                try:
+                    message = await asyncio.wait_for(
+                        subscription.messages.get(), timeout=EVENTS_READ_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    message = None
+
+                if message is not None:
+                    self._receive(message)
+                if time.perf_counter() - self._checked_at >= EVENTS_READ_TIMEOUT:
+                    await self._complete_failed_orders()
+        finally:
+            hub.unsubscribe(subscription)
+            self.ready.set()
+            self.done.set()
+
+    def _receive(self, message: str) -> None:
+        event, data = "", dict()
+        for line in message.strip().splitlines():
+            if line.startswith("event: "):
+                event = line[len("event: ") :]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: ") :])
+
+        order_id = data.get("order_id")
+        if order_id not in self._pending and order_id not in self.processed_at:
+            return
+
+        self.events_received += 1
+        if order_id not in self._pending:
+            return
+
+        if (
+            event == "updatedOrderProcessingStatus"
+            and data.get("status") == "PROCESSED"
+        ):
+            self._processed[order_id] = time.perf_counter()
+        elif (
+            event == "updatedOrderFulfillmentStatus" and data.get("status") == "SHIPPED"
+        ):
+            self._complete(order_id, time.perf_counter())
+
+    # Orders that were processed and are no longer queued or being handled will
+    # not be handled again
+    async def _complete_failed_orders(self) -> None:
+        self._checked_at = time.perf_counter()
+        if len(self._processed) == 0:
+            return
+
+        held = await asyncio.to_thread(OrderHandlingLocks().held, list(self._processed))
+        for order_id, processed_at in list(self._processed.items()):
+            if order_id not in held:
+                self._complete(order_id, processed_at)
+
+    def _complete(self, order_id: str, completed_at: float) -> None:
+        self._pending.discard(order_id)
+        self._processed.pop(order_id, None)
+        self.processed_at[order_id] = completed_at
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs orders end to end through the handling pipeline and reports its "
+        "throughput and latencies. Set REDIS_IN_PROCESS to run it without a "
+        "redis server."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--orders",
+            type=int,
+            default=100,
+            help="Number of orders handled",
+        )
+        parser.add_argument(
+            "--request-size",
+            type=int,
+            default=100,
+            help="Number of order IDs submitted in a single request",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=None,
+            help="Seconds a simulated API request takes, defaults to "
+            "SIMULATED_REQUEST_LATENCY. Use 0 to measure the orchestration "
+            "overhead alone.",
+        )
+        parser.add_argument(
+            "--profiles",
+            choices=["fixed", "production"],
+            default=None,
+            help="Simulated request profiles, defaults to SIMULATED_REQUEST_PROFILES",
+        )
+        parser.add_argument(
+            "--mode",
+            choices=["sequential", "concurrent", "batch", "staged"],
+            default=None,
+            help="Order handling mode, defaults to ORDER_HANDLING_MODE",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=None,
+            help="Seed making the generated orders reproducible",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=600,
+            help="Seconds to wait for the events of all orders",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the benchmarked orders instead of deleting them afterwards",
+        )
+
+    def handle(self, *args, **options):
+        to_generate: int = options["orders"]
+        request_size: int = options["request_size"]
+        if to_generate <= 0 or request_size <= 0:
+            raise CommandError("Orders and request size have to be positive numbers.")
+
+        latency = options["latency"]
+        if latency is None:
+            latency = settings.SIMULATED_REQUEST_LATENCY
+        mode = options["mode"] or settings.ORDER_HANDLING_MODE
+        profiles = options["profiles"] or settings.SIMULATED_REQUEST_PROFILES
+
+        with ExitStack() as stack:
+            stack.enter_context(
+                self._use_settings(
+                    SIMULATED_REQUEST_LATENCY=latency,
+                    SIMULATED_REQUEST_PROFILES=profiles,
+                    ORDER_HANDLING_MODE=mode,
+                )
+            )
+            stack.enter_context(self._eager_celery())
+
+            fake_orders = next(
+                generate_orders(
+                    to_generate, seed=options["seed"], chunk_size=to_generate
+                )
+            )
+            result = Order.generate_and_add_fake_orders(
+                to_generate=len(fake_orders), fake_orders=fake_orders
+            )
+            if result.errors:
+                raise CommandError(
+                    f"Error while adding orders: {result.errors[0].message}"
+                )
+
+            order_ids = [str(order.id) for order in result.result]
+            try:
+                self.stdout.write(
+                    f"Handling {len(order_ids)} orders in `{mode}` mode "
+                    f"with {latency}s `{profiles}` simulated request latency..."
+                )
+                self._run(order_ids, request_size, options["timeout"])
+            finally:
+                if not options["keep"]:
+                    Order.purge(ids=order_ids)
+
+    def _run(self, order_ids: List[str], request_size: int, timeout: float) -> None:
+        # Imported here, so the API is only set up once redis is in place
+        from fastapi.testclient import TestClient
+        from queueproto.wsgi import fastapp_v1, fastapp_v1_root
+
+        collector = OrderEventCollector(order_ids)
+        collector_thread = threading.Thread(
+            target=collector.run, name="benchmark-event-collector", daemon=True
+        )
+        collector_thread.start()
+        collector.ready.wait()
+
+        submitted_at: Dict[str, datetime.datetime] = dict()
+        client = TestClient(fastapp_v1)
+        started_at = time.perf_counter()
+        for i in range(0, len(order_ids), request_size):
+            chunk = order_ids[i : i + request_size]
+            for order_id in chunk:
+                submitted_at[order_id] = now()
+
+            response = client.post(
+                f"{fastapp_v1_root}/core/orders/handle", json={"order_ids": chunk}
+            )
+            if response.status_code != 200:
+                collector.stop()
+                raise CommandError(
+                    f"Submitting orders failed with {response.status_code}: "
+                    f"{response.text}"
+                )
+        submitted_in = time.perf_counter() - started_at
+
+        if settings.ORDER_HANDLING_WRITE_BEHIND:
+            OrderHandlingWriteBuffer().flush()
+
+        if not collector.done.wait(timeout=timeout):
+            collector.stop()
+            collector.done.wait()
+        collector_thread.join()
+
+        finished_at = max(collector.processed_at.values(), default=time.perf_counter())
+        elapsed = finished_at - started_at
+        processed = len(collector.processed_at)
+
+        self.stdout.write(
+            f"Submitted in {submitted_in:.2f}s, "
+            f"{collector.events_received} events received."
+        )
+        if processed < len(order_ids):
+            self.stdout.write(
+                self.style.WARNING(
+                    f"{len(order_ids) - processed} orders did not reach their "
+                    "final state."
+                )
+            )
+
+        shipped = Order.objects.filter(
+            id__in=order_ids, state=Order.State.SHIPPED
+        ).count()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{processed} orders processed ({shipped} shipped) in {elapsed:.2f}s - "
+                f"{processed / elapsed if elapsed > 0 else math.inf:.2f} orders/s."
+            )
+        )
+
+        stage_durations, queue_waits = self._get_durations(order_ids, submitted_at)
+        self._write_latencies("queue wait", queue_waits)
+        for state in OrderHandlingProcess.State:
+            if state in stage_durations:
+                self._write_latencies(str(state.label).lower(), stage_durations[state])
+
+    # Durations of every stage, and how long every order waited between being
+    # submitted and its first stage starting
+    def _get_durations(
+        self, order_ids: List[str], submitted_at: Dict[str, datetime.datetime]
+    ) -> Tuple[Dict[str, List[float]], List[float]]:
+        stage_durations: Dict[str, List[float]] = dict()
+        first_started_at: Dict[str, datetime.datetime] = dict()
+
+        handling_processes = OrderHandlingProcess.objects.filter(
+            order_id__in=order_ids
+        ).values_list("order_id", "state", "started_at", "finished_at")
+        for order_id, state, started_at, finished_at in handling_processes:
+            order_id = str(order_id)
+            if state == OrderHandlingProcess.State.WAITING:
+                continue
+
+            stage_durations.setdefault(state, []).append(
+                (finished_at - started_at).total_seconds()
+            )
+            if (
+                order_id not in first_started_at
+                or started_at < first_started_at[order_id]
+            ):
+                first_started_at[order_id] = started_at
+
+        queue_waits = [
+            max(0.0, (started_at - submitted_at[order_id]).total_seconds())
+            for order_id, started_at in first_started_at.items()
+            if order_id in submitted_at
+        ]
+
+        return stage_durations, queue_waits
+
+    def _write_latencies(self, name: str, durations: List[float]) -> None:
+        durations = sorted(durations)
+        quantiles = ", ".join(
+            f"p{p} {percentile(durations, p) * 1000:.1f}ms" for p in PERCENTILES
+        )
+        self.stdout.write(f"  {name:<20} {quantiles} ({len(durations)} samples)")
+
+    # Tasks run in-process, right where they are sent. Retries and reschedules
+    # of eager tasks run right away, and must not propagate out of the request.
+    @contextmanager
+    def _eager_celery(self):
+        from queueproto.celery import app
+
+        previous = (app.conf.task_always_eager, app.conf.task_eager_propagates)
+        app.conf.task_always_eager = True
+        app.conf.task_eager_propagates = False
+        try:
+            yield
+        finally:
+            app.conf.task_always_eager, app.conf.task_eager_propagates = previous
+
+    # Settings read while handling orders, replaced for the run of the benchmark.
+    # Celery runs eagerly, so the tasks see them in this process.
+    @contextmanager
+    def _use_settings(self, **values):
+        previous = {name: getattr(settings, name) for name in values}
+        for name, value in values.items():
+            setattr(settings, name, value)
+        try:
+            yield
+        finally:
+            for name, value in previous.items():
+                setattr(settings, name, value)
@@ -1,15 +1,59 @@
+import re
+import datetime
+
 from django.core.management.base import BaseCommand, CommandError
 
 from core.models import Order
 
+DURATION_UNITS = {
+    "s": "seconds",
+    "m": "minutes",
+    "h": "hours",
+    "d": "days",
+    "w": "weeks",
+}
+
+
+def parse_duration(value: str) -> datetime.timedelta:
+    match = re.fullmatch(r"(\d+)([smhdw])", value.strip())
+    if match is None:
+        raise CommandError(
+            f"Invalid duration `{value}`. Expected e.g. 45m, 12h, 30d or 2w."
+        )
+
+    return datetime.timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
 
 class Command(BaseCommand):
     help = "Delete all orders from the database"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=parse_duration,
+            default=None,
+            help="Only delete orders created before this long ago, e.g. 30d",
+        )
+        parser.add_argument(
+            "--state",
+            choices=Order.State.values,
+            default=None,
+            help="Only delete orders in this state",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of orders deleted in a single transaction",
+        )
+
     def handle(self, *args, **options):
         try:
-            orders_count = Order.objects.count()
-            Order.objects.all().delete()
+            orders_count = Order.purge(
+                older_than=options["older_than"],
+                state=options["state"],
+                chunk_size=options["chunk_size"],
+            )
         except Exception as e:
             self.stdout.write(self.style.ERROR(f"Error while deleting orders: {e}."))
         else:
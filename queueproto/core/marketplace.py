@@ -1,4 +1,5 @@
-from typing import List, Dict
+from typing import List, Dict, Iterator, Optional
+from functools import lru_cache
 import datetime
 import string
 import random
@@ -6,6 +7,7 @@ import random
 from faker import Faker
 
 from core.definitions import OrderState, Order, OrderItem, Customer, OrderShipment
+from core.ids import generate_shipment_id
 
 fake = Faker()
 
@@ -64,16 +66,21 @@ PRODUCT_NAMES = [
 ]
 
 
+COUNTRIES = [
+    "Denmark",
+    "Sweden",
+    "Germany",
+    "Netherlands",
+    "Finland",
+    "Norway",
+    "Poland",
+]
+
+CURRENCY_ISO_CODES = ["SEK", "PLN", "DKK", "EUR", "NOK"]
+
+
 def generate_customer() -> Customer:
-    countries = [
-        "Denmark",
-        "Sweden",
-        "Germany",
-        "Netherlands",
-        "Finland",
-        "Norway",
-        "Poland",
-    ]
+    countries = COUNTRIES
 
     return Customer(
         first_name=fake.first_name(),
@@ -106,13 +113,10 @@ def generate_order_shipment() -> OrderShipment:
         {"name": "FedEx", "code": "fedex"},
         {"name": "Cargo Express", "code": "cargoex"},
     ]
-    characters_set = string.ascii_letters + string.digits
-    shipment_id = "SHIPMENT-".join(random.choice(characters_set) for _ in range(6))
-
     carrier = carriers[random.randint(0, len(carriers) - 1)]
 
     return OrderShipment(
-        shipment_id=shipment_id,
+        shipment_id=generate_shipment_id(),
         carrier_name=carrier.get("name", ""),
         carrier_code=carrier.get("code", ""),
     )
@@ -124,7 +128,7 @@ def generate_order() -> Order:
         generate_order_item() for _ in range(random.randint(1, 5))
     ]
 
-    currency_iso_codes = ["SEK", "PLN", "DKK", "EUR", "NOK"]
+    currency_iso_codes = CURRENCY_ISO_CODES
 
     today = datetime.datetime.now()
 
@@ -149,3 +153,150 @@ def generate_order() -> Order:
         order_items=order_items,
         customer=customer,
     )
+
+
+# Size of the precomputed pools of fake customer data used by `generate_orders`
+CUSTOMER_POOL_SIZE = 1000
+
+SKU_LENGTH = 6
+
+# Every price `generate_order_item` can produce - 3.5 to 10.0 with a step of 0.1
+ORDER_ITEM_PRICES = [round(3.5 + i / 10, 1) for i in range(66)]
+
+
+@lru_cache(maxsize=1)
+def _get_customer_pools() -> Dict[str, List[str]]:
+    # Built once per process from a seeded Faker, so the pools (and so the
+    # generated orders) are the same everywhere
+    pool_fake = Faker()
+    pool_fake.seed_instance(0)
+
+    return {
+        "first_name": [pool_fake.first_name() for _ in range(CUSTOMER_POOL_SIZE)],
+        "last_name": [pool_fake.last_name() for _ in range(CUSTOMER_POOL_SIZE)],
+        "address1": [pool_fake.street_address() for _ in range(CUSTOMER_POOL_SIZE)],
+        "address2": [pool_fake.secondary_address() for _ in range(CUSTOMER_POOL_SIZE)],
+        "zip_code": [pool_fake.zipcode() for _ in range(CUSTOMER_POOL_SIZE)],
+    }
+
+
+# Orders are generated in blocks of SEED_BLOCK_SIZE orders, every block with a
+# random generator of its own seeded from the seed and the index of the block.
+# So a seed produces the same orders whatever the `chunk_size`, and generating
+# more orders only appends to them.
+SEED_BLOCK_SIZE = 100
+
+
+# Generates `to_generate` orders in chunks of `chunk_size`. Instead of calling
+# Faker and `random` per field, every field of a whole block is sampled at once
+# from precomputed pools. The same seed (and reference time) always produces
+# the same orders. `start` skips that many orders of the seed, so separate calls
+# (e.g. of parallel workers) generate consecutive parts of the same orders.
+def generate_orders(
+    to_generate: int,
+    seed: Optional[int] = None,
+    chunk_size: int = 1000,
+    reference_time: Optional[datetime.datetime] = None,
+    start: int = 0,
+) -> Iterator[List[Order]]:
+    if to_generate < 0 or start < 0:
+        raise ValueError("Number of orders to generate can not be negative.")
+    if chunk_size <= 0:
+        raise ValueError("Chunk size has to be a positive number.")
+
+    if reference_time is None:
+        reference_time = datetime.datetime.now()
+
+    # Checked right away, not only once the chunks are iterated
+    return _generate_chunks(to_generate, seed, chunk_size, reference_time, start)
+
+
+def _generate_chunks(
+    to_generate: int,
+    seed: Optional[int],
+    chunk_size: int,
+    reference_time: datetime.datetime,
+    start: int,
+) -> Iterator[List[Order]]:
+    min_today = datetime.datetime.combine(reference_time.date(), datetime.time(0, 0))
+    delta_time_seconds = (reference_time - min_today).seconds
+
+    pending: List[Order] = []
+    generated = 0
+    block, skipped = divmod(start, SEED_BLOCK_SIZE)
+    while generated < to_generate:
+        rng = random.Random(f"{seed}:{block}" if seed is not None else None)
+        orders = _generate_block(rng, min_today, delta_time_seconds)
+        orders = orders[skipped : skipped + to_generate - generated]
+        skipped = 0
+        generated += len(orders)
+        block += 1
+
+        pending.extend(orders)
+        while len(pending) >= chunk_size or (
+            generated >= to_generate and len(pending) > 0
+        ):
+            yield pending[:chunk_size]
+            pending = pending[chunk_size:]
+
+
+def _generate_block(
+    rng: random.Random, min_today: datetime.datetime, delta_time_seconds: int
+) -> List[Order]:
+    pools = _get_customer_pools()
+    characters_set = string.ascii_letters + string.digits
+    size = SEED_BLOCK_SIZE
+
+    first_names = rng.choices(pools["first_name"], k=size)
+    last_names = rng.choices(pools["last_name"], k=size)
+    addresses1 = rng.choices(pools["address1"], k=size)
+    addresses2 = rng.choices(pools["address2"], k=size)
+    zip_codes = rng.choices(pools["zip_code"], k=size)
+    countries = rng.choices(COUNTRIES, k=size)
+    currencies = rng.choices(CURRENCY_ISO_CODES, k=size)
+    placed_at_seconds = rng.choices(range(delta_time_seconds + 1), k=size)
+    items_counts = rng.choices(range(1, 6), k=size)
+
+    items_total = sum(items_counts)
+    adjectives = rng.choices(PRODUCT_ADJECTIVES, k=items_total)
+    materials = rng.choices(PRODUCT_MATERIALS, k=items_total)
+    names = rng.choices(PRODUCT_NAMES, k=items_total)
+    prices = rng.choices(ORDER_ITEM_PRICES, k=items_total)
+    quantities = rng.choices(range(1, 4), k=items_total)
+    skus = "".join(rng.choices(characters_set, k=items_total * SKU_LENGTH))
+
+    orders: List[Order] = []
+    item_index = 0
+    for i in range(size):
+        order_items = [
+            OrderItem(
+                product_sku=skus[j * SKU_LENGTH : (j + 1) * SKU_LENGTH],
+                product_title=f"{adjectives[j]} {materials[j]} {names[j]}",
+                product_media_url=None,
+                price=prices[j],
+                quantity=quantities[j],
+            )
+            for j in range(item_index, item_index + items_counts[i])
+        ]
+        item_index += items_counts[i]
+
+        orders.append(
+            Order(
+                total_price=sum([order_item.price for order_item in order_items]),
+                total_quantity=sum([order_item.quantity for order_item in order_items]),
+                state=OrderState.SHIPPING,
+                currency_iso_code=currencies[i],
+                placed_at=min_today + datetime.timedelta(seconds=placed_at_seconds[i]),
+                order_items=order_items,
+                customer=Customer(
+                    first_name=first_names[i],
+                    last_name=last_names[i],
+                    address1=addresses1[i],
+                    address2=addresses2[i],
+                    zip_code=zip_codes[i],
+                    country=countries[i],
+                ),
+            )
+        )
+
+    return orders
@@ -0,0 +1,243 @@
+import abc
+import json
+import atexit
+import bisect
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from celery.utils.log import get_task_logger
+
+from core.events import Singleton
+
+logger = get_task_logger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+# Process-wide buffer of metric updates. Recording only touches a dict under a
+# lock, the updates of all processes (API, workers) are added up in redis by a
+# background thread every METRICS_FLUSH_INTERVAL seconds.
+class MetricsRegistry(metaclass=Singleton):
+    def __init__(self):
+        self._key_prefix = "metrics"
+        self._flush_interval = settings.METRICS_FLUSH_INTERVAL
+        self._connection = get_redis_connection("default")
+
+        self._lock = threading.Lock()
+        # metric name -> field -> pending increment
+        self._pending: Dict[str, Dict[str, float]] = dict()
+
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, name="metrics-flusher", daemon=True
+        )
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def increment(self, name: str, field: str, amount: float) -> None:
+        with self._lock:
+            fields = self._pending.setdefault(name, dict())
+            fields[field] = fields.get(field, 0) + amount
+
+    def flush(self) -> None:
+        with self._lock:
+            pending = self._pending
+            self._pending = dict()
+
+        if len(pending) == 0:
+            return
+
+        try:
+            pipeline = self._connection.pipeline(transaction=False)
+            for name, fields in pending.items():
+                for field, amount in fields.items():
+                    pipeline.hincrbyfloat(self.key(name), field, amount)
+            pipeline.execute()
+        except Exception as e:
+            logger.error(msg=f"Error while flushing metrics: {e}")
+            # Kept for the next flush instead of being lost
+            for name, fields in pending.items():
+                for field, amount in fields.items():
+                    self.increment(name, field, amount)
+
+    def read(self, name: str) -> Dict[str, float]:
+        return {
+            field.decode(): float(value)
+            for field, value in self._connection.hgetall(self.key(name)).items()
+        }
+
+    def key(self, name: str) -> str:
+        return f"{self._key_prefix}:{name}"
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+
+class Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+    def _field(self, labels: Dict[str, str], suffix: str = "") -> str:
+        return json.dumps(
+            [[str(labels.get(label, "")) for label in self.labels], suffix]
+        )
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+            *self._render_samples(MetricsRegistry().read(self.name)),
+        ]
+
+    @abc.abstractmethod
+    def _render_samples(self, fields: Dict[str, float]) -> List[str]:
+        pass
+
+    def _format_labels(
+        self, values: Sequence[str], extra: Optional[Tuple[str, str]] = None
+    ) -> str:
+        pairs = list(zip(self.labels, values))
+        if extra is not None:
+            pairs.append(extra)
+        if len(pairs) == 0:
+            return ""
+
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        MetricsRegistry().increment(self.name, self._field(labels), amount)
+
+    def _render_samples(self, fields: Dict[str, float]) -> List[str]:
+        samples = []
+        for field, value in sorted(fields.items()):
+            values, _ = json.loads(field)
+            samples.append(f"{self.name}{self._format_labels(values)} {_format(value)}")
+
+        return samples
+
+
+# Buckets are stored non-cumulative (one counter per bucket), and only added up
+# into the cumulative `le` buckets when rendered
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        registry = MetricsRegistry()
+        index = bisect.bisect_left(self.buckets, value)
+        registry.increment(self.name, self._field(labels, f"bucket:{index}"), 1)
+        registry.increment(self.name, self._field(labels, "sum"), value)
+
+    def _render_samples(self, fields: Dict[str, float]) -> List[str]:
+        series: Dict[LabelValues, Dict[str, float]] = dict()
+        for field, value in fields.items():
+            values, suffix = json.loads(field)
+            series.setdefault(tuple(values), dict())[suffix] = value
+
+        samples = []
+        for values, series_fields in sorted(series.items()):
+            cumulative = 0.0
+            for index, bound in enumerate([*self.buckets, float("inf")]):
+                cumulative += series_fields.get(f"bucket:{index}", 0)
+                le = "+Inf" if bound == float("inf") else _format(bound)
+                samples.append(
+                    f"{self.name}_bucket{self._format_labels(values, ('le', le))} "
+                    f"{_format(cumulative)}"
+                )
+            samples.append(
+                f"{self.name}_sum{self._format_labels(values)} "
+                f"{_format(series_fields.get('sum', 0))}"
+            )
+            samples.append(
+                f"{self.name}_count{self._format_labels(values)} {_format(cumulative)}"
+            )
+
+        return samples
+
+
+# Gauges are not recorded, their current values are read when scraped
+def render_gauge(
+    name: str, description: str, samples: Dict[Tuple[Tuple[str, str], ...], float]
+) -> List[str]:
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+    for labels, value in samples.items():
+        formatted_labels = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+        lines.append(
+            f"{name}{{{formatted_labels}}} {_format(value)}"
+            if formatted_labels
+            else f"{name} {_format(value)}"
+        )
+
+    return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+
+    return repr(value)
+
+
+ORDER_STAGE_DURATION = Histogram(
+    "order_stage_duration_seconds",
+    "Duration of the order handling stages",
+    labels=("stage", "status"),
+)
+
+ORDER_TASK_DURATION = Histogram(
+    "order_task_duration_seconds",
+    "Duration of the celery tasks",
+    labels=("task", "state"),
+)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Duration of the API requests",
+    labels=("method", "route", "status_code"),
+)
+
+ORDERS_QUEUED = Counter("orders_queued_total", "Orders queued for handling")
+
+ORDERS_PROCESSED = Counter(
+    "orders_processed_total", "Orders that went through all handling stages"
+)
+
+ORDERS_FAILED = Counter(
+    "orders_failed_total", "Order handling attempts that failed in one of the stages"
+)
+
+METRICS: List[Metric] = [
+    ORDER_STAGE_DURATION,
+    ORDER_TASK_DURATION,
+    HTTP_REQUEST_DURATION,
+    ORDERS_QUEUED,
+    ORDERS_PROCESSED,
+    ORDERS_FAILED,
+]
@@ -1,9 +1,17 @@
+import os
 import uuid
+import json
+import socket
+import time
+import hashlib
 import datetime
-from typing import List, Optional, Dict, Iterable
+from typing import Any, List, Optional, Dict, Iterable, Set, Tuple, Type
 
-from django.db import models, transaction
-from django.db.models import QuerySet
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models, router, transaction
+from django.db.models import QuerySet, Window, F, Q
+from django.db.models.functions import RowNumber
 from django.utils.timezone import now, make_aware
 from django.utils.translation import gettext_lazy as _
 
@@ -15,10 +23,20 @@ from core.definitions import (
     ApiResponse,
 )
 from core.api import simulate_request
+from core.latency import SHIPMENT_ENDPOINT, TRACKING_ENDPOINT, MARK_SHIPPED_ENDPOINT
+from core.buffers import (
+    write_handling_results,
+    RollupKey,
+    StageDurationRollupBuffer,
+)
+from core.ids import uuid7
+from core.metrics import ORDER_STAGE_DURATION
+from core.sketch import QuantileSketch
 
 
 class BaseModel(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # Time ordered, so inserts append to the primary key index
+    id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
     created_at = models.DateTimeField(default=now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -74,24 +92,9 @@ class OrderShipment(BaseModel):
     ) -> Optional["OrderShipment"]:
         started_at = now()
 
-        api_response: ApiResponse[OrderShipment] = simulate_request(
-            data_callback=generate_order_shipment,
-            allow_failure=True,
-            failure_percentage=5,
-        )
-
-        error = None
-        shipment = None
-        if api_response.status_code != 200 and isinstance(api_response.response, Error):
-            error = api_response.response
-        else:
-            shipment_data: OrderShipment = api_response.response
-            shipment = cls.objects.create(
-                shipment_id=shipment_data.shipment_id,
-                carrier_name=shipment_data.carrier_name,
-                carrier_code=shipment_data.carrier_code,
-                order=order,
-            )
+        shipment, error = cls.request_shipment_for_order(order)
+        if shipment is not None:
+            shipment.save()
 
         OrderHandlingProcess.update_processing(
             order=order,
@@ -104,6 +107,32 @@ class OrderShipment(BaseModel):
 
         return shipment
 
+    # Sends the request to the marketplace without persisting anything, so the
+    # caller can decide how (and when) the shipment is saved
+    @classmethod
+    def request_shipment_for_order(
+        cls, order: "Order"
+    ) -> Tuple[Optional["OrderShipment"], Optional[Error]]:
+        api_response: ApiResponse[OrderShipment] = simulate_request(
+            data_callback=generate_order_shipment,
+            allow_failure=True,
+            failure_percentage=5,
+            endpoint=SHIPMENT_ENDPOINT,
+        )
+
+        if api_response.status_code != 200 and isinstance(api_response.response, Error):
+            return None, api_response.response
+
+        shipment_data: OrderShipment = api_response.response
+        shipment = cls(
+            shipment_id=shipment_data.shipment_id,
+            carrier_name=shipment_data.carrier_name,
+            carrier_code=shipment_data.carrier_code,
+            order=order,
+        )
+
+        return shipment, None
+
 
 class OrderHandlingProcess(BaseModel):
     class Status(models.TextChoices):
@@ -141,31 +170,269 @@ class OrderHandlingProcess(BaseModel):
         event_name: str,
         error: Optional[Error] = None,
     ):
+        handling_process = cls.build_processing(
+            order=order,
+            state=state,
+            started_at=started_at,
+            error=error,
+        )
+        write_handling_results(
+            event_queue,
+            handling_processes=[handling_process],
+            events=[handling_process.to_status_event(event_name=event_name)],
+        )
+
+    @classmethod
+    def build_processing(
+        cls,
+        order: "Order",
+        state: "OrderHandlingProcess.State",
+        started_at: datetime.datetime,
+        error: Optional[Error] = None,
+    ) -> "OrderHandlingProcess":
         order_handling_process_status = OrderHandlingProcess.Status.SUCCEEDED
-        process_status = "SUCCESS"
         process_message = None
 
         if error:
             order_handling_process_status = OrderHandlingProcess.Status.FAILED
-            process_status = "FAILED"
             process_message = error.message
 
-        cls.objects.create(
+        finished_at = now()
+        # Every stage of every handling mode ends up here
+        ORDER_STAGE_DURATION.observe(
+            (finished_at - started_at).total_seconds(),
+            stage=OrderHandlingProcess.State(state).value,
+            status=order_handling_process_status.value,
+        )
+
+        return cls(
             status=order_handling_process_status,
             state=state,
             message=process_message,
             started_at=started_at,
-            finished_at=now(),
+            finished_at=finished_at,
             order=order,
         )
 
-        event_queue.enque_processing_status_event(
-            data={
-                "order_id": str(order.id),
-                "state": state.value,
-                "status": process_status,
-                "event": event_name,
-            },
+    # Every handling process row written while handling orders goes through
+    # here, so the stage duration rollups never miss one. Durations are only
+    # recorded once the rows are committed.
+    @classmethod
+    def bulk_save(cls, handling_processes: List["OrderHandlingProcess"]) -> None:
+        if len(handling_processes) == 0:
+            return
+
+        cls.objects.bulk_create(handling_processes)
+        transaction.on_commit(lambda: StageDurationRollup.record(handling_processes))
+
+    def to_status_event(self, event_name: str) -> Dict[str, str]:
+        process_status = "SUCCESS"
+        if self.status == OrderHandlingProcess.Status.FAILED:
+            process_status = "FAILED"
+
+        return {
+            "order_id": str(self.order_id),
+            "state": OrderHandlingProcess.State(self.state).value,
+            "status": process_status,
+            "event": event_name,
+        }
+
+
+# Durations of the handling stages, pre-aggregated per minute and per hour for
+# every state and status. A rollup holds the count, the sum and a quantile
+# sketch of the durations of the stages that finished in its bucket, so the
+# percentiles of any window are merged from a bounded number of rows instead of
+# scanning the handling processes.
+class StageDurationRollup(BaseModel):
+    class Resolution(models.TextChoices):
+        MINUTE = "MINUTE", _("MINUTE")
+        HOUR = "HOUR", _("HOUR")
+
+    resolution = models.CharField(max_length=10, choices=Resolution.choices)
+    bucket_start = models.DateTimeField()
+    state = models.CharField(
+        max_length=25, choices=OrderHandlingProcess.State.choices
+    )
+    status = models.CharField(
+        max_length=25, choices=OrderHandlingProcess.Status.choices
+    )
+    count = models.PositiveBigIntegerField(default=0)
+    duration_sum = models.FloatField(default=0)
+    sketch = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["resolution", "state", "status", "bucket_start"],
+                name="unique_stage_duration_rollup",
+            )
+        ]
+
+    # Collects the durations of the handling processes per bucket. They are only
+    # added to the rollups by the next flush of StageDurationRollupBuffer, so
+    # writing a stage never waits on the rollup rows every worker updates.
+    @classmethod
+    def record(cls, handling_processes: Iterable[OrderHandlingProcess]) -> None:
+        sketches: Dict[RollupKey, QuantileSketch] = dict()
+        sums: Dict[RollupKey, float] = dict()
+        for handling_process in handling_processes:
+            state = OrderHandlingProcess.State(handling_process.state).value
+            if state == OrderHandlingProcess.State.WAITING:
+                continue
+
+            status = OrderHandlingProcess.Status(handling_process.status).value
+            duration = max(
+                0.0,
+                (
+                    handling_process.finished_at - handling_process.started_at
+                ).total_seconds(),
+            )
+            for resolution in cls.Resolution:
+                key = (
+                    resolution.value,
+                    state,
+                    status,
+                    cls.get_bucket_start(handling_process.finished_at, resolution),
+                )
+                sketches.setdefault(key, QuantileSketch()).add(duration)
+                sums[key] = sums.get(key, 0) + duration
+
+        if len(sketches) == 0:
+            return
+
+        StageDurationRollupBuffer().add(
+            {key: (sums[key], sketch) for key, sketch in sketches.items()}
+        )
+
+    # Adds the collected durations to the rollups, one locked read-merge-write
+    # per bucket
+    @classmethod
+    def merge(cls, durations: Dict[RollupKey, Tuple[float, QuantileSketch]]) -> None:
+        with transaction.atomic():
+            # Always locked in the same order, so concurrent writers can not
+            # deadlock on each other's rollups
+            for key in sorted(durations):
+                resolution, state, status, bucket_start = key
+                duration_sum, durations_sketch = durations[key]
+                rollup, _ = cls.objects.select_for_update().get_or_create(
+                    resolution=resolution,
+                    state=state,
+                    status=status,
+                    bucket_start=bucket_start,
+                )
+
+                sketch = QuantileSketch.from_dict(rollup.sketch)
+                sketch.merge(durations_sketch)
+                rollup.count = sketch.count
+                rollup.duration_sum += duration_sum
+                rollup.sketch = sketch.to_dict()
+                rollup.save(
+                    update_fields=["count", "duration_sum", "sketch", "updated_at"]
+                )
+
+    # Merges the rollups of the stages that finished between `start` and `end`,
+    # widened to whole minutes. Whole hours are read from the hourly rollups and
+    # only the edges from the minute ones, so at most 118 minute rollups and one
+    # rollup per hour of the window are read, however long the history is.
+    @classmethod
+    def summarize(
+        cls,
+        state: OrderHandlingProcess.State,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        status: Optional[OrderHandlingProcess.Status] = None,
+    ) -> Tuple[float, QuantileSketch]:
+        start = cls.get_bucket_start(start, cls.Resolution.MINUTE)
+        end_minute = cls.get_bucket_start(end, cls.Resolution.MINUTE)
+        end = (
+            end_minute
+            if end_minute == end
+            else end_minute + datetime.timedelta(minutes=1)
+        )
+
+        first_hour = cls.get_bucket_start(start, cls.Resolution.HOUR)
+        if first_hour < start:
+            first_hour += datetime.timedelta(hours=1)
+        last_hour = cls.get_bucket_start(end, cls.Resolution.HOUR)
+
+        if first_hour < last_hour:
+            buckets = (
+                Q(
+                    resolution=cls.Resolution.HOUR,
+                    bucket_start__gte=first_hour,
+                    bucket_start__lt=last_hour,
+                )
+                | Q(
+                    resolution=cls.Resolution.MINUTE,
+                    bucket_start__gte=start,
+                    bucket_start__lt=first_hour,
+                )
+                | Q(
+                    resolution=cls.Resolution.MINUTE,
+                    bucket_start__gte=last_hour,
+                    bucket_start__lt=end,
+                )
+            )
+        else:
+            buckets = Q(
+                resolution=cls.Resolution.MINUTE,
+                bucket_start__gte=start,
+                bucket_start__lt=end,
+            )
+
+        rollups = cls.objects.filter(buckets, state=state)
+        if status is not None:
+            rollups = rollups.filter(status=status)
+
+        duration_sum = 0.0
+        sketch = QuantileSketch()
+        for rollup_sum, rollup_sketch in rollups.values_list("duration_sum", "sketch"):
+            duration_sum += rollup_sum
+            sketch.merge(QuantileSketch.from_dict(rollup_sketch))
+
+        return duration_sum, sketch
+
+    # Buckets are aligned in UTC, so hours are whole in every timezone
+    @classmethod
+    def get_bucket_start(
+        cls, at: datetime.datetime, resolution: "StageDurationRollup.Resolution"
+    ) -> datetime.datetime:
+        bucket_start = at.astimezone(datetime.timezone.utc).replace(
+            second=0, microsecond=0
+        )
+        if resolution == cls.Resolution.HOUR:
+            bucket_start = bucket_start.replace(minute=0)
+
+        return bucket_start
+
+    @classmethod
+    def purge(
+        cls,
+        older_than: datetime.timedelta,
+        resolution: Optional["StageDurationRollup.Resolution"] = None,
+    ) -> int:
+        rollups = cls.objects.filter(bucket_start__lt=now() - older_than)
+        if resolution is not None:
+            rollups = rollups.filter(resolution=resolution)
+
+        deleted, _ = rollups.delete()
+
+        return deleted
+
+
+# Deletes the rows of `model` with the given primary keys with a single DELETE.
+# Unlike QuerySet.delete() it neither fetches the rows nor cascades, and sends
+# no signals, so it is only safe for rows nothing references anymore.
+def _delete_rows(model: Type[models.Model], pks: List[Any]) -> None:
+    connection = connections[router.db_for_write(model)]
+    quote_name = connection.ops.quote_name
+    pk_field = model._meta.pk
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {quote_name(model._meta.db_table)} "
+            f"WHERE {quote_name(pk_field.column)} IN ({', '.join(['%s'] * len(pks))})",
+            [pk_field.get_db_prep_value(pk, connection) for pk in pks],
         )
 
 
@@ -181,16 +448,59 @@ class Order(BaseModel):
     currency_iso_code = models.TextField(max_length=3)
     placed_at = models.DateTimeField()
 
-    @classmethod
-    def generate_and_add_fake_orders(cls, to_generate: int) -> Result[List["Order"]]:
-        # do not play with me...
-        if to_generate <= 0:
-            to_generate = 1
+    # Set while a worker handles the order, see `claim`
+    claimed_by = models.CharField(max_length=100, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
 
-        fake_orders: List[OrderDefinition] = [
-            generate_order() for _ in range(to_generate)
+    class Meta:
+        indexes = [
+            # Supports the keyset pagination of the orders dashboard
+            models.Index(fields=["-placed_at", "-id"], name="order_placed_at_id_idx"),
         ]
 
+    # Counting the whole table gets slow as it grows, the dashboard is fine with
+    # a number that is up to ORDERS_COUNT_CACHE_TIMEOUT seconds old. The keys
+    # include a version, so all counts (whatever their filters) are invalidated
+    # at once by `invalidate_cached_counts`.
+    @classmethod
+    def get_cached_count(cls, **filters) -> int:
+        version = cache.get_or_set("orders_count_version", 1, timeout=None)
+        cache_key = f"orders_count:{version}"
+        if filters:
+            filters_hash = hashlib.md5(
+                json.dumps(filters, sort_keys=True, default=str).encode()
+            ).hexdigest()
+            cache_key = f"{cache_key}:{filters_hash}"
+
+        return cache.get_or_set(
+            cache_key,
+            cls.objects.filter(**filters).count,
+            timeout=settings.ORDERS_COUNT_CACHE_TIMEOUT,
+        )
+
+    @classmethod
+    def invalidate_cached_counts(cls) -> None:
+        try:
+            cache.incr("orders_count_version")
+        except ValueError:
+            # No count was cached yet
+            pass
+
+    @classmethod
+    def generate_and_add_fake_orders(
+        cls,
+        to_generate: int,
+        fake_orders: Optional[List[OrderDefinition]] = None,
+    ) -> Result[List["Order"]]:
+        # Already generated orders (e.g. from `generate_orders`) can be passed in,
+        # then only those are added
+        if fake_orders is None:
+            # do not play with me...
+            if to_generate <= 0:
+                to_generate = 1
+
+            fake_orders = [generate_order() for _ in range(to_generate)]
+
         orders: List[Order] = []
         created_orders: List[Order] = []
         order_items: List[OrderItem] = []
@@ -251,32 +561,209 @@ class Order(BaseModel):
                     )
                     continue
 
-        if orders:
-            created_orders = cls.objects.bulk_create(orders)
-            OrderItem.objects.bulk_create(order_items)
-            Customer.objects.bulk_create(customers)
-            OrderHandlingProcess.objects.bulk_create(order_handling_processes)
+            # All rows of the orders are written in a single transaction
+            if orders:
+                created_orders = cls.objects.bulk_create(orders)
+                OrderItem.objects.bulk_create(order_items)
+                Customer.objects.bulk_create(customers)
+                OrderHandlingProcess.objects.bulk_create(order_handling_processes)
 
         return Result(
             errors=failed,
             result=created_orders,
         )
 
+    # Deletes orders (with all their related rows) in chunks of `chunk_size`,
+    # each chunk in its own short transaction. Only the IDs of a chunk are
+    # loaded, the rows themselves are deleted with plain SQL DELETEs instead of
+    # going through Django's cascade collector. Orders a worker holds an active
+    # lease on are left alone.
     @classmethod
-    def send_back_tracking_number(cls, order: "Order", event_queue) -> bool:
-        started_at = now()
+    def purge(
+        cls,
+        older_than: Optional[datetime.timedelta] = None,
+        state: Optional["Order.State"] = None,
+        chunk_size: int = 1000,
+        pause: float = 0,
+        ids: Optional[Iterable[str]] = None,
+    ) -> int:
+        orders: QuerySet[Order] = cls.objects.all()
+        if ids is not None:
+            orders = orders.filter(id__in=list(ids))
+        if older_than is not None:
+            orders = orders.filter(created_at__lt=now() - older_than)
+        if state is not None:
+            orders = orders.filter(state=state)
+
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                # Locked (where supported), so they can not be claimed while
+                # they are being deleted
+                order_ids = list(
+                    orders.exclude(
+                        claimed_by__isnull=False, lease_expires_at__gt=now()
+                    )
+                    .select_for_update()
+                    .values_list("id", flat=True)[:chunk_size]
+                )
+                if len(order_ids) == 0:
+                    break
+
+                # The related models have no relations of their own, so their
+                # querysets are deleted with a single query without fetching
+                for related_model in (
+                    OrderHandlingProcess,
+                    OrderShipment,
+                    OrderItem,
+                    Customer,
+                ):
+                    related_model.objects.filter(order_id__in=order_ids).delete()
+
+                # Nothing references these orders anymore
+                _delete_rows(cls, order_ids)
+
+            deleted += len(order_ids)
+
+            # Gives the workers a chance to write in between the chunks
+            if pause > 0:
+                time.sleep(pause)
+
+        cls.invalidate_cached_counts()
+
+        return deleted
+
+    # Atomically claims the orders that are not claimed yet (or whose lease has
+    # expired) for ORDER_LEASE_SECONDS. Returns the claim token and the orders
+    # that were claimed, in the input order. Orders that were not claimed are
+    # being handled by someone else.
+    @classmethod
+    def claim(cls, orders: Iterable["Order"]) -> Tuple[str, List["Order"]]:
+        orders = list(orders)
+        token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}"
+        lease_expires_at = now() + datetime.timedelta(
+            seconds=settings.ORDER_LEASE_SECONDS
+        )
 
-        api_response: ApiResponse[None] = simulate_request(
-            data_callback=generate_order_shipment, allow_failure=True
+        claimed_count = (
+            cls.objects.filter(id__in=[order.id for order in orders])
+            .filter(Q(claimed_by__isnull=True) | Q(lease_expires_at__lt=now()))
+            .update(claimed_by=token, lease_expires_at=lease_expires_at)
         )
+        if claimed_count == 0:
+            return token, []
+
+        if claimed_count < len(orders):
+            claimed_ids = set(
+                cls.objects.filter(
+                    id__in=[order.id for order in orders], claimed_by=token
+                ).values_list("id", flat=True)
+            )
+            orders = [order for order in orders if order.id in claimed_ids]
 
-        error = None
-        if not order.shipment:
-            error = Error(message=f"Order with ID '{order.id}' does not have shipment.")
-        elif api_response.status_code != 200 and isinstance(
-            api_response.response, Error
+        for order in orders:
+            order.claimed_by = token
+            order.lease_expires_at = lease_expires_at
+
+        return token, orders
+
+    # Extends the lease of the orders still claimed with `token` and returns
+    # them. Orders whose lease expired and were claimed by someone else are left
+    # out and must not be handled any further.
+    @classmethod
+    def renew_lease(cls, token: str, orders: Iterable["Order"]) -> List["Order"]:
+        orders = list(orders)
+        lease_expires_at = now() + datetime.timedelta(
+            seconds=settings.ORDER_LEASE_SECONDS
+        )
+
+        renewed_count = cls.objects.filter(
+            id__in=[order.id for order in orders], claimed_by=token
+        ).update(lease_expires_at=lease_expires_at)
+
+        if renewed_count < len(orders):
+            renewed_ids = set(
+                cls.objects.filter(
+                    id__in=[order.id for order in orders], claimed_by=token
+                ).values_list("id", flat=True)
+            )
+            orders = [order for order in orders if order.id in renewed_ids]
+
+        for order in orders:
+            order.lease_expires_at = lease_expires_at
+
+        return orders
+
+    @classmethod
+    def release_claim(cls, token: str) -> None:
+        cls.objects.filter(claimed_by=token).update(
+            claimed_by=None, lease_expires_at=None
+        )
+
+    # Clears leases of workers that died (or got stuck) while handling orders
+    @classmethod
+    def release_expired_leases(cls) -> int:
+        return cls.objects.filter(lease_expires_at__lt=now()).update(
+            claimed_by=None, lease_expires_at=None
+        )
+
+    # Stages every order already went through successfully, read from its
+    # handling history. A saved shipment counts as a generated one even if its
+    # handling process was never written. Handling resumes after these stages
+    # instead of repeating requests that already succeeded.
+    @classmethod
+    def get_completed_stages(
+        cls, orders: Iterable["Order"]
+    ) -> Dict[uuid.UUID, Set[str]]:
+        orders = list(orders)
+        completed_stages: Dict[uuid.UUID, Set[str]] = {
+            order.id: set() for order in orders
+        }
+
+        succeeded_stages = (
+            OrderHandlingProcess.objects.filter(
+                order__in=orders,
+                status=OrderHandlingProcess.Status.SUCCEEDED,
+                state__in=[
+                    OrderHandlingProcess.State.GENERATING_SHIPMENT,
+                    OrderHandlingProcess.State.SENDING_TRACKING,
+                    OrderHandlingProcess.State.MARKING_AS_SHIPPED,
+                ],
+            )
+            .values_list("order_id", "state")
+            .distinct()
+        )
+        for order_id, state in succeeded_stages:
+            completed_stages[order_id].add(state)
+
+        for order_id in OrderShipment.objects.filter(order__in=orders).values_list(
+            "order_id", flat=True
         ):
-            error = api_response.response
+            completed_stages[order_id].add(
+                OrderHandlingProcess.State.GENERATING_SHIPMENT
+            )
+
+        return completed_stages
+
+    # Orders that failed in one of the stages and are not being handled (or
+    # retried) right now
+    @classmethod
+    def get_failed_orders(cls) -> QuerySet["Order"]:
+        return (
+            cls.objects.filter(
+                state=cls.State.SHIPPING,
+                claimed_by__isnull=True,
+                handling_processes__status=OrderHandlingProcess.Status.FAILED,
+            )
+            .distinct()
+            .order_by("-created_at")
+        )
+
+    @classmethod
+    def send_back_tracking_number(cls, order: "Order", event_queue) -> bool:
+        started_at = now()
+
+        error = cls.request_tracking_number_send_back(order, shipment=order.shipment)
 
         OrderHandlingProcess.update_processing(
             order=order,
@@ -290,17 +777,31 @@ class Order(BaseModel):
         return error == None
 
     @classmethod
-    def mark_order_as_shipped(cls, order: "Order", event_queue) -> bool:
-        started_at = now()
-
+    def request_tracking_number_send_back(
+        cls, order: "Order", shipment: Optional[OrderShipment]
+    ) -> Optional[Error]:
         api_response: ApiResponse[None] = simulate_request(
-            data_callback=None, allow_failure=True
+            data_callback=generate_order_shipment,
+            allow_failure=True,
+            endpoint=TRACKING_ENDPOINT,
         )
 
         error = None
-        if api_response.status_code != 200 and isinstance(api_response.response, Error):
+        if not shipment:
+            error = Error(message=f"Order with ID '{order.id}' does not have shipment.")
+        elif api_response.status_code != 200 and isinstance(
+            api_response.response, Error
+        ):
             error = api_response.response
 
+        return error
+
+    @classmethod
+    def mark_order_as_shipped(cls, order: "Order", event_queue) -> bool:
+        started_at = now()
+
+        error = cls.request_mark_as_shipped(order)
+
         OrderHandlingProcess.update_processing(
             order=order,
             state=OrderHandlingProcess.State.MARKING_AS_SHIPPED,
@@ -312,17 +813,42 @@ class Order(BaseModel):
 
         return error == None
 
+    @classmethod
+    def request_mark_as_shipped(cls, order: "Order") -> Optional[Error]:
+        api_response: ApiResponse[None] = simulate_request(
+            data_callback=None, allow_failure=True, endpoint=MARK_SHIPPED_ENDPOINT
+        )
+
+        error = None
+        if api_response.status_code != 200 and isinstance(api_response.response, Error):
+            error = api_response.response
+
+        return error
+
     @classmethod
     def get_latest_handling_process_for_each_order(
         cls, orders: Iterable["Order"]
     ) -> Dict["Order", Optional[OrderHandlingProcess]]:
+        orders = list(orders)
+
+        # Numbers the handling processes of every order from the newest one,
+        # so the latest processes of all orders are fetched with a single query.
+        # Processes created at the same instant tie on `created_at`, their time
+        # ordered IDs break the tie.
         handling_processes: QuerySet[OrderHandlingProcess] = (
             OrderHandlingProcess.objects.filter(order__in=orders)
-        )
-        order_latest_handling_processes = dict()
-        for order in orders:
-            order_latest_handling_processes[order] = (
-                handling_processes.filter(order=order).order_by("created_at").last()
+            .annotate(
+                row_number=Window(
+                    expression=RowNumber(),
+                    partition_by=F("order"),
+                    order_by=[F("created_at").desc(), F("id").desc()],
+                )
             )
+            .filter(row_number=1)
+        )
+        latest_handling_processes = {
+            handling_process.order_id: handling_process
+            for handling_process in handling_processes
+        }
 
-        return order_latest_handling_processes
+        return {order: latest_handling_processes.get(order.id) for order in orders}
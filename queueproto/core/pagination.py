@@ -0,0 +1,122 @@
+import base64
+import datetime
+import json
+from dataclasses import dataclass
+from typing import Generic, List, Optional, TypeVar
+
+from django.db.models import Model, Q, QuerySet
+
+T = TypeVar("T", bound=Model)
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+@dataclass
+class KeysetPage(Generic[T]):
+    object_list: List[T]
+    next_cursor: Optional[str]
+    previous_cursor: Optional[str]
+    # 1-based, carried along in the cursors
+    number: int = 1
+
+
+# Cursor based pagination over (`key_field`, id) in descending order. Every page
+# is fetched by seeking an index instead of scanning an OFFSET, so deep pages
+# cost the same as the first one. The cursors also carry the number of the page
+# they lead to, so it is known without counting the rows before the page.
+class KeysetPaginator(Generic[T]):
+    def __init__(self, queryset: QuerySet[T], per_page: int, key_field: str):
+        self._queryset = queryset
+        self._per_page = per_page
+        self._key_field = key_field
+
+    def get_page(self, cursor: Optional[str] = None) -> KeysetPage[T]:
+        if not cursor:
+            items = list(
+                self._queryset.order_by(f"-{self._key_field}", "-id")[
+                    : self._per_page + 1
+                ]
+            )
+            return KeysetPage(
+                object_list=items[: self._per_page],
+                next_cursor=(
+                    self._encode_cursor("next", items[self._per_page - 1], 2)
+                    if len(items) > self._per_page
+                    else None
+                ),
+                previous_cursor=None,
+            )
+
+        direction, key, id, number = self._decode_cursor(cursor)
+
+        if direction == "next":
+            items = list(
+                self._queryset.filter(
+                    Q(**{f"{self._key_field}__lt": key})
+                    | Q(**{self._key_field: key, "id__lt": id})
+                ).order_by(f"-{self._key_field}", "-id")[: self._per_page + 1]
+            )
+            has_more = len(items) > self._per_page
+            items = items[: self._per_page]
+
+            return KeysetPage(
+                object_list=items,
+                next_cursor=(
+                    self._encode_cursor("next", items[-1], number + 1)
+                    if has_more
+                    else None
+                ),
+                previous_cursor=(
+                    self._encode_cursor("previous", items[0], number - 1)
+                    if items
+                    else None
+                ),
+                number=number,
+            )
+
+        items = list(
+            self._queryset.filter(
+                Q(**{f"{self._key_field}__gt": key})
+                | Q(**{self._key_field: key, "id__gt": id})
+            ).order_by(self._key_field, "id")[: self._per_page + 1]
+        )
+        has_more = len(items) > self._per_page
+        items = list(reversed(items[: self._per_page]))
+
+        # Whether this is the first page is known for sure, the carried number
+        # is kept consistent with it (rows may have been added or deleted in
+        # front of the page since the cursor was made)
+        number = max(number, 2) if has_more else 1
+
+        return KeysetPage(
+            object_list=items,
+            next_cursor=(
+                self._encode_cursor("next", items[-1], number + 1) if items else None
+            ),
+            previous_cursor=(
+                self._encode_cursor("previous", items[0], number - 1)
+                if has_more
+                else None
+            ),
+            number=number,
+        )
+
+    def _encode_cursor(self, direction: str, item: T, number: int) -> str:
+        key: datetime.datetime = getattr(item, self._key_field)
+        value = json.dumps([direction, key.isoformat(), str(item.id), number])
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    def _decode_cursor(self, cursor: str):
+        try:
+            direction, key, id, number = json.loads(
+                base64.urlsafe_b64decode(cursor.encode())
+            )
+            if direction not in ("next", "previous"):
+                raise ValueError(f"Unknown direction `{direction}`")
+            if not isinstance(number, int) or number < 1:
+                raise ValueError(f"Invalid page number `{number}`")
+            return direction, datetime.datetime.fromisoformat(key), id, number
+        except Exception as e:
+            raise InvalidCursor(f"Invalid cursor: {e}")
@@ -0,0 +1,64 @@
+import bisect
+import hashlib
+from functools import lru_cache
+from typing import List, Dict, Iterable
+
+from django.conf import settings
+
+ORDER_PARTITION_QUEUE_PREFIX = "order_partition"
+
+
+# Consistent hash ring - every node is placed on the ring multiple times
+# (virtual nodes) so the keys are spread evenly, and adding a node only moves
+# roughly 1/N of the keys to the new node
+class HashRing:
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int = 128):
+        self._ring: List[int] = []
+        self._nodes: Dict[int, str] = dict()
+
+        for node in nodes:
+            for i in range(virtual_nodes):
+                point = self._hash(f"{node}#{i}")
+                self._nodes[point] = node
+                bisect.insort(self._ring, point)
+
+        if len(self._ring) == 0:
+            raise ValueError("Hash ring requires at least one node.")
+
+    def get_node(self, key: str) -> str:
+        index = bisect.bisect(self._ring, self._hash(key)) % len(self._ring)
+        return self._nodes[self._ring[index]]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+def get_partition_queues() -> List[str]:
+    return [
+        f"{ORDER_PARTITION_QUEUE_PREFIX}_{i}"
+        for i in range(max(1, settings.ORDER_QUEUE_PARTITIONS))
+    ]
+
+
+@lru_cache(maxsize=None)
+def _get_hash_ring(partitions: int) -> HashRing:
+    return HashRing(
+        nodes=[f"{ORDER_PARTITION_QUEUE_PREFIX}_{i}" for i in range(partitions)]
+    )
+
+
+def get_order_queue(order_id: str) -> str:
+    return _get_hash_ring(max(1, settings.ORDER_QUEUE_PARTITIONS)).get_node(
+        str(order_id)
+    )
+
+
+# Groups order IDs by their partition queue while keeping the original order of
+# the IDs within every partition
+def group_by_partition(order_ids: Iterable[str]) -> Dict[str, List[str]]:
+    partitions: Dict[str, List[str]] = dict()
+    for order_id in order_ids:
+        partitions.setdefault(get_order_queue(order_id), []).append(str(order_id))
+
+    return partitions
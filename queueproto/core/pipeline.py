@@ -0,0 +1,680 @@
+import time
+import uuid
+import datetime
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Dict, Set, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.timezone import now
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.utils.log import get_task_logger
+
+from core.models import Order, OrderShipment, OrderHandlingProcess
+from core.events import OrderProcessingEventQueue
+from core.buffers import get_handling_event_queue, write_handling_results
+from core.latency import SHIPMENT_ENDPOINT, TRACKING_ENDPOINT, MARK_SHIPPED_ENDPOINT
+from core.ratelimit import RateLimiter, RateLimited, ConcurrencyLimiter
+from core.stages import Stage, get_stages
+from core.definitions import Error
+
+logger = get_task_logger(__name__)
+
+
+# Outcome of handling a single order
+class HandlingOutcome(str, Enum):
+    HANDLED = "HANDLED"
+    # One of the stages failed, handling the order again resumes at that stage
+    FAILED = "FAILED"
+    # Already shipped, nothing left to do
+    SKIPPED = "SKIPPED"
+    # Claimed by another worker, handling the order later picks it up once the
+    # claim is released
+    BUSY = "BUSY"
+    # A rate limit was reached, handling the order later resumes at that stage
+    THROTTLED = "THROTTLED"
+    # A stage of the "staged" mode is done, the order moves on to the next stage
+    ADVANCED = "ADVANCED"
+
+
+def process_order(
+    order: Order, event_queue: OrderProcessingEventQueue
+) -> HandlingOutcome:
+    # Makes sure no other worker handles the same order at the same time
+    token, claimed_orders = Order.claim([order])
+    if len(claimed_orders) == 0:
+        logger.info(msg=f"Order `{order.id}` is already being handled, skipping it.")
+        return HandlingOutcome.BUSY
+
+    try:
+        return _process_claimed_order(order, token, event_queue)
+    except RateLimited:
+        enque_queued_event(order, event_queue)
+        raise
+    finally:
+        write_handling_results(event_queue, released_claims=[token])
+
+
+def _process_claimed_order(
+    order: Order, token: str, event_queue: OrderProcessingEventQueue
+) -> HandlingOutcome:
+    order.refresh_from_db(fields=["state"])
+    if order.state != Order.State.SHIPPING:
+        logger.info(msg=f"Order `{order.id}` was already handled, skipping it.")
+        enque_processed_event(order, event_queue)
+        return HandlingOutcome.SKIPPED
+
+    event_queue.enque_processing_status_event(
+        data={
+            "order_id": str(order.id),
+            "status": "PROCESSING",
+            "event": "updatedOrderProcessingStatus",
+        },
+    )
+
+    started_at = now()
+    completed_stages = Order.get_completed_stages([order])[order.id]
+
+    if OrderHandlingProcess.State.GENERATING_SHIPMENT not in completed_stages:
+        RateLimiter().acquire(SHIPMENT_ENDPOINT)
+        shipment: Optional[OrderShipment] = OrderShipment.create_shipment_for_order(
+            order,
+            event_queue,
+        )
+        if shipment is None:
+            enque_processed_event(order, event_queue)
+            return HandlingOutcome.FAILED
+
+    if not _renew_lease(order, token, event_queue):
+        return HandlingOutcome.FAILED
+
+    if OrderHandlingProcess.State.SENDING_TRACKING not in completed_stages:
+        RateLimiter().acquire(TRACKING_ENDPOINT, carrier=_get_carrier_code(order))
+        was_sent_back = Order.send_back_tracking_number(
+            order,
+            event_queue,
+        )
+        if not was_sent_back:
+            enque_processed_event(order, event_queue)
+            return HandlingOutcome.FAILED
+
+    if not _renew_lease(order, token, event_queue):
+        return HandlingOutcome.FAILED
+
+    if OrderHandlingProcess.State.MARKING_AS_SHIPPED not in completed_stages:
+        RateLimiter().acquire(MARK_SHIPPED_ENDPOINT)
+        was_marked_as_shipped = Order.mark_order_as_shipped(
+            order,
+            event_queue,
+        )
+        if not was_marked_as_shipped:
+            enque_processed_event(order, event_queue)
+            return HandlingOutcome.FAILED
+
+    _complete_order(order, started_at, event_queue)
+
+    return HandlingOutcome.HANDLED
+
+
+# Writes the HANDLED row once all the stages are done, and ships the order
+def _complete_order(
+    order: Order, started_at: datetime.datetime, event_queue: OrderProcessingEventQueue
+) -> None:
+    order.state = Order.State.SHIPPED
+    write_handling_results(
+        event_queue,
+        handling_processes=[
+            OrderHandlingProcess(
+                status=OrderHandlingProcess.Status.SUCCEEDED,
+                state=OrderHandlingProcess.State.HANDLED,
+                started_at=started_at,
+                finished_at=now(),
+                order=order,
+            )
+        ],
+        orders=[order],
+        events=[
+            {
+                "order_id": str(order.id),
+                "state": "HANDLED",
+                "status": "SUCCESS",
+                "event": "updatedOrderHandlingStatus",
+            },
+            {
+                "order_id": str(order.id),
+                "status": "PROCESSED",
+                "event": "updatedOrderProcessingStatus",
+            },
+            {
+                "order_id": str(order.id),
+                "status": "SHIPPED",
+                "event": "updatedOrderFulfillmentStatus",
+            },
+        ],
+    )
+
+
+# The lease is renewed before every stage. If it was lost in the meantime, the
+# order may have been taken over by another worker and must not be touched
+# anymore. It is reported as failed, so it is retried (and picked up again once
+# nobody holds it) instead of being left half handled.
+def _renew_lease(
+    order: Order, token: str, event_queue: OrderProcessingEventQueue
+) -> bool:
+    if len(Order.renew_lease(token, [order])) > 0:
+        return True
+
+    logger.error(msg=f"Lease of order `{order.id}` was lost, stopping its handling.")
+    enque_processed_event(order, event_queue)
+    return False
+
+
+# Keeps the lease of a batch alive while its stages run. Besides before every
+# stage, the lease is renewed whenever a third of ORDER_LEASE_SECONDS passed
+# since the last renewal, so it does not run out in the middle of a slow stage.
+# Orders whose lease was lost are marked as failed and left out of the batch.
+class _BatchLease:
+    def __init__(
+        self,
+        token: str,
+        event_queue: OrderProcessingEventQueue,
+        outcomes: Dict[str, HandlingOutcome],
+    ):
+        self._token = token
+        self._event_queue = event_queue
+        self._outcomes = outcomes
+        self._renewed_at = time.monotonic()
+        self._lost_ids: Set[uuid.UUID] = set()
+
+    # Returns the orders whose lease is still held
+    def renew(self, orders: List[Order]) -> List[Order]:
+        orders = self.held(orders)
+        renewed_ids = {order.id for order in Order.renew_lease(self._token, orders)}
+        self._renewed_at = time.monotonic()
+
+        for order in orders:
+            if order.id not in renewed_ids:
+                logger.error(
+                    msg=f"Lease of order `{order.id}` was lost, stopping its handling."
+                )
+                self._lost_ids.add(order.id)
+                self._outcomes[str(order.id)] = HandlingOutcome.FAILED
+                enque_processed_event(order, self._event_queue)
+
+        return self.held(orders)
+
+    def keep_alive(self, orders: List[Order]) -> None:
+        if time.monotonic() - self._renewed_at >= settings.ORDER_LEASE_SECONDS / 3:
+            self.renew(orders)
+
+    def is_held(self, order: Order) -> bool:
+        return order.id not in self._lost_ids
+
+    def held(self, orders: List[Order]) -> List[Order]:
+        return [order for order in orders if self.is_held(order)]
+
+
+def _get_carrier_code(order: Order) -> Optional[str]:
+    try:
+        return order.shipment.carrier_code
+    except OrderShipment.DoesNotExist:
+        return None
+
+
+# Throttled orders go back to waiting for their turn
+def enque_queued_event(order: Order, event_queue: OrderProcessingEventQueue) -> None:
+    event_queue.enque_processing_status_event(
+        data={
+            "order_id": str(order.id),
+            "status": "QUEUED",
+            "event": "updatedOrderProcessingStatus",
+        },
+    )
+
+
+def enque_processed_event(order: Order, event_queue: OrderProcessingEventQueue) -> None:
+    event_queue.enque_processing_status_event(
+        data={
+            "order_id": str(order.id),
+            "status": "PROCESSED",
+            "event": "updatedOrderProcessingStatus",
+        },
+    )
+
+
+def _process_order_in_thread(
+    order: Order, throttled: Dict[str, float]
+) -> HandlingOutcome:
+    try:
+        return process_order(order, get_handling_event_queue())
+    except RateLimited as e:
+        throttled[str(order.id)] = e.retry_after
+        return HandlingOutcome.THROTTLED
+    except Exception as e:
+        logger.error(msg=f"Error while handling order `{order.id}`: {e}")
+        return HandlingOutcome.FAILED
+    finally:
+        # Every thread gets its own database connection, make sure it does not leak
+        connection.close()
+
+
+# Keeps up to `max_in_flight` orders in flight at once. Every order still goes
+# through its stages one after another, only different orders overlap. Orders
+# that reached a rate limit are put in `throttled`, with the seconds to wait.
+def process_orders_concurrently(
+    orders: List[Order],
+    max_in_flight: int,
+    throttled: Optional[Dict[str, float]] = None,
+) -> List[HandlingOutcome]:
+    if len(orders) == 0:
+        return []
+
+    if throttled is None:
+        throttled = dict()
+
+    max_workers = max(1, min(max_in_flight, len(orders)))
+    with ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="order-pipeline"
+    ) as executor:
+        return list(
+            executor.map(
+                lambda order: _process_order_in_thread(order, throttled), orders
+            )
+        )
+
+
+# Runs the stages for a whole chunk of orders stage by stage, so every stage
+# persists its rows with bulk operations. Each order still receives exactly the
+# same sequence of events as in `process_order`, and every event is emitted
+# only once the rows it describes were written. Returns the outcome of every
+# order, in the input order. Orders that reached a rate limit are put in
+# `throttled`, with the seconds to wait.
+def process_orders_in_batch(
+    orders: List[Order],
+    event_queue: OrderProcessingEventQueue,
+    throttled: Optional[Dict[str, float]] = None,
+) -> List[HandlingOutcome]:
+    outcomes: Dict[str, HandlingOutcome] = {
+        str(order.id): HandlingOutcome.SKIPPED for order in orders
+    }
+    if throttled is None:
+        throttled = dict()
+
+    token, claimed_orders = Order.claim(orders)
+    claimed_ids = {order.id for order in claimed_orders}
+    for order in orders:
+        if order.id not in claimed_ids:
+            outcomes[str(order.id)] = HandlingOutcome.BUSY
+
+    try:
+        _process_claimed_orders_in_batch(
+            claimed_orders, token, event_queue, outcomes, throttled
+        )
+    finally:
+        Order.release_claim(token)
+
+    return [outcomes[str(order.id)] for order in orders]
+
+
+def _process_claimed_orders_in_batch(
+    orders: List[Order],
+    token: str,
+    event_queue: OrderProcessingEventQueue,
+    outcomes: Dict[str, HandlingOutcome],
+    throttled: Dict[str, float],
+) -> None:
+    shipped_ids = set(
+        Order.objects.filter(
+            id__in=[order.id for order in orders], state=Order.State.SHIPPED
+        ).values_list("id", flat=True)
+    )
+    for order in orders:
+        if order.id in shipped_ids:
+            logger.info(msg=f"Order `{order.id}` was already handled, skipping it.")
+            enque_processed_event(order, event_queue)
+    orders = [order for order in orders if order.id not in shipped_ids]
+
+    started_at: Dict[str, datetime.datetime] = dict()
+    for order in orders:
+        started_at[str(order.id)] = now()
+        event_queue.enque_processing_status_event(
+            data={
+                "order_id": str(order.id),
+                "status": "PROCESSING",
+                "event": "updatedOrderProcessingStatus",
+            },
+        )
+
+    completed_stages = Order.get_completed_stages(orders)
+    lease = _BatchLease(token, event_queue, outcomes)
+
+    # Generating shipments
+    shipments: Dict[str, OrderShipment] = {
+        str(shipment.order_id): shipment
+        for shipment in OrderShipment.objects.filter(order__in=orders)
+    }
+    new_shipments: List[OrderShipment] = []
+    stage_orders = _get_pending_orders(
+        orders, completed_stages, OrderHandlingProcess.State.GENERATING_SHIPMENT
+    )
+    orders, stage_orders = _acquire_batch_tokens(
+        orders, stage_orders, SHIPMENT_ENDPOINT, event_queue, outcomes, throttled
+    )
+    processed_orders: List[Order] = []
+    handling_processes: List[OrderHandlingProcess] = []
+    for order in stage_orders:
+        lease.keep_alive(orders)
+        if not lease.is_held(order):
+            continue
+
+        stage_started_at = now()
+        shipment, error = OrderShipment.request_shipment_for_order(order)
+        if shipment is not None:
+            shipments[str(order.id)] = shipment
+            new_shipments.append(shipment)
+
+        processed_orders.append(order)
+        handling_processes.append(
+            OrderHandlingProcess.build_processing(
+                order=order,
+                state=OrderHandlingProcess.State.GENERATING_SHIPMENT,
+                started_at=stage_started_at,
+                error=error,
+            )
+        )
+
+    with transaction.atomic():
+        OrderShipment.objects.bulk_create(new_shipments)
+        OrderHandlingProcess.bulk_save(handling_processes)
+    orders = _enque_batch_stage_events(
+        orders, processed_orders, handling_processes, event_queue, outcomes
+    )
+
+    # Sending tracking numbers back
+    orders = lease.renew(orders)
+    stage_orders = _get_pending_orders(
+        orders, completed_stages, OrderHandlingProcess.State.SENDING_TRACKING
+    )
+    orders, stage_orders = _acquire_batch_tokens(
+        orders,
+        stage_orders,
+        TRACKING_ENDPOINT,
+        event_queue,
+        outcomes,
+        throttled,
+        carriers={
+            order_id: shipment.carrier_code for order_id, shipment in shipments.items()
+        },
+    )
+    processed_orders = []
+    handling_processes = []
+    for order in stage_orders:
+        lease.keep_alive(orders)
+        if not lease.is_held(order):
+            continue
+
+        processed_orders.append(order)
+        handling_processes.append(
+            OrderHandlingProcess.build_processing(
+                order=order,
+                state=OrderHandlingProcess.State.SENDING_TRACKING,
+                started_at=now(),
+                error=Order.request_tracking_number_send_back(
+                    order, shipment=shipments.get(str(order.id))
+                ),
+            )
+        )
+    OrderHandlingProcess.bulk_save(handling_processes)
+    orders = _enque_batch_stage_events(
+        orders, processed_orders, handling_processes, event_queue, outcomes
+    )
+
+    # Marking orders as shipped
+    orders = lease.renew(orders)
+    stage_orders = _get_pending_orders(
+        orders, completed_stages, OrderHandlingProcess.State.MARKING_AS_SHIPPED
+    )
+    orders, stage_orders = _acquire_batch_tokens(
+        orders, stage_orders, MARK_SHIPPED_ENDPOINT, event_queue, outcomes, throttled
+    )
+    processed_orders = []
+    handling_processes = []
+    for order in stage_orders:
+        lease.keep_alive(orders)
+        if not lease.is_held(order):
+            continue
+
+        processed_orders.append(order)
+        handling_processes.append(
+            OrderHandlingProcess.build_processing(
+                order=order,
+                state=OrderHandlingProcess.State.MARKING_AS_SHIPPED,
+                started_at=now(),
+                error=Order.request_mark_as_shipped(order),
+            )
+        )
+    OrderHandlingProcess.bulk_save(handling_processes)
+    orders = _enque_batch_stage_events(
+        orders, processed_orders, handling_processes, event_queue, outcomes
+    )
+
+    if len(orders) == 0:
+        return
+
+    orders = lease.renew(orders)
+    if len(orders) == 0:
+        return
+
+    finished_at = now()
+    with transaction.atomic():
+        OrderHandlingProcess.bulk_save(
+            [
+                OrderHandlingProcess(
+                    status=OrderHandlingProcess.Status.SUCCEEDED,
+                    state=OrderHandlingProcess.State.HANDLED,
+                    started_at=started_at[str(order.id)],
+                    finished_at=finished_at,
+                    order=order,
+                )
+                for order in orders
+            ]
+        )
+        Order.objects.filter(id__in=[order.id for order in orders]).update(
+            state=Order.State.SHIPPED,
+            updated_at=finished_at,
+        )
+
+    for order in orders:
+        order.state = Order.State.SHIPPED
+        outcomes[str(order.id)] = HandlingOutcome.HANDLED
+        event_queue.enque_processing_status_event(
+            data={
+                "order_id": str(order.id),
+                "state": "HANDLED",
+                "status": "SUCCESS",
+                "event": "updatedOrderHandlingStatus",
+            },
+        )
+        enque_processed_event(order, event_queue)
+        event_queue.enque_processing_status_event(
+            data={
+                "order_id": str(order.id),
+                "status": "SHIPPED",
+                "event": "updatedOrderFulfillmentStatus",
+            },
+        )
+
+
+# Orders that did not go through `stage` successfully yet
+def _get_pending_orders(
+    orders: List[Order],
+    completed_stages: Dict[uuid.UUID, Set[str]],
+    stage: OrderHandlingProcess.State,
+) -> List[Order]:
+    return [order for order in orders if stage not in completed_stages[order.id]]
+
+
+# Takes a rate limit token for every order about to go through a stage. Orders
+# that reached the limit are left out of the rest of the batch, and are returned
+# to the queue.
+def _acquire_batch_tokens(
+    orders: List[Order],
+    stage_orders: List[Order],
+    endpoint: str,
+    event_queue: OrderProcessingEventQueue,
+    outcomes: Dict[str, HandlingOutcome],
+    throttled: Dict[str, float],
+    carriers: Optional[Dict[str, str]] = None,
+) -> Tuple[List[Order], List[Order]]:
+    throttled_ids = set()
+    for order in stage_orders:
+        try:
+            RateLimiter().acquire(
+                endpoint, carrier=(carriers or dict()).get(str(order.id))
+            )
+        except RateLimited as e:
+            throttled_ids.add(order.id)
+            throttled[str(order.id)] = e.retry_after
+            outcomes[str(order.id)] = HandlingOutcome.THROTTLED
+            enque_queued_event(order, event_queue)
+
+    if len(throttled_ids) == 0:
+        return orders, stage_orders
+
+    return (
+        [order for order in orders if order.id not in throttled_ids],
+        [order for order in stage_orders if order.id not in throttled_ids],
+    )
+
+
+# Emits the stage event of every order that went through the stage, and returns
+# the orders that can move on to the next stage. Orders whose stage failed are
+# marked as failed in `outcomes`.
+def _enque_batch_stage_events(
+    orders: List[Order],
+    stage_orders: List[Order],
+    handling_processes: List[OrderHandlingProcess],
+    event_queue: OrderProcessingEventQueue,
+    outcomes: Dict[str, HandlingOutcome],
+) -> List[Order]:
+    failed_ids = set()
+    for order, handling_process in zip(stage_orders, handling_processes):
+        event_queue.enque_processing_status_event(
+            data=handling_process.to_status_event(
+                event_name="updatedOrderHandlingStatus"
+            ),
+        )
+
+        if handling_process.status == OrderHandlingProcess.Status.FAILED:
+            failed_ids.add(order.id)
+            outcomes[str(order.id)] = HandlingOutcome.FAILED
+            enque_processed_event(order, event_queue)
+
+    return [order for order in orders if order.id not in failed_ids]
+
+
+# Runs a single stage of an order for the "staged" mode. Returns ADVANCED when
+# the order can be handed over to the next stage, and HANDLED once the last
+# stage is done and the order was shipped. `started_at` is when the order
+# entered its first stage.
+def process_order_stage(
+    order: Order,
+    stage: Stage,
+    event_queue: OrderProcessingEventQueue,
+    started_at: datetime.datetime,
+) -> HandlingOutcome:
+    token, claimed_orders = Order.claim([order])
+    if len(claimed_orders) == 0:
+        logger.info(msg=f"Order `{order.id}` is already being handled, skipping it.")
+        return HandlingOutcome.BUSY
+
+    try:
+        return _process_claimed_order_stage(order, stage, event_queue, started_at)
+    except RateLimited:
+        enque_queued_event(order, event_queue)
+        raise
+    except SoftTimeLimitExceeded:
+        # Out of time outside of the request itself (e.g. waiting for a slot or
+        # writing the results), the stage is failed and retried
+        logger.error(
+            msg=f"Stage `{stage.state}` of order `{order.id}` did not finish "
+            f"within {stage.timeout}s."
+        )
+        enque_processed_event(order, event_queue)
+        return HandlingOutcome.FAILED
+    finally:
+        write_handling_results(event_queue, released_claims=[token])
+
+
+def _process_claimed_order_stage(
+    order: Order,
+    stage: Stage,
+    event_queue: OrderProcessingEventQueue,
+    started_at: datetime.datetime,
+) -> HandlingOutcome:
+    order.refresh_from_db(fields=["state"])
+    if order.state != Order.State.SHIPPING:
+        logger.info(msg=f"Order `{order.id}` was already handled, skipping it.")
+        enque_processed_event(order, event_queue)
+        return HandlingOutcome.SKIPPED
+
+    stages = get_stages()
+    if stage.state == stages[0].state:
+        event_queue.enque_processing_status_event(
+            data={
+                "order_id": str(order.id),
+                "status": "PROCESSING",
+                "event": "updatedOrderProcessingStatus",
+            },
+        )
+
+    # Stages done by an earlier attempt are passed straight through
+    if stage.state not in Order.get_completed_stages([order])[order.id]:
+        error = _run_stage(order, stage, event_queue)
+        if error is not None:
+            enque_processed_event(order, event_queue)
+            return HandlingOutcome.FAILED
+
+    if stage.state != stages[-1].state:
+        return HandlingOutcome.ADVANCED
+
+    _complete_order(order, started_at, event_queue)
+
+    return HandlingOutcome.HANDLED
+
+
+def _run_stage(
+    order: Order, stage: Stage, event_queue: OrderProcessingEventQueue
+) -> Optional[Error]:
+    slot: Optional[str] = None
+    stage_started_at = now()
+    try:
+        if stage.concurrency > 0:
+            slot = ConcurrencyLimiter().acquire(
+                stage.queue, limit=stage.concurrency, lease_seconds=stage.timeout + 5
+            )
+
+        RateLimiter().acquire(
+            stage.endpoint,
+            carrier=_get_carrier_code(order) if stage.limit_by_carrier else None,
+        )
+
+        stage_started_at = now()
+        error = stage.request(order)
+    except SoftTimeLimitExceeded:
+        error = Error(message=f"Stage did not finish within {stage.timeout}s.")
+    finally:
+        if slot is not None:
+            ConcurrencyLimiter().release(stage.queue, slot)
+
+    OrderHandlingProcess.update_processing(
+        order=order,
+        state=stage.state,
+        started_at=stage_started_at,
+        event_queue=event_queue,
+        event_name="updatedOrderHandlingStatus",
+        error=error,
+    )
+
+    return error
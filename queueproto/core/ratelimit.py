@@ -0,0 +1,161 @@
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from core.events import Singleton
+
+# Token buckets of all the given keys are refilled, and tokens are only taken
+# when every bucket has one left - so a request never uses up the quota of one
+# limit while being rejected by another. Returns 0 when the tokens were taken,
+# otherwise the milliseconds until every bucket has a token again.
+#
+# KEYS - bucket keys, ARGV - rate (tokens per second) and capacity of every key
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local capacity = tonumber(ARGV[i * 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated_at')
+    local available = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+
+    available = math.min(capacity, available + math.max(0, now - updated_at) * rate / 1000)
+    tokens[i] = available
+    if available < 1 then
+        wait = math.max(wait, math.ceil((1 - available) * 1000 / rate))
+    end
+end
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local capacity = tonumber(ARGV[i * 2])
+    local available = tokens[i]
+    if wait == 0 then
+        available = available - 1
+    end
+
+    redis.call('HSET', key, 'tokens', tostring(available), 'updated_at', now)
+    redis.call('PEXPIRE', key, math.ceil(capacity * 1000 / rate) + 1000)
+end
+
+return wait
+"""
+
+# Counting semaphore with leases - expired leases (of workers that died while
+# holding them) are dropped first, and a new lease is only taken while fewer
+# than the limit are held. Returns 0 when the lease was taken, otherwise the
+# milliseconds until the oldest lease expires.
+#
+# KEYS - semaphore key, ARGV - limit, lease milliseconds and the lease token
+SEMAPHORE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local limit = tonumber(ARGV[1])
+local lease = tonumber(ARGV[2])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < limit then
+    redis.call('ZADD', KEYS[1], now + lease, ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], lease)
+    return 0
+end
+
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return math.max(1, tonumber(oldest[2]) - now)
+"""
+
+
+# Raised when a rate limit does not allow another request right now. The request
+# can be sent again in `retry_after` seconds.
+class RateLimited(Exception):
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(
+            f"Rate limit of `{endpoint}` reached, retry in {retry_after:.3f}s."
+        )
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+# Token buckets shared by all the workers through redis. The limits are
+# configured in API_RATE_LIMITS as `{"<endpoint>": [rate, burst]}` and
+# `{"<endpoint>:<carrier code>": [rate, burst]}`, where rate is the number of
+# requests per second and burst the number of requests that can be sent at once.
+class RateLimiter(metaclass=Singleton):
+    def __init__(self):
+        self._key_prefix = "rate_limit"
+        self._connection = get_redis_connection("default")
+        self._script = self._connection.register_script(TOKEN_BUCKET_SCRIPT)
+
+    # Takes a token for a request to `endpoint` (and to the carrier, if given),
+    # or raises RateLimited when there is none left
+    def acquire(self, endpoint: str, carrier: Optional[str] = None) -> None:
+        limits = get_rate_limits(endpoint, carrier)
+        if len(limits) == 0:
+            return
+
+        keys: List[str] = []
+        args: List[float] = []
+        for name, (rate, burst) in limits:
+            keys.append(f"{self._key_prefix}:{name}")
+            args.extend([rate, burst])
+
+        wait_ms = int(self._script(keys=keys, args=args))
+        if wait_ms > 0:
+            raise RateLimited(endpoint=endpoint, retry_after=wait_ms / 1000)
+
+
+def get_rate_limits(
+    endpoint: str, carrier: Optional[str] = None
+) -> List[Tuple[str, Tuple[float, float]]]:
+    configured: Dict[str, List[float]] = settings.API_RATE_LIMITS
+
+    names = [endpoint]
+    if carrier:
+        names.append(f"{endpoint}:{carrier}")
+
+    return [
+        (name, (float(configured[name][0]), float(configured[name][1])))
+        for name in names
+        if name in configured
+    ]
+
+
+# Limits how many requests are in flight at once across all the workers. The
+# leases expire after `lease_seconds`, so the slots of dead workers come back.
+class ConcurrencyLimiter(metaclass=Singleton):
+    def __init__(self):
+        self._key_prefix = "concurrency_limit"
+        # Slots are usually freed long before the oldest lease expires
+        self._max_retry_after = 0.5
+        self._connection = get_redis_connection("default")
+        self._script = self._connection.register_script(SEMAPHORE_SCRIPT)
+
+    # Takes one of the `limit` slots of `name` and returns its token, or raises
+    # RateLimited when all of them are taken
+    def acquire(self, name: str, limit: int, lease_seconds: float) -> str:
+        token = uuid.uuid4().hex
+        wait_ms = int(
+            self._script(
+                keys=[self.key(name)],
+                args=[limit, int(lease_seconds * 1000), token],
+            )
+        )
+        if wait_ms > 0:
+            raise RateLimited(
+                endpoint=name,
+                retry_after=min(wait_ms / 1000, self._max_retry_after),
+            )
+
+        return token
+
+    def release(self, name: str, token: str) -> None:
+        self._connection.zrem(self.key(name), token)
+
+    def key(self, name: str) -> str:
+        return f"{self._key_prefix}:{name}"
@@ -0,0 +1,95 @@
+import math
+from typing import Any, Dict, Optional
+
+
+# Quantile sketch with relative error guarantees (DDSketch). Values are counted
+# in logarithmically sized bins, so any quantile is estimated within
+# `relative_accuracy` of the real value, no matter how many values were added.
+# Two sketches are merged by adding up their bins, which makes them suitable
+# for rollups - a sketch of an hour is the merge of the sketches of its minutes.
+class QuantileSketch:
+    def __init__(
+        self,
+        relative_accuracy: float = 0.01,
+        max_bins: int = 2048,
+        min_value: float = 1e-6,
+    ):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.min_value = min_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+
+        self.bins: Dict[int, int] = dict()
+        # Values too small to be binned (e.g. zero durations)
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float, count: int = 1) -> None:
+        self.count += count
+        if value <= self.min_value:
+            self.zero_count += count
+            return
+
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + count
+        self._collapse()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same accuracy can be merged.")
+
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self._collapse()
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                # Middle of the bin, in relative terms
+                return 2 * self._gamma**index / (self._gamma + 1)
+
+        return 2 * self._gamma ** max(self.bins) / (self._gamma + 1)
+
+    # Keeps the sketch bounded by merging the lowest bins - only the accuracy
+    # of the lowest quantiles suffers
+    def _collapse(self) -> None:
+        if len(self.bins) <= self.max_bins:
+            return
+
+        indexes = sorted(self.bins)
+        to_collapse = indexes[: len(indexes) - self.max_bins + 1]
+        collapsed_count = sum(self.bins.pop(index) for index in to_collapse)
+        target = to_collapse[-1]
+        self.bins[target] = self.bins.get(target, 0) + collapsed_count
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "bins": {str(index): count for index, count in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "QuantileSketch":
+        if not data:
+            return cls()
+
+        sketch = cls(relative_accuracy=data["relative_accuracy"])
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.bins = {int(index): count for index, count in data["bins"].items()}
+
+        return sketch
@@ -0,0 +1,110 @@
+import dataclasses
+from typing import Callable, List, Optional
+
+from django.conf import settings
+
+from core.models import Order, OrderShipment, OrderHandlingProcess
+from core.definitions import Error
+from core.latency import SHIPMENT_ENDPOINT, TRACKING_ENDPOINT, MARK_SHIPPED_ENDPOINT
+
+
+# A stage of the "staged" handling mode. Every stage is consumed from its own
+# queue, so a slow stage only backs up its own queue, and its workers can be
+# scaled independently of the other stages.
+@dataclasses.dataclass(frozen=True)
+class Stage:
+    state: OrderHandlingProcess.State
+    # Sends the request of the stage, returns the error if it failed
+    request: Callable[[Order], Optional[Error]]
+    # Rate limited endpoint, see API_RATE_LIMITS
+    endpoint: str
+    queue: str
+    # Orders in the stage at once across all workers, 0 for no limit
+    concurrency: int
+    # Seconds after which the stage is failed
+    timeout: float
+    # Whether the rate limits of the carrier of the order apply too
+    limit_by_carrier: bool = False
+
+
+def _request_shipment(order: Order) -> Optional[Error]:
+    shipment, error = OrderShipment.request_shipment_for_order(order)
+    if shipment is not None:
+        shipment.save()
+
+    return error
+
+
+def _request_tracking_number_send_back(order: Order) -> Optional[Error]:
+    try:
+        shipment: Optional[OrderShipment] = order.shipment
+    except OrderShipment.DoesNotExist:
+        shipment = None
+
+    return Order.request_tracking_number_send_back(order, shipment=shipment)
+
+
+# In the order they are handled in
+STAGES: List[Stage] = [
+    Stage(
+        state=OrderHandlingProcess.State.GENERATING_SHIPMENT,
+        request=_request_shipment,
+        endpoint=SHIPMENT_ENDPOINT,
+        queue="order_stage_shipment",
+        concurrency=8,
+        timeout=30,
+    ),
+    Stage(
+        state=OrderHandlingProcess.State.SENDING_TRACKING,
+        request=_request_tracking_number_send_back,
+        endpoint=TRACKING_ENDPOINT,
+        queue="order_stage_tracking",
+        concurrency=4,
+        timeout=15,
+        limit_by_carrier=True,
+    ),
+    Stage(
+        state=OrderHandlingProcess.State.MARKING_AS_SHIPPED,
+        request=Order.request_mark_as_shipped,
+        endpoint=MARK_SHIPPED_ENDPOINT,
+        queue="order_stage_mark_shipped",
+        concurrency=4,
+        timeout=15,
+    ),
+]
+
+
+# The stages with the overrides of ORDER_STAGES applied
+def get_stages() -> List[Stage]:
+    overrides = settings.ORDER_STAGES
+
+    return [
+        dataclasses.replace(
+            stage,
+            **{
+                field: value
+                for field, value in overrides.get(stage.state.value, dict()).items()
+                if field in ("queue", "concurrency", "timeout")
+            },
+        )
+        for stage in STAGES
+    ]
+
+
+def get_stage(state: str) -> Stage:
+    for stage in get_stages():
+        if stage.state == state:
+            return stage
+
+    raise ValueError(f"Order handling has no stage `{state}`.")
+
+
+def get_next_stage(stage: Stage) -> Optional[Stage]:
+    stages = get_stages()
+    index = [s.state for s in stages].index(stage.state)
+
+    return stages[index + 1] if index + 1 < len(stages) else None
+
+
+def get_stage_queues() -> List[str]:
+    return [stage.queue for stage in get_stages()]
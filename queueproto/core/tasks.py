@@ -1,26 +1,225 @@
-from typing import List, Optional
+import time
+import random
+import datetime
+from typing import Dict, List, NoReturn, Optional, Set
 
-from django.utils.timezone import now
+from django.conf import settings
 from django.db.models import QuerySet
-from celery import shared_task
+from django.utils.timezone import now
+from celery import Task, shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import (
+    task_postrun,
+    task_prerun,
+    worker_process_shutdown,
+    worker_shutdown,
+)
 from celery.utils.log import get_task_logger
+from celery.utils.time import get_exponential_backoff_interval
 
-from core.models import Order, OrderShipment, OrderHandlingProcess
+from core.models import Order, StageDurationRollup
 from core.events import OrderProcessingEventQueue
+from core.partitions import group_by_partition
+from core.ratelimit import RateLimited
+from core.dedupe import OrderHandlingLocks
+from core.metrics import (
+    MetricsRegistry,
+    ORDER_TASK_DURATION,
+    ORDERS_FAILED,
+    ORDERS_PROCESSED,
+    ORDERS_QUEUED,
+)
+from core.buffers import (
+    OrderHandlingWriteBuffer,
+    StageDurationRollupBuffer,
+    get_handling_event_queue,
+)
+from core.pipeline import (
+    HandlingOutcome,
+    process_order,
+    process_orders_concurrently,
+    process_orders_in_batch,
+    process_order_stage,
+)
+from core.stages import Stage, get_stage, get_stages, get_next_stage
 
 logger = get_task_logger(__name__)
 
 
-@shared_task(queue="single_worker_queue")
+# Raised by the handling tasks when a stage of some of their orders failed and
+# they are out of retries
+class OrderHandlingFailed(Exception):
+    pass
+
+
+def get_failed_order_ids(
+    order_ids: List[str], outcomes: List[HandlingOutcome]
+) -> List[str]:
+    return [
+        order_id
+        for order_id, outcome in zip(order_ids, outcomes)
+        if outcome == HandlingOutcome.FAILED
+    ]
+
+
+# Retries a handling task with exponential backoff and full jitter. Only the
+# failed orders are passed on, and the retry resumes them at the stage they
+# failed in.
+def retry_order_handling(task: Task, args: list, failed_ids: List[str]) -> NoReturn:
+    flush_handling_results()
+    if task.request.retries >= settings.ORDER_HANDLING_MAX_RETRIES:
+        # Out of retries, so the orders can be queued again
+        OrderHandlingLocks().release(failed_ids)
+
+    raise task.retry(
+        args=args,
+        countdown=get_exponential_backoff_interval(
+            factor=settings.ORDER_HANDLING_RETRY_BACKOFF,
+            retries=task.request.retries,
+            maximum=settings.ORDER_HANDLING_RETRY_BACKOFF_MAX,
+            full_jitter=True,
+        ),
+        max_retries=settings.ORDER_HANDLING_MAX_RETRIES,
+        exc=OrderHandlingFailed(
+            f"Handling of {len(failed_ids)} orders failed: {', '.join(failed_ids)}"
+        ),
+    )
+
+
+# Sends a handling task again once the rate limit allows it. Unlike a retry this
+# does not count against the retries of the task, and the worker is free to
+# handle other orders in the meantime. The countdown is slightly jittered, so
+# throttled tasks do not all come back at the same moment.
+# It is sent as a new task (with a new ID), on the queue the task came from and
+# with its time limits.
+def reschedule_order_handling(task: Task, args: list, retry_after: float) -> None:
+    flush_handling_results()
+    countdown = retry_after * (1 + random.random() * 0.2)
+    if task.request.is_eager:
+        # Eager tasks would run again right away
+        time.sleep(countdown)
+
+    options = dict()
+    queue = (task.request.delivery_info or dict()).get("routing_key")
+    if queue:
+        options["queue"] = queue
+    time_limit, soft_time_limit = task.request.timelimit or (None, None)
+    if time_limit:
+        options["time_limit"] = time_limit
+    if soft_time_limit:
+        options["soft_time_limit"] = soft_time_limit
+
+    task.s(*args).apply_async(countdown=countdown, **options)
+
+
+# With write-behind the claims of the orders are only released by the next
+# flush. Orders are handled again (or by the next stage) right after this, so
+# the claims must be released first, or the orders would be seen as claimed by
+# another worker.
+def flush_handling_results() -> None:
+    if settings.ORDER_HANDLING_WRITE_BEHIND:
+        OrderHandlingWriteBuffer().flush()
+
+
+# Orders claimed by another worker are sent again a bit later. They keep their
+# dedupe locks, as they are still being handled.
+def reschedule_busy_orders(
+    order_ids: List[str], outcomes: List[HandlingOutcome], throttled: Dict[str, float]
+) -> None:
+    for order_id, outcome in zip(order_ids, outcomes):
+        if outcome == HandlingOutcome.BUSY:
+            throttled.setdefault(order_id, settings.ORDER_HANDLING_RETRY_BACKOFF)
+
+
+# Rows still waiting in the write-behind buffer must not be lost when a worker
+# goes down
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_order_handling_write_buffer(**kwargs) -> None:
+    if settings.ORDER_HANDLING_WRITE_BEHIND:
+        OrderHandlingWriteBuffer().flush()
+
+    StageDurationRollupBuffer().flush()
+    MetricsRegistry().flush()
+
+
+_task_started_at: Dict[str, float] = dict()
+
+
+@task_prerun.connect
+def start_task_timer(task_id: str, **kwargs) -> None:
+    _task_started_at[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def record_task_duration(task_id: str, task: Task, state: str, **kwargs) -> None:
+    started_at = _task_started_at.pop(task_id, None)
+    if started_at is not None:
+        ORDER_TASK_DURATION.observe(
+            time.perf_counter() - started_at,
+            task=task.name.rsplit(".", 1)[-1],
+            state=state or "",
+        )
+
+
+def record_handling_outcomes(outcomes: List[HandlingOutcome]) -> None:
+    handled = sum(1 for outcome in outcomes if outcome == HandlingOutcome.HANDLED)
+    failed = sum(1 for outcome in outcomes if outcome == HandlingOutcome.FAILED)
+    if handled > 0:
+        ORDERS_PROCESSED.inc(handled)
+    if failed > 0:
+        ORDERS_FAILED.inc(failed)
+
+
+# Orders that were handled (or did not need handling) can be queued again.
+# Failed and throttled orders are still on their way.
+def release_finished_orders(
+    order_ids: List[str], outcomes: List[HandlingOutcome]
+) -> None:
+    OrderHandlingLocks().release(
+        order_id
+        for order_id, outcome in zip(order_ids, outcomes)
+        if outcome in (HandlingOutcome.HANDLED, HandlingOutcome.SKIPPED)
+    )
+
+
+@shared_task(queue="single_worker_queue", ignore_result=True)
 def handle_orders(order_ids: List[str]) -> None:
     if len(order_ids) == 0:
         logger.error(msg="No order IDs were passed to handle orders function.")
         return
 
+    # Orders that are already queued or being handled are skipped before
+    # anything else is done with them
+    locked_ids = OrderHandlingLocks().acquire(order_ids)
+    skipped = len(set(map(str, order_ids))) - len(locked_ids)
+    if skipped > 0:
+        logger.info(
+            msg=f"Skipping {skipped} orders that are already queued or being handled."
+        )
+    if len(locked_ids) == 0:
+        return
+
+    # Orders that were not handed over to a worker by the time anything fails
+    # can be queued again right away, instead of once their locks expired
+    dispatched_ids: Set[str] = set()
+    try:
+        queue_locked_orders(locked_ids, dispatched_ids)
+    except Exception:
+        OrderHandlingLocks().release(set(locked_ids) - dispatched_ids)
+        raise
+
+
+# Emits the QUEUED events of the locked orders and dispatches them to their
+# partition queues, adding the IDs of the dispatched orders to `dispatched_ids`
+def queue_locked_orders(locked_ids: List[str], dispatched_ids: Set[str]) -> None:
     # Order the elements in the same way they are getting displayed on the frontend
-    orders: QuerySet[Order] = Order.objects.filter(id__in=order_ids).order_by(
+    orders: QuerySet[Order] = Order.objects.filter(id__in=locked_ids).order_by(
         "-created_at"
     )
+    missing_ids = set(locked_ids) - {str(order.id) for order in orders}
+    if len(missing_ids) > 0:
+        OrderHandlingLocks().release(missing_ids)
     if len(orders) == 0:
         logger.error(msg="No orders were found for the provided IDs")
         return
@@ -35,105 +234,251 @@ def handle_orders(order_ids: List[str]) -> None:
             },
         )
 
-    for order in orders:
-        handle_order.delay(order.id)
+    ORDERS_QUEUED.inc(len(orders))
+
+    # Every order always lands on the same partition queue, and every partition
+    # is consumed by a single worker, so an order is never handled by two
+    # workers at the same time
+    partitions = group_by_partition(str(order.id) for order in orders)
+    for queue, partition_order_ids in partitions.items():
+        dispatch_partition(queue=queue, order_ids=partition_order_ids)
+        dispatched_ids.update(partition_order_ids)
+
+
+def dispatch_partition(queue: str, order_ids: List[str]) -> None:
+    if settings.ORDER_HANDLING_MODE == "concurrent":
+        handle_orders_concurrently.apply_async(args=[order_ids], queue=queue)
+        return
+
+    if settings.ORDER_HANDLING_MODE == "batch":
+        batch_size = max(1, settings.ORDER_HANDLING_BATCH_SIZE)
+        for i in range(0, len(order_ids), batch_size):
+            handle_orders_batch.apply_async(
+                args=[order_ids[i : i + batch_size]], queue=queue
+            )
+        return
+
+    if settings.ORDER_HANDLING_MODE == "staged":
+        # Stages have queues of their own, the partitions do not apply
+        for order_id in order_ids:
+            dispatch_order_stage(order_id, stage=get_stages()[0])
+        return
+
+    for order_id in order_ids:
+        handle_order.apply_async(args=[order_id], queue=queue)
 
 
-@shared_task(queue="single_worker_queue")
-def handle_order(order_id: str) -> None:
+# The order is claimed by every stage, so the stages of an order never run at
+# the same time even though they are consumed by different workers
+def dispatch_order_stage(
+    order_id: str, stage: Stage, started_at: Optional[str] = None
+) -> None:
+    handle_order_stage.apply_async(
+        args=[order_id, stage.state.value, started_at],
+        queue=stage.queue,
+        soft_time_limit=stage.timeout,
+        time_limit=stage.timeout + 5,
+    )
+
+
+@shared_task(bind=True, queue="order_partition_0", ignore_result=True)
+def handle_order(self: Task, order_id: str) -> None:
     try:
         order: Order = Order.objects.get(id=order_id)
     except Order.DoesNotExist:
         logger.error(
             msg=f"Error while handling order: order with ID `{order_id}` does not exist."
         )
+        OrderHandlingLocks().release([order_id])
         return
 
-    event_queue = OrderProcessingEventQueue()
-    event_queue.enque_processing_status_event(
-        data={
-            "order_id": str(order.id),
-            "status": "PROCESSING",
-            "event": "updatedOrderProcessingStatus",
-        },
-    )
+    try:
+        outcome = process_order(order, get_handling_event_queue())
+    except RateLimited as e:
+        reschedule_order_handling(self, args=[order_id], retry_after=e.retry_after)
+        return
+
+    if outcome == HandlingOutcome.BUSY:
+        reschedule_order_handling(
+            self, args=[order_id], retry_after=settings.ORDER_HANDLING_RETRY_BACKOFF
+        )
+        return
 
-    started_at = now()
+    record_handling_outcomes([outcome])
+    release_finished_orders([order_id], [outcome])
+    if outcome == HandlingOutcome.FAILED:
+        retry_order_handling(self, args=[order_id], failed_ids=[order_id])
 
-    shipment: Optional[OrderShipment] = OrderShipment.create_shipment_for_order(
-        order,
-        event_queue,
+
+@shared_task(bind=True, queue="order_partition_0", ignore_result=True)
+def handle_orders_concurrently(self: Task, order_ids: List[str]) -> None:
+    orders: List[Order] = list(
+        Order.objects.filter(id__in=order_ids).order_by("-created_at")
     )
-    if shipment is None:
-        event_queue.enque_processing_status_event(
-            data={
-                "order_id": str(order.id),
-                "status": "PROCESSED",
-                "event": "updatedOrderProcessingStatus",
-            },
-        )
+    if len(orders) == 0:
+        logger.error(msg="No orders were found for the provided IDs")
+        OrderHandlingLocks().release(order_ids)
         return
 
-    was_sent_back = Order.send_back_tracking_number(
-        order,
-        event_queue,
+    throttled: Dict[str, float] = dict()
+    outcomes = process_orders_concurrently(
+        orders=orders,
+        max_in_flight=settings.ORDER_HANDLING_MAX_IN_FLIGHT,
+        throttled=throttled,
     )
-    if not was_sent_back:
-        event_queue.enque_processing_status_event(
-            data={
-                "order_id": str(order.id),
-                "status": "PROCESSED",
-                "event": "updatedOrderProcessingStatus",
-            },
+    record_handling_outcomes(outcomes)
+    release_finished_orders([str(order.id) for order in orders], outcomes)
+    reschedule_busy_orders([str(order.id) for order in orders], outcomes, throttled)
+    if len(throttled) > 0:
+        reschedule_order_handling(
+            self, args=[list(throttled)], retry_after=max(throttled.values())
         )
+
+    failed_ids = get_failed_order_ids([str(order.id) for order in orders], outcomes)
+    if len(failed_ids) > 0:
+        retry_order_handling(self, args=[failed_ids], failed_ids=failed_ids)
+
+
+@shared_task(bind=True, queue="order_partition_0", ignore_result=True)
+def handle_orders_batch(self: Task, order_ids: List[str]) -> None:
+    orders: List[Order] = list(
+        Order.objects.filter(id__in=order_ids).order_by("-created_at")
+    )
+    if len(orders) == 0:
+        logger.error(msg="No orders were found for the provided IDs")
+        OrderHandlingLocks().release(order_ids)
         return
 
-    was_marked_as_shipped = Order.mark_order_as_shipped(
-        order,
-        event_queue,
+    throttled: Dict[str, float] = dict()
+    outcomes = process_orders_in_batch(
+        orders, OrderProcessingEventQueue(), throttled=throttled
     )
-    if not was_marked_as_shipped:
-        event_queue.enque_processing_status_event(
-            data={
-                "order_id": str(order.id),
-                "status": "PROCESSED",
-                "event": "updatedOrderProcessingStatus",
-            },
+    record_handling_outcomes(outcomes)
+    release_finished_orders([str(order.id) for order in orders], outcomes)
+    reschedule_busy_orders([str(order.id) for order in orders], outcomes, throttled)
+    if len(throttled) > 0:
+        reschedule_order_handling(
+            self, args=[list(throttled)], retry_after=max(throttled.values())
+        )
+
+    failed_ids = get_failed_order_ids([str(order.id) for order in orders], outcomes)
+    if len(failed_ids) > 0:
+        retry_order_handling(self, args=[failed_ids], failed_ids=failed_ids)
+
+
+# Runs one stage of an order in the "staged" mode and hands the order over to
+# the next stage. Retries and rescheduling only repeat this stage. A worker
+# killed by the hard time limit puts the task back on its queue, the order is
+# then handled again once the lease of its claim expired.
+@shared_task(bind=True, ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def handle_order_stage(
+    self: Task, order_id: str, state: str, started_at: Optional[str] = None
+) -> None:
+    try:
+        order: Order = Order.objects.get(id=order_id)
+    except Order.DoesNotExist:
+        logger.error(
+            msg=f"Error while handling order: order with ID `{order_id}` does not exist."
         )
+        OrderHandlingLocks().release([order_id])
         return
 
-    event_queue.enque_processing_status_event(
-        data={
-            "order_id": str(order.id),
-            "state": "HANDLED",
-            "status": "SUCCESS",
-            "event": "updatedOrderHandlingStatus",
-        },
-    )
+    stage = get_stage(state)
+    started_at = started_at or now().isoformat()
+    try:
+        outcome = process_order_stage(
+            order,
+            stage,
+            get_handling_event_queue(),
+            started_at=datetime.datetime.fromisoformat(started_at),
+        )
+    except RateLimited as e:
+        reschedule_order_handling(
+            self, args=[order_id, state, started_at], retry_after=e.retry_after
+        )
+        return
+    except SoftTimeLimitExceeded:
+        # Out of time before the order was claimed
+        outcome = HandlingOutcome.FAILED
+
+    if outcome == HandlingOutcome.BUSY:
+        reschedule_order_handling(
+            self,
+            args=[order_id, state, started_at],
+            retry_after=settings.ORDER_HANDLING_RETRY_BACKOFF,
+        )
+        return
+
+    if outcome == HandlingOutcome.ADVANCED:
+        flush_handling_results()
+        dispatch_order_stage(order_id, get_next_stage(stage), started_at=started_at)
+        return
+
+    record_handling_outcomes([outcome])
+    release_finished_orders([order_id], [outcome])
+    if outcome == HandlingOutcome.FAILED:
+        retry_order_handling(
+            self, args=[order_id, state, started_at], failed_ids=[order_id]
+        )
 
-    event_queue.enque_processing_status_event(
-        data={
-            "order_id": str(order.id),
-            "status": "PROCESSED",
-            "event": "updatedOrderProcessingStatus",
-        },
-    )
 
-    event_queue.enque_processing_status_event(
-        data={
-            "order_id": str(order.id),
-            "status": "SHIPPED",
-            "event": "updatedOrderFulfillmentStatus",
-        },
+# Hands every order that failed in one of the stages over to handling again. The
+# orders are resumed at the stage they failed in.
+@shared_task(queue="single_worker_queue", ignore_result=True)
+def retry_failed_orders(chunk_size: int = 1000) -> None:
+    order_ids = [
+        str(order_id)
+        for order_id in Order.get_failed_orders().values_list("id", flat=True)
+    ]
+    logger.info(msg=f"Retrying {len(order_ids)} failed orders.")
+
+    for i in range(0, len(order_ids), chunk_size):
+        handle_orders(order_ids=order_ids[i : i + chunk_size])
+
+
+# Meant to be scheduled periodically from celery-beat, e.g. with kwargs
+# {"older_than_seconds": 2592000, "state": "SHIPPED"}. Runs on its own queue so
+# it never holds up the order handling workers.
+@shared_task(queue="maintenance_queue", ignore_result=True)
+def purge_orders(
+    older_than_seconds: Optional[int] = None,
+    state: Optional[str] = None,
+    chunk_size: int = 1000,
+) -> None:
+    deleted = Order.purge(
+        older_than=(
+            datetime.timedelta(seconds=older_than_seconds)
+            if older_than_seconds is not None
+            else None
+        ),
+        state=state,
+        chunk_size=chunk_size,
+        pause=settings.ORDER_PURGE_CHUNK_PAUSE,
     )
 
-    OrderHandlingProcess.objects.create(
-        status=OrderHandlingProcess.Status.SUCCEEDED,
-        state=OrderHandlingProcess.State.HANDLED,
-        started_at=started_at,
-        finished_at=now(),
-        order=order,
+    logger.info(msg=f"Purged {deleted} orders.")
+
+
+# Meant to be scheduled periodically from celery-beat. Expired leases can be
+# taken over by any worker anyway, this only keeps the claims of dead workers
+# from lingering on the orders.
+@shared_task(queue="maintenance_queue", ignore_result=True)
+def release_expired_order_leases() -> None:
+    released = Order.release_expired_leases()
+    if released > 0:
+        logger.warning(msg=f"Released {released} expired order leases.")
+
+
+# Meant to be scheduled periodically from celery-beat, e.g. with kwargs
+# {"older_than_seconds": 604800, "resolution": "MINUTE"} - minute rollups are
+# only needed for the edges of recent windows, the hourly ones can be kept.
+@shared_task(queue="maintenance_queue", ignore_result=True)
+def purge_stage_duration_rollups(
+    older_than_seconds: int, resolution: Optional[str] = None
+) -> None:
+    deleted = StageDurationRollup.purge(
+        older_than=datetime.timedelta(seconds=older_than_seconds),
+        resolution=resolution,
     )
 
-    order.state = Order.State.SHIPPED
-    order.save()
+    logger.info(msg=f"Purged {deleted} stage duration rollups.")
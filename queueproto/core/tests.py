@@ -1,3 +1,669 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import random
+import time
+import uuid
+from collections import Counter
+from unittest import mock
 
-# Create your tests here.
+from celery.exceptions import Retry, SoftTimeLimitExceeded
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import now
+
+from core.api import simulate_request_async
+from core.buffers import OrderHandlingWriteBuffer
+from core.definitions import Error
+from core.events import (
+    Singleton,
+    decode_processing_event,
+    encode_processing_event,
+)
+from core.ids import generate_shipment_id, uuid7
+from core.marketplace import generate_orders
+from core.models import Order, OrderHandlingProcess
+from core.pagination import InvalidCursor, KeysetPaginator
+from core.partitions import HashRing
+from core.pipeline import (
+    HandlingOutcome,
+    process_order,
+    process_order_stage,
+    process_orders_in_batch,
+)
+from core.sketch import QuantileSketch
+from core.stages import get_stages
+from core.tasks import (
+    handle_order,
+    handle_orders,
+    reschedule_order_handling,
+    retry_order_handling,
+)
+
+REDIS_MODULES = ("core.events", "core.metrics", "core.ratelimit", "core.dedupe")
+
+
+# Redis is replaced with mocks and the write-behind buffer is only flushed when
+# asked to, so every test decides when rows are written
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    SIMULATED_REQUEST_LATENCY=0,
+    ORDER_HANDLING_WRITE_BEHIND=True,
+    ORDER_HANDLING_WRITE_BEHIND_ROWS=10000,
+    ORDER_HANDLING_WRITE_BEHIND_INTERVAL_MS=3600 * 1000,
+    API_RATE_LIMITS={},
+)
+class OrderHandlingTestCase(TestCase):
+    def setUp(self):
+        Singleton._instances.clear()
+        for module in REDIS_MODULES:
+            patcher = mock.patch(f"{module}.get_redis_connection")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(Singleton._instances.clear)
+
+        self.order = Order.generate_and_add_fake_orders(to_generate=1).result[0]
+
+    def fail_shipments(self):
+        patcher = mock.patch(
+            "core.models.OrderShipment.request_shipment_for_order",
+            return_value=(None, Error(message="Marketplace is down")),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class OrderHandlingRetryTests(OrderHandlingTestCase):
+    # The claim of a failed order used to be released only by the next flush of
+    # the write-behind buffer, so an immediate retry found the order claimed and
+    # dropped it
+    def test_claim_is_released_before_failed_order_is_retried(self):
+        self.fail_shipments()
+
+        outcome = process_order(self.order, OrderHandlingWriteBuffer())
+        self.assertEqual(outcome, HandlingOutcome.FAILED)
+
+        claimed_by_at_retry = []
+
+        def retry(**kwargs):
+            claimed_by_at_retry.append(Order.objects.get(id=self.order.id).claimed_by)
+            return Retry()
+
+        task = mock.Mock(request=mock.Mock(retries=0), retry=retry)
+        with self.assertRaises(Retry):
+            retry_order_handling(
+                task, args=[str(self.order.id)], failed_ids=[str(self.order.id)]
+            )
+
+        self.assertEqual(claimed_by_at_retry, [None])
+        self.assertTrue(
+            OrderHandlingProcess.objects.filter(
+                order=self.order, status=OrderHandlingProcess.Status.FAILED
+            ).exists()
+        )
+
+    def test_order_claimed_by_another_worker_is_rescheduled(self):
+        Order.claim([self.order])
+
+        with mock.patch(
+            "core.tasks.reschedule_order_handling"
+        ) as reschedule, mock.patch("core.tasks.OrderHandlingLocks") as locks:
+            handle_order(str(self.order.id))
+
+        reschedule.assert_called_once()
+        released_ids = [
+            order_id
+            for call in locks.return_value.release.call_args_list
+            for order_id in call.args[0]
+        ]
+        self.assertNotIn(str(self.order.id), released_ids)
+
+    def test_batch_reports_orders_claimed_by_another_worker_as_busy(self):
+        Order.claim([self.order])
+
+        outcomes = process_orders_in_batch([self.order], OrderHandlingWriteBuffer())
+
+        self.assertEqual(outcomes, [HandlingOutcome.BUSY])
+
+
+class BatchLeaseTests(OrderHandlingTestCase):
+    # The lease of a batch used to be renewed only between the stages, orders
+    # whose lease ran out during a slow stage were dropped as SKIPPED
+    @override_settings(ORDER_LEASE_SECONDS=0)
+    def test_order_whose_lease_was_lost_during_stage_fails(self):
+        other_order = Order.generate_and_add_fake_orders(to_generate=1).result[0]
+        requested_ids = []
+
+        def request_shipment(order):
+            requested_ids.append(order.id)
+            # Another worker takes over the other order after its lease expired
+            Order.objects.filter(id=other_order.id).update(claimed_by="other")
+            return None, Error(message="Marketplace is down")
+
+        with mock.patch(
+            "core.models.OrderShipment.request_shipment_for_order",
+            side_effect=request_shipment,
+        ):
+            outcomes = process_orders_in_batch(
+                [self.order, other_order], OrderHandlingWriteBuffer()
+            )
+
+        self.assertEqual(outcomes, [HandlingOutcome.FAILED, HandlingOutcome.FAILED])
+        self.assertEqual(requested_ids, [self.order.id])
+
+
+class OrderHandlingWriteBufferTests(OrderHandlingTestCase):
+    # The pending rows used to be swapped out of the buffer before they were
+    # written, so a failed flush (e.g. a locked database) lost them for good
+    def test_rows_are_kept_when_flush_fails(self):
+        self.fail_shipments()
+        buffer = OrderHandlingWriteBuffer()
+        process_order(self.order, buffer)
+
+        with mock.patch.object(
+            OrderHandlingProcess, "bulk_save", side_effect=Exception("locked")
+        ):
+            with self.assertRaises(Exception):
+                buffer.flush()
+
+        self.assertIsNotNone(Order.objects.get(id=self.order.id).claimed_by)
+
+        buffer.flush()
+
+        self.assertIsNone(Order.objects.get(id=self.order.id).claimed_by)
+        self.assertTrue(
+            OrderHandlingProcess.objects.filter(
+                order=self.order, status=OrderHandlingProcess.Status.FAILED
+            ).exists()
+        )
+
+
+class StageTimeLimitTests(OrderHandlingTestCase):
+    # The soft time limit used to be handled only around the request of the
+    # stage, running out of time anywhere else left the order claimed
+    @override_settings(ORDER_STAGES={"GENERATING SHIPMENT": {"concurrency": 0}})
+    def test_order_out_of_time_while_writing_results_fails_and_is_released(self):
+        with mock.patch(
+            "core.models.OrderHandlingProcess.update_processing",
+            side_effect=SoftTimeLimitExceeded(),
+        ):
+            outcome = process_order_stage(
+                self.order, get_stages()[0], OrderHandlingWriteBuffer(), now()
+            )
+        OrderHandlingWriteBuffer().flush()
+
+        self.assertEqual(outcome, HandlingOutcome.FAILED)
+        self.assertIsNone(Order.objects.get(id=self.order.id).claimed_by)
+
+
+class RescheduleTests(OrderHandlingTestCase):
+    # Rescheduled tasks used to be sent with the ID of the task they replaced
+    def test_rescheduled_task_is_sent_as_new_task_on_the_same_queue(self):
+        task = mock.Mock(
+            request=mock.Mock(
+                is_eager=False,
+                delivery_info={"routing_key": "order_stage_tracking"},
+                timelimit=(20, 15),
+            )
+        )
+
+        reschedule_order_handling(task, args=["order", "state"], retry_after=1)
+
+        task.s.assert_called_once_with("order", "state")
+        options = task.s.return_value.apply_async.call_args.kwargs
+        self.assertEqual(options["queue"], "order_stage_tracking")
+        self.assertEqual(options["time_limit"], 20)
+        self.assertEqual(options["soft_time_limit"], 15)
+        self.assertNotIn("task_id", options)
+
+    def test_task_without_queue_and_time_limits_is_sent_with_defaults(self):
+        task = mock.Mock(
+            request=mock.Mock(is_eager=False, delivery_info=None, timelimit=None)
+        )
+
+        reschedule_order_handling(task, args=["order"], retry_after=2)
+
+        options = task.s.return_value.apply_async.call_args.kwargs
+        self.assertEqual(set(options), {"countdown"})
+        self.assertTrue(2 <= options["countdown"] <= 2.4)
+
+
+class HandleOrdersTests(OrderHandlingTestCase):
+    # The locks of orders that failed to be dispatched used to be kept until
+    # they expired, so the orders could not be queued again in the meantime
+    def test_locks_of_orders_not_dispatched_are_released_on_failure(self):
+        other_order = Order.generate_and_add_fake_orders(to_generate=1).result[0]
+        order_ids = [str(self.order.id), str(other_order.id)]
+        partitions = {
+            "order_partition_0": order_ids[:1],
+            "order_partition_1": order_ids[1:],
+        }
+
+        with mock.patch("core.tasks.OrderHandlingLocks") as locks, mock.patch(
+            "core.tasks.group_by_partition", return_value=partitions
+        ), mock.patch(
+            "core.tasks.dispatch_partition",
+            side_effect=[None, ConnectionError("Broker is down")],
+        ):
+            locks.return_value.acquire.return_value = order_ids
+            with self.assertRaises(ConnectionError):
+                handle_orders(order_ids)
+
+        locks.return_value.release.assert_called_once_with({order_ids[1]})
+
+
+class OrderPurgeTests(OrderHandlingTestCase):
+    def test_orders_with_active_lease_are_not_purged(self):
+        other_order = Order.generate_and_add_fake_orders(to_generate=1).result[0]
+        Order.claim([self.order])
+
+        deleted = Order.purge()
+
+        self.assertEqual(deleted, 1)
+        self.assertEqual(
+            list(Order.objects.values_list("id", flat=True)), [self.order.id]
+        )
+        self.assertFalse(
+            OrderHandlingProcess.objects.filter(order=other_order).exists()
+        )
+
+    def test_purge_invalidates_filtered_counts(self):
+        self.assertEqual(Order.get_cached_count(state=Order.State.SHIPPING), 1)
+
+        Order.purge()
+
+        self.assertEqual(Order.get_cached_count(state=Order.State.SHIPPING), 0)
+        self.assertEqual(Order.get_cached_count(), 0)
+
+
+class LatestHandlingProcessTests(OrderHandlingTestCase):
+    def test_processes_created_at_the_same_instant_tie_on_their_ids(self):
+        created_at = now()
+        processes = [
+            OrderHandlingProcess.objects.create(
+                order=self.order,
+                status=OrderHandlingProcess.Status.SUCCEEDED,
+                state=state,
+                started_at=created_at,
+                finished_at=created_at,
+                created_at=created_at,
+            )
+            for state in (
+                OrderHandlingProcess.State.GENERATING_SHIPMENT,
+                OrderHandlingProcess.State.SENDING_TRACKING,
+            )
+        ]
+
+        latest = Order.get_latest_handling_process_for_each_order([self.order])
+
+        self.assertEqual(latest[self.order], max(processes, key=lambda p: p.id))
+
+
+class SimulateRequestAsyncTests(TestCase):
+    @override_settings(SIMULATED_REQUEST_PROFILES="fixed")
+    def test_waiting_for_the_response_yields_to_the_event_loop(self):
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.001)
+
+        async def main():
+            ticker = asyncio.create_task(tick())
+            response = await simulate_request_async(lambda: "data", to_wait=0.05)
+            ticker.cancel()
+            return response
+
+        response = asyncio.run(main())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.response, "data")
+        self.assertGreater(len(ticks), 1)
+
+
+class KeysetPageNumberTests(OrderHandlingTestCase):
+    def test_page_number_is_carried_in_the_cursors(self):
+        Order.generate_and_add_fake_orders(to_generate=4)
+        paginator = KeysetPaginator(
+            Order.objects.all(), per_page=2, key_field="placed_at"
+        )
+
+        first = paginator.get_page()
+        second = paginator.get_page(first.next_cursor)
+        third = paginator.get_page(second.next_cursor)
+        back = paginator.get_page(third.previous_cursor)
+        first_again = paginator.get_page(back.previous_cursor)
+
+        self.assertEqual(
+            [page.number for page in (first, second, third, back, first_again)],
+            [1, 2, 3, 2, 1],
+        )
+        self.assertIsNone(third.next_cursor)
+        self.assertIsNone(first_again.previous_cursor)
+
+    # The page number shown used to be taken from a `page` query parameter
+    @override_settings(ORDERS_PER_PAGE=1)
+    def test_index_shows_the_page_number_of_the_cursor(self):
+        Order.generate_and_add_fake_orders(to_generate=1)
+        first = self.client.get("/", {"page": 7})
+        second = self.client.get(
+            "/", {"cursor": first.context["next_cursor"], "page": 7}
+        )
+
+        self.assertEqual(first.context["current_page"], 1)
+        self.assertEqual(second.context["current_page"], 2)
+
+
+# Generated orders are placed between the midnight before and this time
+REFERENCE_TIME = datetime.datetime(2026, 10, 18, 12)
+
+
+class GenerateOrdersTests(TestCase):
+    def test_invalid_sizes_are_rejected(self):
+        with self.assertRaises(ValueError):
+            generate_orders(5, seed=1, chunk_size=0)
+        with self.assertRaises(ValueError):
+            generate_orders(-1, seed=1)
+
+    def test_no_orders_are_generated_for_zero(self):
+        self.assertEqual(list(generate_orders(0, seed=1)), [])
+
+    def test_seed_gives_the_same_orders_for_any_chunk_size(self):
+        orders = flatten_generated_orders(
+            generate_orders(250, seed=7, reference_time=REFERENCE_TIME, chunk_size=1000)
+        )
+
+        for chunk_size in (1, 37, 100, 250):
+            with self.subTest(chunk_size=chunk_size):
+                chunks = list(
+                    generate_orders(
+                        250,
+                        seed=7,
+                        reference_time=REFERENCE_TIME,
+                        chunk_size=chunk_size,
+                    )
+                )
+                self.assertTrue(all(len(chunk) <= chunk_size for chunk in chunks))
+                self.assertEqual(flatten_generated_orders(chunks), orders)
+
+    def test_more_orders_only_append_to_the_same_seed(self):
+        orders = flatten_generated_orders(
+            generate_orders(250, seed=7, reference_time=REFERENCE_TIME)
+        )
+
+        self.assertEqual(
+            flatten_generated_orders(
+                generate_orders(120, seed=7, reference_time=REFERENCE_TIME)
+            ),
+            orders[:120],
+        )
+        self.assertNotEqual(
+            flatten_generated_orders(
+                generate_orders(120, seed=8, reference_time=REFERENCE_TIME)
+            ),
+            orders[:120],
+        )
+
+    def test_start_skips_orders_of_the_same_seed(self):
+        orders = flatten_generated_orders(
+            generate_orders(250, seed=7, reference_time=REFERENCE_TIME)
+        )
+
+        self.assertEqual(
+            flatten_generated_orders(
+                generate_orders(
+                    120, seed=7, reference_time=REFERENCE_TIME, start=95, chunk_size=30
+                )
+            ),
+            orders[95:215],
+        )
+
+
+class AddFakeOrdersTests(OrderHandlingTestCase):
+    # The chunks used to get seeds of their own, drawn per batch, so the orders
+    # of a seed changed with the batch size
+    def test_orders_of_a_seed_do_not_depend_on_batch_size_or_workers(self):
+        added = []
+        for batch_size, workers in ((7, 1), (25, 2)):
+            Order.purge()
+            call_command(
+                "addfakeorders",
+                30,
+                seed=42,
+                batch_size=batch_size,
+                workers=workers,
+                stdout=io.StringIO(),
+            )
+            added.append(
+                [
+                    (
+                        order.total_price,
+                        order.customer.first_name,
+                        order.currency_iso_code,
+                    )
+                    for order in Order.objects.order_by("id").select_related("customer")
+                ]
+            )
+
+        self.assertEqual(len(added[0]), 30)
+        self.assertEqual(added[0], added[1])
+
+
+# Comparable summary of generated orders
+def flatten_generated_orders(chunks):
+    return [
+        (
+            order.total_price,
+            order.currency_iso_code,
+            order.placed_at,
+            order.customer.first_name,
+            order.customer.zip_code,
+            [(item.product_sku, item.product_title) for item in order.order_items],
+        )
+        for chunk in chunks
+        for order in chunk
+    ]
+
+
+class HashRingTests(SimpleTestCase):
+    def setUp(self):
+        self.nodes = [f"order_partition_{i}" for i in range(4)]
+        self.keys = [str(uuid.UUID(int=i * 7919)) for i in range(4000)]
+
+    def test_keys_are_routed_to_the_same_node_every_time(self):
+        ring = HashRing(self.nodes)
+        other_ring = HashRing(reversed(self.nodes))
+
+        self.assertEqual(
+            [ring.get_node(key) for key in self.keys],
+            [other_ring.get_node(key) for key in self.keys],
+        )
+
+    def test_keys_are_spread_across_all_nodes(self):
+        ring = HashRing(self.nodes)
+
+        counts = Counter(ring.get_node(key) for key in self.keys)
+
+        self.assertEqual(set(counts), set(self.nodes))
+        expected = len(self.keys) / len(self.nodes)
+        for node, count in counts.items():
+            with self.subTest(node=node):
+                self.assertLess(abs(count - expected), expected * 0.25)
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        ring = HashRing(self.nodes)
+        grown_ring = HashRing([*self.nodes, "order_partition_4"])
+
+        moved = [
+            key for key in self.keys if ring.get_node(key) != grown_ring.get_node(key)
+        ]
+
+        self.assertTrue(
+            all(grown_ring.get_node(key) == "order_partition_4" for key in moved)
+        )
+        self.assertLess(len(moved), len(self.keys) * 0.3)
+
+    def test_ring_needs_a_node(self):
+        with self.assertRaises(ValueError):
+            HashRing([])
+
+
+class KeysetPaginatorTests(OrderHandlingTestCase):
+    def setUp(self):
+        super().setUp()
+        Order.generate_and_add_fake_orders(to_generate=6)
+        self.paginator = KeysetPaginator(
+            Order.objects.all(), per_page=3, key_field="placed_at"
+        )
+        self.ordered_ids = list(
+            Order.objects.order_by("-placed_at", "-id").values_list("id", flat=True)
+        )
+
+    def page_ids(self, page):
+        return [order.id for order in page.object_list]
+
+    def test_next_and_previous_cursors_round_trip(self):
+        first = self.paginator.get_page()
+        second = self.paginator.get_page(first.next_cursor)
+        third = self.paginator.get_page(second.next_cursor)
+        back = self.paginator.get_page(third.previous_cursor)
+
+        self.assertEqual(
+            self.page_ids(first) + self.page_ids(second) + self.page_ids(third),
+            self.ordered_ids,
+        )
+        self.assertIsNone(third.next_cursor)
+        self.assertEqual(self.page_ids(back), self.page_ids(second))
+        self.assertEqual(
+            self.page_ids(self.paginator.get_page(back.previous_cursor)),
+            self.page_ids(first),
+        )
+
+    def test_bad_cursor_is_rejected(self):
+        for cursor in ("not a cursor", "WyJzaWRld2F5cyIsICIiLCAiIiwgMV0="):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(InvalidCursor):
+                    self.paginator.get_page(cursor)
+
+
+class ProcessingEventEncodingTests(SimpleTestCase):
+    def test_known_events_round_trip_compactly(self):
+        events = [
+            {
+                "order_id": str(uuid.uuid4()),
+                "event": "updatedOrderProcessingStatus",
+                "status": "PROCESSED",
+            },
+            {
+                "order_id": str(uuid.uuid4()),
+                "event": "updatedOrderHandlingStatus",
+                "status": "FAILED",
+                "state": "SENDING TRACKING",
+            },
+        ]
+
+        for event in events:
+            with self.subTest(event=event):
+                encoded = encode_processing_event(event)
+                self.assertIsInstance(encoded, bytes)
+                self.assertEqual(len(encoded), 20)
+                self.assertEqual(decode_processing_event(encoded), event)
+
+    def test_other_events_fall_back_to_json(self):
+        events = [
+            # Not a UUID
+            {
+                "order_id": "1",
+                "event": "updatedOrderProcessingStatus",
+                "status": "QUEUED",
+            },
+            # Unknown status
+            {
+                "order_id": str(uuid.uuid4()),
+                "event": "updatedOrderProcessingStatus",
+                "status": "LOST",
+            },
+            # Unknown field
+            {
+                "order_id": str(uuid.uuid4()),
+                "event": "updatedOrderHandlingStatus",
+                "status": "FAILED",
+                "message": "Marketplace is down",
+            },
+        ]
+
+        for event in events:
+            with self.subTest(event=event):
+                encoded = encode_processing_event(event)
+                self.assertIsInstance(encoded, str)
+                self.assertEqual(decode_processing_event(encoded), event)
+                self.assertEqual(decode_processing_event(encoded.encode()), event)
+
+
+class QuantileSketchTests(SimpleTestCase):
+    def assertWithinRelativeError(self, estimate, value, relative_error):
+        self.assertLessEqual(abs(estimate - value), value * relative_error)
+
+    def test_quantiles_are_within_the_relative_accuracy(self):
+        rng = random.Random(1)
+        values = sorted(rng.lognormvariate(0, 1.5) for _ in range(10000))
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        for value in values:
+            sketch.add(value)
+
+        for q in (0.01, 0.5, 0.9, 0.99):
+            with self.subTest(q=q):
+                value = values[int(q * (len(values) - 1))]
+                self.assertWithinRelativeError(sketch.quantile(q), value, 0.01)
+
+    def test_merged_sketch_equals_sketch_of_all_values(self):
+        rng = random.Random(2)
+        values = [rng.expovariate(10) for _ in range(2000)] + [0.0] * 10
+        whole, first, second = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for i, value in enumerate(values):
+            whole.add(value)
+            (first if i % 2 else second).add(value)
+
+        first.merge(second)
+
+        self.assertEqual(first.to_dict(), whole.to_dict())
+        self.assertEqual(first.count, len(values))
+        self.assertEqual(
+            QuantileSketch.from_dict(first.to_dict()).quantile(0.95),
+            whole.quantile(0.95),
+        )
+
+    def test_sketches_with_different_accuracy_are_not_merged(self):
+        with self.assertRaises(ValueError):
+            QuantileSketch(relative_accuracy=0.01).merge(
+                QuantileSketch(relative_accuracy=0.05)
+            )
+
+    def test_empty_sketch_has_no_quantiles(self):
+        self.assertIsNone(QuantileSketch().quantile(0.5))
+
+
+class IdTests(SimpleTestCase):
+    def test_uuid7_is_ordered_by_generation(self):
+        ids = [uuid7() for _ in range(5000)]
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_uuid7_has_version_and_variant_bits(self):
+        before_ms = time.time_ns() // 1_000_000
+        value = uuid7()
+        after_ms = time.time_ns() // 1_000_000
+
+        self.assertEqual(value.version, 7)
+        self.assertEqual(value.variant, uuid.RFC_4122)
+        self.assertTrue(before_ms <= value.int >> 80 <= after_ms)
+
+    def test_shipment_id_format(self):
+        shipment_ids = [generate_shipment_id() for _ in range(100)]
+
+        for shipment_id in shipment_ids:
+            self.assertRegex(shipment_id, r"^SHIPMENT-[0-9A-HJKMNP-TV-Z]{26}$")
+        self.assertEqual(shipment_ids, sorted(shipment_ids))
+        self.assertEqual(len(set(shipment_ids)), len(shipment_ids))
@@ -1,30 +1,39 @@
+import math
+
+from django.conf import settings
 from django.shortcuts import render
-from django.core.paginator import Paginator, Page
 from django.db.models import QuerySet
 
-from core.models import Order, OrderHandlingProcess
+from core.models import Order
+from core.pagination import KeysetPaginator, KeysetPage, InvalidCursor
 
 
 def index(request):
-    orders: QuerySet[Order] = Order.objects.all().order_by("-placed_at")
-    paginator = Paginator(orders, 15)
-
-    page_number = request.GET.get("page")
-    page_orders: Page = paginator.get_page(page_number)
+    orders: QuerySet[Order] = Order.objects.all().select_related("customer")
+    paginator = KeysetPaginator(
+        orders, per_page=settings.ORDERS_PER_PAGE, key_field="placed_at"
+    )
 
-    if page_number is None:
-        page_number = 1
+    try:
+        page_orders: KeysetPage = paginator.get_page(request.GET.get("cursor"))
+    except InvalidCursor:
+        page_orders = paginator.get_page()
 
+    # Only the orders displayed on the current page are needed
     latest_handling_processes = Order.get_latest_handling_process_for_each_order(
-        orders=orders
+        orders=page_orders.object_list
     )
 
+    orders_count = Order.get_cached_count()
+
     context = {
-        "orders": page_orders,
+        "orders": page_orders.object_list,
         "lastest_handling_processes": latest_handling_processes,
-        "orders_count": orders.count(),
-        "current_page": page_number,
-        "pages_count": paginator.num_pages,
+        "orders_count": orders_count,
+        "current_page": page_orders.number,
+        "pages_count": max(1, math.ceil(orders_count / settings.ORDERS_PER_PAGE)),
+        "next_cursor": page_orders.next_cursor,
+        "previous_cursor": page_orders.previous_cursor,
     }
 
     return render(request=request, template_name="core/index.html", context=context)
@@ -124,6 +124,18 @@ CACHES = {
     }
 }
 
+# Runs redis in-process on an in-memory fakeredis server (requires fakeredis with
+# lupa for the lua scripts) instead of connecting to CACHE_LOCATION, e.g. to
+# benchmark the pipeline without a redis server. Every connection made by the
+# process shares the same data, other processes don't see it.
+REDIS_IN_PROCESS = env.bool("REDIS_IN_PROCESS", default=False)
+if REDIS_IN_PROCESS:
+    from fakeredis import FakeConnection
+
+    CACHES["default"]["OPTIONS"]["CONNECTION_POOL_KWARGS"] = {
+        "connection_class": FakeConnection
+    }
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
@@ -171,4 +183,134 @@ CELERY_TASK_TIME_LIMIT = 30 * 60
 
 CELERY_BROKER_URL = env("CELERY_BROKER_URL")
 
+# Seconds the results of the tasks that store one are kept. The order handling
+# tasks are fire-and-forget and do not store results at all.
+CELERY_RESULT_EXPIRES = env.int("CELERY_RESULT_EXPIRES", default=3600)
+
 CELERY_CACHE_BACKEND = "default"
+
+# Order handling
+
+# "sequential" - every order is handled by its own `handle_order` task
+# "concurrent" - a single task keeps up to ORDER_HANDLING_MAX_IN_FLIGHT orders
+#                in flight at once inside one worker process
+# "batch"      - orders are handled in chunks of ORDER_HANDLING_BATCH_SIZE with
+#                bulk database writes per stage
+# "staged"     - every stage has its own queue and hands the order over to the
+#                next stage when done, see ORDER_STAGES
+ORDER_HANDLING_MODE = env("ORDER_HANDLING_MODE", default="sequential")
+
+ORDER_HANDLING_MAX_IN_FLIGHT = env.int("ORDER_HANDLING_MAX_IN_FLIGHT", default=8)
+
+ORDER_HANDLING_BATCH_SIZE = env.int("ORDER_HANDLING_BATCH_SIZE", default=50)
+
+# Overrides the queue, concurrency (orders in the stage at once across all
+# workers, 0 for no limit) and timeout (seconds) of the stages of the "staged"
+# mode, see `core.stages.STAGES` for the defaults.
+# e.g. ORDER_STAGES={"GENERATING SHIPMENT": {"concurrency": 16, "timeout": 60}}
+ORDER_STAGES = env.json("ORDER_STAGES", default={})
+
+# Orders are spread over ORDER_QUEUE_PARTITIONS queues ("order_partition_0",
+# "order_partition_1", ...) by consistent hashing of their IDs. Every partition
+# queue has to be consumed by exactly one worker running with --concurrency=1.
+ORDER_QUEUE_PARTITIONS = env.int("ORDER_QUEUE_PARTITIONS", default=1)
+
+# Order events
+
+# "stream" - processing events are appended to a redis stream capped at roughly
+#            ORDER_EVENTS_STREAM_MAX_LENGTH entries, and read with blocking reads.
+#            Every reader keeps its own position, so every API process gets
+#            every event.
+# "list"   - processing events are pushed to a redis list and popped by the reader.
+#            Popping consumes them, so with several API processes every event
+#            only reaches one of them - use it with a single API process only.
+ORDER_EVENTS_BACKEND = env("ORDER_EVENTS_BACKEND", default="stream")
+
+ORDER_EVENTS_STREAM_MAX_LENGTH = env.int(
+    "ORDER_EVENTS_STREAM_MAX_LENGTH", default=10000
+)
+
+# The "list" backend keeps the newest ORDER_EVENTS_LIST_MAX_LENGTH events, older
+# ones are dropped when new events are pushed
+ORDER_EVENTS_LIST_MAX_LENGTH = env.int("ORDER_EVENTS_LIST_MAX_LENGTH", default=10000)
+
+# Seconds after the last event until unread processing events are dropped
+ORDER_EVENTS_TTL = env.int("ORDER_EVENTS_TTL", default=3600)
+
+# New orders are broadcast to every API process through a redis stream capped
+# at roughly NEW_ORDER_EVENTS_MAX_LENGTH entries (oldest entries are dropped)
+NEW_ORDER_EVENTS_MAX_LENGTH = env.int("NEW_ORDER_EVENTS_MAX_LENGTH", default=1000)
+
+# Order dashboard
+
+ORDERS_PER_PAGE = 15
+
+ORDERS_COUNT_CACHE_TIMEOUT = env.int("ORDERS_COUNT_CACHE_TIMEOUT", default=60)
+
+# Seconds the periodic order purge waits between deleted chunks
+ORDER_PURGE_CHUNK_PAUSE = env.float("ORDER_PURGE_CHUNK_PAUSE", default=0.1)
+
+# Opt-in write-behind buffer for handling process rows and order state changes.
+# Pending rows are written in a single transaction every
+# ORDER_HANDLING_WRITE_BEHIND_ROWS rows or ORDER_HANDLING_WRITE_BEHIND_INTERVAL_MS
+# milliseconds, whichever comes first.
+ORDER_HANDLING_WRITE_BEHIND = env.bool("ORDER_HANDLING_WRITE_BEHIND", default=False)
+
+ORDER_HANDLING_WRITE_BEHIND_ROWS = env.int(
+    "ORDER_HANDLING_WRITE_BEHIND_ROWS", default=100
+)
+
+ORDER_HANDLING_WRITE_BEHIND_INTERVAL_MS = env.int(
+    "ORDER_HANDLING_WRITE_BEHIND_INTERVAL_MS", default=250
+)
+
+# How long a worker holds the claim of an order it handles without renewing it.
+# Expired claims can be taken over by other workers.
+ORDER_LEASE_SECONDS = env.int("ORDER_LEASE_SECONDS", default=60)
+
+# Seconds every simulated external API request (carrier, marketplace) takes
+SIMULATED_REQUEST_LATENCY = env.float("SIMULATED_REQUEST_LATENCY", default=0.5)
+
+# "fixed"      - simulated requests always take SIMULATED_REQUEST_LATENCY seconds
+#                and fail independently of each other
+# "production" - per endpoint lognormal latencies around SIMULATED_REQUEST_LATENCY
+#                with heavy-tail spikes and a time of day ramp, and failures
+#                that come in bursts (see core.latency)
+SIMULATED_REQUEST_PROFILES = env("SIMULATED_REQUEST_PROFILES", default="fixed")
+
+# Order handling tasks whose orders failed in a stage are retried up to
+# ORDER_HANDLING_MAX_RETRIES times, with exponential backoff starting at
+# ORDER_HANDLING_RETRY_BACKOFF seconds (capped at ORDER_HANDLING_RETRY_BACKOFF_MAX)
+# and full jitter. Retries resume the orders at the stage that failed.
+ORDER_HANDLING_MAX_RETRIES = env.int("ORDER_HANDLING_MAX_RETRIES", default=5)
+
+ORDER_HANDLING_RETRY_BACKOFF = env.int("ORDER_HANDLING_RETRY_BACKOFF", default=2)
+
+ORDER_HANDLING_RETRY_BACKOFF_MAX = env.int(
+    "ORDER_HANDLING_RETRY_BACKOFF_MAX", default=300
+)
+
+# Orders that are queued or being handled are not queued again. The lock of an
+# order expires after ORDER_HANDLING_DEDUPE_TTL seconds, in case its worker died
+# before releasing it - it should cover the queue wait plus all the retries.
+ORDER_HANDLING_DEDUPE_TTL = env.int("ORDER_HANDLING_DEDUPE_TTL", default=1800)
+
+# Seconds an Idempotency-Key sent to the API is remembered
+IDEMPOTENCY_KEY_TTL = env.int("IDEMPOTENCY_KEY_TTL", default=86400)
+
+# Rate limits of the marketplace and carrier APIs, shared by all workers. Keys
+# are endpoints ("shipment", "tracking", "mark_shipped"), optionally narrowed
+# down to a carrier ("tracking:dhl"), values are [requests per second, burst].
+# Orders that hit a limit are rescheduled for when a token is available.
+# e.g. API_RATE_LIMITS={"shipment": [20, 40], "tracking:fedex": [5, 10]}
+API_RATE_LIMITS = env.json("API_RATE_LIMITS", default={})
+
+# Seconds between the flushes of the metrics recorded by every process to redis,
+# where they are added up and served from /api/v1/metrics
+METRICS_FLUSH_INTERVAL = env.float("METRICS_FLUSH_INTERVAL", default=5)
+
+# Seconds between the flushes of the stage durations collected by every process
+# to the stage duration rollups
+STAGE_DURATION_ROLLUP_FLUSH_INTERVAL = env.float(
+    "STAGE_DURATION_ROLLUP_FLUSH_INTERVAL", default=10
+)
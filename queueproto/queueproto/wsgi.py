@@ -43,9 +43,17 @@ fastapp_v1.add_middleware(
     allow_headers=["*"],
 )
 
+from api.v1.utils.metrics import RequestMetricsMiddleware
+
+fastapp_v1.add_middleware(RequestMetricsMiddleware)
+
 from api.v1.routers.core import router as queue_router
+from api.v1.routers.metrics import router as metrics_router
+from api.v1.routers.analytics import router as analytics_router
 
 fastapp_v1.include_router(queue_router, prefix=f"{fastapp_v1_root}/core")
+fastapp_v1.include_router(metrics_router, prefix=fastapp_v1_root)
+fastapp_v1.include_router(analytics_router, prefix=fastapp_v1_root)
 
 
 @fastapp_v1.get(f"{fastapp_v1_root}/healthcheck", include_in_schema=False)
@@ -1,23 +1,21 @@
 import { BASE_URL } from "./settings.js";
 
 export function gotoPreviousPage() {
-  const currentPage = +document.getElementById("pagination-current-page")
-    .innerHTML;
-  const allPages = +document.getElementById("pagination-total-pages-count")
-    .innerHTML;
+  const cursor = document
+    .getElementById("pagination-previous-btn")
+    .getAttribute("data-cursor");
 
-  if (currentPage - 1 >= 1) {
-    document.location.href = `${BASE_URL}?page=${currentPage - 1}`;
+  if (cursor) {
+    document.location.href = `${BASE_URL}?cursor=${encodeURIComponent(cursor)}`;
   }
 }
 
 export function gotoNextPage() {
-  const currentPage = +document.getElementById("pagination-current-page")
-    .innerHTML;
-  const allPages = +document.getElementById("pagination-total-pages-count")
-    .innerHTML;
+  const cursor = document
+    .getElementById("pagination-next-btn")
+    .getAttribute("data-cursor");
 
-  if (currentPage + 1 <= allPages) {
-    document.location.href = `${BASE_URL}?page=${currentPage + 1}`;
+  if (cursor) {
+    document.location.href = `${BASE_URL}?cursor=${encodeURIComponent(cursor)}`;
   }
 }